@@ -0,0 +1,135 @@
+"""Decode time and peak memory of large uploads: full decode vs ``open_image``.
+
+    python -m benchmarks.decode
+    python -m benchmarks.decode --images some/dir --repeats 10
+
+Each image is decoded and preprocessed both the old way
+(``Image.open(...).convert("RGB")``) and with ``scanner.preprocess.open_image``,
+each in a fresh process, reporting the p50 time, the peak RSS above the
+process's baseline and the largest
+difference in the pixel values fed to the model. Without ``--images`` the
+inputs are synthetic camera photos of 12 to 48 megapixels in several formats,
+one of them rotated through EXIF, plus an oversized PNG the pixel budget must
+refuse.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.inference import peak_rss_mb, reset_peak_rss
+from scanner.preprocess import open_image, preprocess_images
+
+# (name, (height, width), format, EXIF orientation)
+CASES = [
+    ("jpeg 12MP", (3024, 4032), "JPEG", None),
+    ("jpeg 12MP rotated", (3024, 4032), "JPEG", 6),
+    ("jpeg 48MP", (6000, 8000), "JPEG", None),
+    ("png 12MP", (3024, 4032), "PNG", None),
+    ("webp 12MP", (3024, 4032), "WEBP", None),
+]
+
+
+def synthetic_photo(height, width, rng):
+    # Noise upsampled from 1/8 scale: photo-like detail that compresses like a photo
+    small = np.clip(rng.normal(128, 40, (height // 8, width // 8, 3)), 0, 255).astype(np.uint8)
+    return Image.fromarray(small).resize((width, height), Image.BICUBIC)
+
+
+def encode(image, image_format, orientation=None):
+    buffer = io.BytesIO()
+    options = {"quality": 90} if image_format in ("JPEG", "WEBP") else {}
+    if orientation:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        options["exif"] = exif.tobytes()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def sample_images(seed):
+    rng = np.random.default_rng(seed)
+    samples = [(name, encode(synthetic_photo(height, width, rng), image_format, orientation))
+               for name, (height, width), image_format, orientation in CASES]
+    # Tiny on disk, 81 megapixels once decoded
+    samples.append(("png bomb 81MP", encode(Image.new("1", (9000, 9000)), "PNG")))
+    return samples
+
+
+def load_images(directory):
+    names = sorted(os.listdir(directory))
+    samples = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as f:
+            samples.append((name, f.read()))
+    return samples
+
+
+DECODERS = {
+    "full": lambda data: Image.open(io.BytesIO(data)).convert("RGB"),
+    "bounded": lambda data: open_image(io.BytesIO(data)),
+}
+
+
+def current_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure(decoder, data, repeats):
+    """p50 ms, peak MB above the starting RSS and the pixel values, or the error raised."""
+    decode = DECODERS[decoder]
+    baseline = current_rss_mb()
+    reset_peak_rss()
+    try:
+        pixels = preprocess_images([decode(data)])[0]
+    except Exception as e:
+        return None, None, str(e)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        preprocess_images.buffered([decode(data)])
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings)), peak_rss_mb() - baseline, pixels
+
+
+def measure_isolated(decoder, data, repeats):
+    # A fresh process per measurement, so neither path inherits the other's heap
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(measure, decoder, data, repeats).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", help="directory of image files; synthetic photos when omitted")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    samples = load_images(args.images) if args.images else sample_images(args.seed)
+    print(f"{'image':20} {'MB':>6} {'full ms':>9} {'full MB':>8} {'bounded ms':>11} {'bounded MB':>11} {'speedup':>8} {'max diff':>9}")
+    for name, data in samples:
+        full_ms, full_mb, full_pixels = measure_isolated("full", data, args.repeats)
+        bounded_ms, bounded_mb, bounded_pixels = measure_isolated("bounded", data, args.repeats)
+        line = f"{name[:20]:20} {len(data) / 1e6:6.2f} "
+        line += f"{full_ms:9.1f} {full_mb:8.0f} " if full_ms is not None else f"{'error':>9} {'':8} "
+        if bounded_ms is None:
+            print(line + f"{'refused':>11}  ({bounded_pixels})")
+            continue
+        line += f"{bounded_ms:11.1f} {bounded_mb:11.0f} "
+        if full_ms is not None:
+            # The full decode ignores EXIF orientation, so rotated inputs differ by design
+            line += f"{full_ms / bounded_ms:7.1f}x {float(np.abs(full_pixels - bounded_pixels).max()):9.3f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Cost of occlusion attributions, batched against one variant per call.
+
+    python -m benchmarks.explain --base-dir .
+    python -m benchmarks.explain --fixture --grid 7 --batch-size 64
+
+For every layout under ``clip_model/``, ``scanner.explain.explain`` is timed on
+a post whose text fills all 77 tokens (75 token variants) and a camera photo
+(``grid * grid`` cell variants): once with ``--batch-size`` variants per call
+and once with a batch size of 1, the sequential loop it replaces. Both must
+give the same attributions; a mismatch fails the run.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.inference import classifiers, sample_posts
+from scanner.explain import DEFAULT_BATCH_SIZE, DEFAULT_GRID, explain
+from scanner.pipeline import decode_image
+from scanner.tokenizer import ClipTokenizer
+
+
+def time_explain(text, image, classifier, processor, grid, batch_size, repeats):
+    explain(text, image, classifier, processor, grid, batch_size)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = explain(text, image, classifier, processor, grid, batch_size)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)), result
+
+
+def attributions(result):
+    tokens = [[token["importance"][view] for view in sorted(token["importance"])] for token in result["tokens"]]
+    return np.array(tokens), np.array([result["heatmaps"][view] for view in sorted(result["heatmaps"])])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--fixture", action="store_true", help="build and use the tiny random-weight model instead")
+    parser.add_argument("--grid", type=int, default=DEFAULT_GRID)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    base_dir = args.base_dir
+    if args.fixture:
+        from benchmarks.fixture import build_fixture
+
+        base_dir = build_fixture(tempfile.mkdtemp(prefix="scanner-fixture-"), args.seed)
+    processor = ClipTokenizer.from_dir(os.path.join(base_dir, "clip_processor"))
+    layouts = classifiers(os.path.join(base_dir, "clip_model"))
+    text, image_bytes = sample_posts(5, args.seed)[4]
+    text = " ".join([text] * 40)
+    image = decode_image(image_bytes)
+
+    failed = False
+    print(f"{'layout':8} {'batched s':>10} {'one per call s':>15} {'speedup':>8}")
+    for layout, classifier in layouts.items():
+        batched, result = time_explain(text, image, classifier, processor, args.grid, args.batch_size, args.repeats)
+        sequential, expected = time_explain(text, image, classifier, processor, args.grid, 1, args.repeats)
+        print(f"{layout:8} {batched:10.3f} {sequential:15.3f} {sequential / batched:7.1f}x")
+        for got, want in zip(attributions(result), attributions(expected)):
+            if got.shape != want.shape or not np.allclose(got, want, atol=1e-4):
+                print(f"  {layout}: batched attributions differ from the sequential ones")
+                failed = True
+    if args.fixture:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""A tiny random-weight stand-in for the trained model, so benchmarks run offline.
+
+    python -m benchmarks.fixture --out-dir /tmp/scanner-fixture [--quantize]
+
+Writes ``clip_processor/`` (a byte-level BPE ``tokenizer.json`` shaped like
+CLIP's) and ``clip_model/`` with both artifact layouts: ``train_quantized.onnx``
+and ``text_tower.onnx`` + ``image_tower.onnx`` + ``head.npz``. The graphs take
+and return exactly what the real ``CLIPClassifier`` export does (77-token text,
+224x224 images, 512-d embeddings, two logits) but use a narrow two-layer
+encoder per modality, so timings measure the code around the model rather than
+CLIP itself. Needs ``onnx`` (see requirements-export.txt); not torch.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+from tokenizers import Regex, Tokenizer, decoders, models, normalizers, pre_tokenizers, processors
+
+from scanner.model import (EMBED_DIM, FULL_MODEL_FILE, HEAD_FILE, IMAGE_SIZE, IMAGE_TOWER_FILE, MAX_TEXT_LENGTH,
+                           TEXT_TOWER_FILE, zero_embeddings)
+
+WIDTH = 64
+LAYERS = 2
+PATCH_SIZE = 32
+OPSET = 17
+# Readable by every onnxruntime that supports the opset, not only the newest
+IR_VERSION = 8
+
+BOS_TOKEN = "<|startoftext|>"
+EOS_TOKEN = "<|endoftext|>"
+# CLIP's pre-tokenization pattern, so words split as they do for the real tokenizer
+SPLIT_PATTERN = r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+"""
+MERGES = [("t", "h"), ("th", "e</w>"), ("i", "n"), ("o", "n</w>"), ("a", "n"), ("e", "r</w>"), ("r", "e"), ("e", "s")]
+
+
+def build_tokenizer():
+    """Byte-level BPE like CLIP's: every byte is a token, plus a few merges."""
+    byte_tokens = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = byte_tokens + [token + "</w>" for token in byte_tokens] + [a + b for a, b in MERGES]
+    # The end-of-text token has the highest id, as in CLIP, where the text is pooled at argmax(input_ids)
+    vocab += [BOS_TOKEN, EOS_TOKEN]
+    tokenizer = Tokenizer(models.BPE({token: i for i, token in enumerate(vocab)}, MERGES, end_of_word_suffix="</w>",
+                                     unk_token=EOS_TOKEN))
+    tokenizer.normalizer = normalizers.Sequence([
+        normalizers.NFC(), normalizers.Replace(pattern=Regex(r"\s+"), content=" "), normalizers.Lowercase()])
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(Regex(SPLIT_PATTERN), behavior="removed", invert=True),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+    ])
+    tokenizer.post_processor = processors.RobertaProcessing(
+        (EOS_TOKEN, vocab.index(EOS_TOKEN)), (BOS_TOKEN, vocab.index(BOS_TOKEN)), add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return tokenizer
+
+
+class GraphBuilder:
+    """Appends nodes and random initializers under one name prefix."""
+
+    def __init__(self, prefix, rng):
+        self.prefix = prefix
+        self.rng = rng
+        self.nodes = []
+        self.initializers = []
+        self._count = 0
+
+    def _name(self, hint):
+        self._count += 1
+        return f"{self.prefix}{hint}_{self._count}"
+
+    def const(self, array, hint="const"):
+        name = self._name(hint)
+        self.initializers.append(numpy_helper.from_array(np.asarray(array), name))
+        return name
+
+    def weight(self, shape, hint="weight", scale=0.02):
+        return self.const(self.rng.normal(0, scale, shape).astype(np.float32), hint)
+
+    def op(self, op_type, inputs, output=None, **attrs):
+        output = output or self._name(op_type.lower())
+        self.nodes.append(helper.make_node(op_type, inputs, [output], **attrs))
+        return output
+
+    def linear(self, x, d_in, d_out, bias=True):
+        y = self.op("MatMul", [x, self.weight((d_in, d_out))])
+        return self.op("Add", [y, self.const(np.zeros(d_out, dtype=np.float32), "bias")]) if bias else y
+
+    def layer_norm(self, x):
+        return self.op("LayerNormalization", [x, self.const(np.ones(WIDTH, dtype=np.float32), "ln_scale"),
+                                              self.const(np.zeros(WIDTH, dtype=np.float32), "ln_bias")], axis=-1)
+
+    def block(self, x, mask=None):
+        # Pre-norm residual block: single-head attention, then a quick-GELU MLP as in CLIP
+        h = self.layer_norm(x)
+        q, k, v = (self.linear(h, WIDTH, WIDTH) for _ in range(3))
+        scores = self.op("Mul", [self.op("MatMul", [q, self.op("Transpose", [k], perm=[0, 2, 1])]),
+                                 self.const(np.float32(WIDTH ** -0.5))])
+        if mask is not None:
+            scores = self.op("Add", [scores, mask])
+        attended = self.op("MatMul", [self.op("Softmax", [scores], axis=-1), v])
+        x = self.op("Add", [x, self.linear(attended, WIDTH, WIDTH)])
+        h = self.linear(self.layer_norm(x), WIDTH, 4 * WIDTH)
+        h = self.op("Mul", [h, self.op("Sigmoid", [self.op("Mul", [h, self.const(np.float32(1.702))])])])
+        return self.op("Add", [x, self.linear(h, 4 * WIDTH, WIDTH)])
+
+    def normalize(self, x, output):
+        return self.op("Div", [x, self.op("ReduceL2", [x], axes=[-1], keepdims=1)], output)
+
+
+def text_tower(builder, vocab_size, output="text_embeds"):
+    b = builder
+    x = b.op("Gather", [b.weight((vocab_size, WIDTH)), "input_ids"])
+    seq_len = b.op("Unsqueeze", [b.op("Gather", [b.op("Shape", ["input_ids"]), b.const(np.int64(1))]),
+                                 b.const(np.array([0], dtype=np.int64))])
+    positions = b.op("Slice", [b.weight((MAX_TEXT_LENGTH, WIDTH)), b.const(np.array([0], dtype=np.int64)), seq_len,
+                               b.const(np.array([0], dtype=np.int64))])
+    x = b.op("Add", [x, positions])
+
+    # Causal mask plus the padding mask, both additive
+    causal = np.triu(np.full((MAX_TEXT_LENGTH, MAX_TEXT_LENGTH), -1e4, dtype=np.float32), k=1)
+    causal = b.op("Slice", [b.const(causal), b.const(np.array([0, 0], dtype=np.int64)),
+                            b.op("Concat", [seq_len, seq_len], axis=0), b.const(np.array([0, 1], dtype=np.int64))])
+    padding = b.op("Mul", [b.op("Sub", [b.const(np.float32(1)), b.op("Cast", ["attention_mask"], to=TensorProto.FLOAT)]),
+                           b.const(np.float32(-1e4))])
+    mask = b.op("Add", [b.op("Unsqueeze", [padding, b.const(np.array([1], dtype=np.int64))]), causal])
+    for _ in range(LAYERS):
+        x = b.block(x, mask)
+    x = b.layer_norm(x)
+
+    # Pooled at the end-of-text token, the highest id in the row
+    eos = b.op("ArgMax", ["input_ids"], axis=1, keepdims=1)
+    pooled = b.op("GatherND", [x, eos], batch_dims=1)
+    return b.normalize(b.linear(pooled, WIDTH, EMBED_DIM, bias=False), output)
+
+
+def image_tower(builder, output="image_embeds"):
+    b = builder
+    grid = IMAGE_SIZE // PATCH_SIZE
+    patches = b.op("Conv", ["pixel_values", b.weight((WIDTH, 3, PATCH_SIZE, PATCH_SIZE))],
+                   kernel_shape=[PATCH_SIZE, PATCH_SIZE], strides=[PATCH_SIZE, PATCH_SIZE])
+    patches = b.op("Transpose", [b.op("Reshape", [patches, b.const(np.array([0, WIDTH, -1], dtype=np.int64))])],
+                   perm=[0, 2, 1])
+    batch = b.op("Gather", [b.op("Shape", ["pixel_values"]), b.const(np.array([0], dtype=np.int64))])
+    cls_shape = b.op("Concat", [batch, b.const(np.array([1, WIDTH], dtype=np.int64))], axis=0)
+    cls = b.op("Expand", [b.weight((1, 1, WIDTH)), cls_shape])
+    x = b.op("Add", [b.op("Concat", [cls, patches], axis=1), b.weight((grid * grid + 1, WIDTH))])
+    x = b.layer_norm(x)
+    for _ in range(LAYERS):
+        x = b.block(x)
+    pooled = b.layer_norm(b.op("Gather", [x, b.const(np.int64(0))], axis=1))
+    return b.normalize(b.linear(pooled, WIDTH, EMBED_DIM, bias=False), output)
+
+
+def _inputs(names):
+    specs = {
+        "input_ids": helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "sequence"]),
+        "attention_mask": helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "sequence"]),
+        "pixel_values": helper.make_tensor_value_info("pixel_values", TensorProto.FLOAT, ["batch", 3, IMAGE_SIZE, IMAGE_SIZE]),
+    }
+    return [specs[name] for name in names]
+
+
+def _save(builders, inputs, output, width, path):
+    graph = helper.make_graph([node for b in builders for node in b.nodes], os.path.basename(path), _inputs(inputs),
+                              [helper.make_tensor_value_info(output, TensorProto.FLOAT, ["batch", width])],
+                              [init for b in builders for init in b.initializers])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", OPSET)], ir_version=IR_VERSION)
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+
+def build_fixture(out_dir, seed=0, quantize=False):
+    """Write ``clip_processor/`` and ``clip_model/`` under ``out_dir``; returns ``out_dir``."""
+    processor_dir = os.path.join(out_dir, "clip_processor")
+    model_dir = os.path.join(out_dir, "clip_model")
+    os.makedirs(processor_dir, exist_ok=True)
+    os.makedirs(model_dir, exist_ok=True)
+
+    tokenizer = build_tokenizer()
+    tokenizer.save(os.path.join(processor_dir, "tokenizer.json"))
+    with open(os.path.join(processor_dir, "tokenizer_config.json"), "w") as f:
+        json.dump({"bos_token": BOS_TOKEN, "eos_token": EOS_TOKEN, "pad_token": EOS_TOKEN, "unk_token": EOS_TOKEN,
+                   "tokenizer_class": "CLIPTokenizer", "processor_class": "CLIPProcessor"}, f, indent=2)
+
+    # The same seed gives the towers and the joint graph the same weights
+    text = GraphBuilder("text/", np.random.default_rng(seed))
+    text_tower(text, tokenizer.get_vocab_size())
+    image = GraphBuilder("vision/", np.random.default_rng(seed + 1))
+    image_tower(image)
+    _save([text], ["input_ids", "attention_mask"], "text_embeds", EMBED_DIM, os.path.join(model_dir, TEXT_TOWER_FILE))
+    _save([image], ["pixel_values"], "image_embeds", EMBED_DIM, os.path.join(model_dir, IMAGE_TOWER_FILE))
+
+    # CLIPClassifier.fc over [image_embeds, text_embeds]
+    rng = np.random.default_rng(seed + 2)
+    weight = rng.normal(0, 1.0, (2, 2 * EMBED_DIM)).astype(np.float32)
+    bias = np.zeros(2, dtype=np.float32)
+    head = GraphBuilder("head/", rng)
+    combined = head.op("Concat", ["image_embeds", "text_embeds"], axis=1)
+    head.op("Add", [head.op("MatMul", [combined, head.const(weight.T.copy(), "fc_weight")]), head.const(bias, "fc_bias")],
+            "logits")
+    full_path = os.path.join(model_dir, FULL_MODEL_FILE)
+    _save([text, image, head], ["input_ids", "pixel_values", "attention_mask"], "logits", 2, full_path)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # Dynamic QUInt8 like the notebook's train_quantized.onnx
+        for name in (FULL_MODEL_FILE, TEXT_TOWER_FILE, IMAGE_TOWER_FILE):
+            path = os.path.join(model_dir, name)
+            quantize_dynamic(path, path, weight_type=QuantType.QUInt8)
+
+    zero_text, zero_image = zero_embeddings(model_dir)
+    np.savez(os.path.join(model_dir, HEAD_FILE), weight=weight, bias=bias,
+             zero_text_embeds=zero_text, zero_image_embeds=zero_image)
+    return out_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a tiny random-weight model and tokenizer for benchmarks")
+    parser.add_argument("--out-dir", required=True, help="gets clip_processor/ and clip_model/")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quantize", action="store_true", help="dynamically quantize the graphs like the real model")
+    args = parser.parse_args()
+    build_fixture(args.out_dir, args.seed, args.quantize)
+    print(f"Fixture written to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Latency, throughput and memory of each stage of a scan, at several batch sizes.
+
+    python -m benchmarks.inference --base-dir . --batch-sizes 1,2,4,8
+    python -m benchmarks.inference --fixture --json runs/today.json --baseline runs/last-week.json
+
+Stages: image decode, preprocessing, tokenization, the classifier per modality
+(text / image / joint / all three at once, for every layout found under ``clip_model/``) and
+end-to-end scans. Each is timed ``--repeats`` times per batch size and reported
+as p50/p95/p99 latency, items per second and peak RSS during the stage.
+``--fixture`` runs on the tiny random-weight model from ``benchmarks.fixture``
+instead of the real one, so the suite also works where the model is not
+available.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+
+from scanner.model import FULL_MODEL_FILE, FullGraphClassifier, create_session, has_towers, load_classifier, to_verdicts
+from scanner.pipeline import decode_image, encode_texts, scan_post
+from scanner.preprocess import preprocess_images
+from scanner.tokenizer import ClipTokenizer
+
+# Camera photos, screenshots and thumbnails
+IMAGE_SIZES = [(720, 1280), (1080, 1080), (1200, 1600), (480, 640), (3024, 4032), (300, 200)]
+WORDS = ("breaking news government flood dhaka election minister report police court health school market "
+         "price rain cricket team vaccine road accident bank viral video claims photo shows").split()
+BANGLA_WORDS = "ঢাকায় বন্যা নির্বাচন সরকার খবর ভাইরাল ছবি দাবি পুলিশ আদালত".split()
+
+
+def peak_rss_mb():
+    # VmHWM can be reset per stage; ru_maxrss only ever grows
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def sample_posts(count, seed):
+    """``count`` (text, JPEG bytes) pairs with varied lengths, scripts and image sizes."""
+    rng = np.random.default_rng(seed)
+    posts = []
+    for i in range(count):
+        words = BANGLA_WORDS if i % 3 == 2 else WORDS
+        text = " ".join(rng.choice(words, int(rng.integers(3, 40))))
+        height, width = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+        # Smooth gradients plus noise compress like photos, unlike pure noise
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * np.ones((height, 1, 3), dtype=np.float32)
+        pixels = np.clip(gradient + rng.normal(0, 20, (height, width, 3)), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+        posts.append((text, buffer.getvalue()))
+    return posts
+
+
+def time_stage(fn, warmup, repeats):
+    for _ in range(warmup):
+        fn()
+    reset_peak_rss()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings), peak_rss_mb()
+
+
+def summarize(stage, batch_size, timings, peak_mb):
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+    return {
+        "stage": stage,
+        "batch_size": batch_size,
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "mean_ms": float(timings.mean()),
+        "throughput_per_s": float(batch_size / timings.mean() * 1000),
+        "peak_rss_mb": float(peak_mb),
+    }
+
+
+def classifiers(model_dir):
+    """Every layout present in ``model_dir``, by name."""
+    found = {}
+    if has_towers(model_dir):
+        found["towers"] = load_classifier(model_dir)
+    if os.path.exists(os.path.join(model_dir, FULL_MODEL_FILE)):
+        found["full"] = FullGraphClassifier(create_session(os.path.join(model_dir, FULL_MODEL_FILE)))
+    if not found:
+        raise SystemExit(f"No model found under {model_dir}")
+    return found
+
+
+def stages(posts, batch_size, processor, layouts):
+    """``(name, fn)`` for every stage at ``batch_size``; inputs are prepared up front."""
+    batch = posts[:batch_size]
+    texts = [text for text, _ in batch]
+    images = [decode_image(image_bytes) for _, image_bytes in batch]
+    input_ids, attention_mask = encode_texts(texts, processor)
+    seq_len = attention_mask.sum(axis=1)
+    pixel_values = preprocess_images(images)
+
+    yield "decode", lambda: [decode_image(image_bytes) for _, image_bytes in batch]
+    yield "preprocess", lambda: preprocess_images.buffered(images)
+    yield "tokenize", lambda: encode_texts(texts, processor)
+    for layout, classifier in layouts.items():
+        yield f"run/{layout}/text", lambda c=classifier: c.text_logits(input_ids, attention_mask)
+        yield f"run/{layout}/image", lambda c=classifier: c.image_logits(pixel_values, seq_len)
+        yield f"run/{layout}/joint", lambda c=classifier: c.joint_logits(input_ids, attention_mask, pixel_values)
+        yield f"run/{layout}/multi_view", lambda c=classifier: c.multi_view_logits(input_ids, attention_mask, pixel_values)
+
+        def end_to_end(c=classifier):
+            # What scanner.bulk does for a batch of posts: both single-modality verdicts per row
+            ids, mask = encode_texts(texts, processor)
+            pixels = preprocess_images.buffered([decode_image(image_bytes) for _, image_bytes in batch])
+            return to_verdicts(c.text_logits(ids, mask)), to_verdicts(c.image_logits(pixels, mask.sum(axis=1)))
+
+        yield f"end_to_end/{layout}", end_to_end
+        if batch_size == 1:
+            # The app's path, one post per click
+            yield f"scan_post/{layout}", lambda c=classifier: scan_post(batch[0][0], batch[0][1], c, processor)
+
+
+def metadata(base_dir, fixture):
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "base_dir": None if fixture else os.path.abspath(base_dir),
+        "fixture": fixture,
+        "python": platform.python_version(),
+        "onnxruntime": ort.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_table(results, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {(r["stage"], r["batch_size"]): r for r in baseline["results"]}
+    print(f"{'stage':24} {'batch':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'items/s':>10} {'peak MB':>8}"
+          + ("   p50 vs baseline" if baseline else ""))
+    for r in results:
+        line = (f"{r['stage']:24} {r['batch_size']:5d} {r['p50_ms']:9.2f} {r['p95_ms']:9.2f} {r['p99_ms']:9.2f} "
+                f"{r['throughput_per_s']:10.1f} {r['peak_rss_mb']:8.0f}")
+        old = previous.get((r["stage"], r["batch_size"]))
+        if old:
+            line += f"   {r['p50_ms'] / old['p50_ms']:6.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of a scan at several batch sizes")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--fixture", action="store_true", help="build and use the tiny random-weight model instead")
+    parser.add_argument("--quantize-fixture", action="store_true", help="dynamically quantize the fixture like the real model")
+    parser.add_argument("--batch-sizes", default="1,2,4,8", help="comma-separated batch sizes")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare p50 against")
+    args = parser.parse_args()
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    base_dir = args.base_dir
+    if args.fixture:
+        from benchmarks.fixture import build_fixture
+
+        base_dir = build_fixture(tempfile.mkdtemp(prefix="scanner-fixture-"), args.seed, args.quantize_fixture)
+
+    processor = ClipTokenizer.from_dir(os.path.join(base_dir, "clip_processor"))
+    layouts = classifiers(os.path.join(base_dir, "clip_model"))
+    posts = sample_posts(max(batch_sizes), args.seed)
+
+    results = []
+    for batch_size in batch_sizes:
+        for stage, fn in stages(posts, batch_size, processor, layouts):
+            timings, peak_mb = time_stage(fn, args.warmup, args.repeats)
+            results.append(summarize(stage, batch_size, timings, peak_mb))
+            print(f"  {stage} x{batch_size}: p50 {results[-1]['p50_ms']:.2f} ms", file=sys.stderr)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_table(sorted(results, key=lambda r: (r["stage"], r["batch_size"])), baseline)
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump({"meta": metadata(base_dir, args.fixture), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}", file=sys.stderr)
+    if args.fixture:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Per-process memory of several scanner replicas sharing one host.
+
+    python -m benchmarks.memory --base-dir . --replicas 4
+    python -m benchmarks.memory --base-dir . --replicas 4 --compare
+
+Starts ``--replicas`` processes that each load the classifier and run every
+modality once, then reads their RSS, PSS (resident memory with shared pages
+split between the processes mapping them) and private memory from
+``/proc/<pid>/smaps_rollup``. The total PSS is what the replicas really cost
+the host. ``--compare`` also measures a copy of the model with its weights
+moved to external data (``scanner.external_data``): the before/after of
+sharing the weights. Linux only.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SMAPS_FIELDS = {"Rss": "rss_mb", "Pss": "pss_mb", "Private_Clean": "private_mb", "Private_Dirty": "private_mb",
+                "Shared_Clean": "shared_mb", "Shared_Dirty": "shared_mb"}
+
+
+def memory_mb(pid="self"):
+    usage = dict.fromkeys(SMAPS_FIELDS.values(), 0.0)
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            field = line.split(":")[0]
+            if field in SMAPS_FIELDS:
+                usage[SMAPS_FIELDS[field]] += int(line.split()[1]) / 1024
+    return usage
+
+
+def child(model_dir):
+    import numpy as np
+
+    from scanner.model import MAX_TEXT_LENGTH, load_classifier, zero_pixel_values
+
+    start = time.perf_counter()
+    classifier = load_classifier(model_dir)
+    loaded = time.perf_counter()
+    input_ids = np.zeros((1, MAX_TEXT_LENGTH), dtype=np.int64)
+    attention_mask = np.ones((1, MAX_TEXT_LENGTH), dtype=np.int64)
+    pixel_values = zero_pixel_values(1)
+    classifier.text_logits(input_ids, attention_mask)
+    classifier.image_logits(pixel_values, MAX_TEXT_LENGTH)
+    classifier.joint_logits(input_ids, attention_mask, pixel_values)
+    print(json.dumps({"load_s": loaded - start, "first_inference_s": time.perf_counter() - loaded}), flush=True)
+    # Stay resident until the parent has read this process's memory
+    sys.stdin.readline()
+
+
+def measure(model_dir, replicas):
+    # Tuned graphs are inlined copies; measure the graphs as they are on disk
+    env = dict(os.environ, SCANNER_ORT_TUNING="0")
+    command = [sys.executable, "-m", "benchmarks.memory", "--child", "--model-dir", model_dir]
+    processes = []
+    results = []
+    try:
+        # One at a time, so each load can only reuse pages that are already resident
+        for _ in range(replicas):
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=env)
+            processes.append(process)
+            line = process.stdout.readline()
+            if not line:
+                raise SystemExit(f"A replica failed to start on {model_dir}")
+            results.append(json.loads(line))
+        for process, result in zip(processes, results):
+            result.update(memory_mb(process.pid))
+    finally:
+        for process in processes:
+            process.stdin.close()
+            process.wait()
+    return results
+
+
+def summarize(label, results):
+    print(f"{label}: {len(results)} replicas")
+    print(f"  {'replica':>7} {'RSS MB':>8} {'PSS MB':>8} {'private MB':>11} {'shared MB':>10} {'load s':>7}")
+    for i, result in enumerate(results):
+        print(f"  {i:7d} {result['rss_mb']:8.0f} {result['pss_mb']:8.0f} {result['private_mb']:11.0f} "
+              f"{result['shared_mb']:10.0f} {result['load_s']:7.2f}")
+    print(f"  total PSS {sum(result['pss_mb'] for result in results):.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory of several replicas on one host")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_model/")
+    parser.add_argument("--model-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--replicas", type=int, default=4)
+    parser.add_argument("--compare", action="store_true",
+                        help="also measure a copy of the model with its weights in external data")
+    parser.add_argument("--json", help="write the raw results here")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.model_dir)
+        return
+
+    model_dir = os.path.join(args.base_dir, "clip_model")
+    results = {"as_is": measure(model_dir, args.replicas)}
+    summarize(f"{model_dir} as is", results["as_is"])
+    if args.compare:
+        from scanner.external_data import externalize
+        from scanner.tuning import TUNED_DIR, has_external_data
+
+        copy_dir = tempfile.mkdtemp(prefix="scanner-external-")
+        try:
+            shutil.copytree(model_dir, copy_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns(TUNED_DIR))
+            for name in sorted(os.listdir(copy_dir)):
+                path = os.path.join(copy_dir, name)
+                if name.endswith(".onnx") and not has_external_data(path):
+                    externalize(path)
+            results["external_data"] = measure(copy_dir, args.replicas)
+        finally:
+            shutil.rmtree(copy_dir, ignore_errors=True)
+        summarize("weights in external data", results["external_data"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Search latency and recall of the nearest-neighbour index at a million vectors.
+
+    python -m benchmarks.neighbors
+    python -m benchmarks.neighbors --count 100000 --dtype float16 --probes 4,8,16
+
+Fills a temporary ``scanner.neighbors`` index with ``--count`` synthetic
+embeddings (unit vectors scattered around a few thousand topics, like posts
+on recurring stories), clusters it, and times batched top-k searches for
+re-posts (stored vectors with a little noise, as a re-encoded image or an
+edited headline gives) and for new posts on the same topics. Reports p50/p95 latency per
+query batch, how often a re-post finds its original first, and recall@k
+against an exact float32 search.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from scanner.model import EMBED_DIM
+from scanner.neighbors import DEFAULT_K, DTYPES, NeighborIndex, unit_rows
+
+CHUNK = 100_000
+
+
+def synthetic_chunk(start, count, topics, seed):
+    # Seeded per chunk, so the exact search can regenerate the data instead of holding it
+    rng = np.random.default_rng([seed, start])
+    vectors = topics[rng.integers(0, len(topics), count)] + rng.normal(0, 0.03, (count, EMBED_DIM))
+    return unit_rows(vectors)
+
+
+def stored_rows(rows, count, topics, seed):
+    vectors = np.empty((len(rows), EMBED_DIM))
+    for start in np.unique(rows - rows % CHUNK):
+        chunk = synthetic_chunk(start, min(CHUNK, count - start), topics, seed)
+        picked = (rows >= start) & (rows < start + CHUNK)
+        vectors[picked] = chunk[rows[picked] - start]
+    return vectors
+
+
+def exact_top_k(queries, count, topics, seed, k):
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, count, CHUNK):
+        vectors = synthetic_chunk(start, min(CHUNK, count - start), topics, seed)
+        rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(vectors)), (len(queries), len(vectors)))], axis=1)
+        scores = np.concatenate([best_scores, queries @ vectors.T], axis=1)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_rows, best_scores = np.take_along_axis(rows, top, axis=1), np.take_along_axis(scores, top, axis=1)
+    return best_rows
+
+
+def percentile_ms(timings, q):
+    return float(np.percentile(timings, q)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument("--topics", type=int, default=5000)
+    parser.add_argument("--dtype", choices=DTYPES, default="int8")
+    parser.add_argument("--queries", type=int, default=200, help="of each kind, re-posts and new posts")
+    parser.add_argument("--batch-sizes", default="1,16")
+    parser.add_argument("--probes", default="4,8,16")
+    parser.add_argument("--k", type=int, default=DEFAULT_K)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    topics = rng.normal(0, 1 / np.sqrt(EMBED_DIM), (args.topics, EMBED_DIM))
+    directory = tempfile.mkdtemp(prefix="scanner-neighbors-")
+    try:
+        index = NeighborIndex.create(directory, args.dtype)
+        start = time.perf_counter()
+        for chunk_start in range(0, args.count, CHUNK):
+            vectors = synthetic_chunk(chunk_start, min(CHUNK, args.count - chunk_start), topics, args.seed)
+            positions = range(len(vectors))
+            index.append([{"row": chunk_start + i} for i in positions], rng.integers(0, 2, len(vectors)),
+                         {"image": (positions, vectors)}, train=False)
+        appended = time.perf_counter()
+        cells = index.train("image")
+        trained = time.perf_counter()
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"{args.count} {args.dtype} vectors, {size / 1e6:.0f} MB on disk ({size / args.count:.0f} B/vector), "
+              f"{cells or 'no'} cells; appended in {appended - start:.1f} s, clustered in {trained - appended:.1f} s")
+
+        originals = rng.integers(0, args.count, args.queries)
+        stored = stored_rows(originals, args.count, topics, args.seed)
+        queries = {
+            "re-post": unit_rows(stored + rng.normal(0, 0.01, stored.shape)),
+            "new": synthetic_chunk(args.count + CHUNK, args.queries, topics, args.seed + 1),
+        }
+        exact = {name: exact_top_k(values, args.count, topics, args.seed, args.k) for name, values in queries.items()}
+
+        print(f"{'queries':10} {'probes':>6} {'batch':>5} {'p50 ms':>8} {'p95 ms':>8} {'ms/query':>9} "
+              f"{'recall@' + str(args.k):>9} {'found first':>12}")
+        for probes in (int(p) for p in args.probes.split(",")):
+            for batch_size in (int(b) for b in args.batch_sizes.split(",")):
+                for name, values in queries.items():
+                    index.search("image", values[:batch_size], args.k, probes)
+                    timings, found = [], []
+                    for batch_start in range(0, len(values), batch_size):
+                        started = time.perf_counter()
+                        rows, _ = index.search("image", values[batch_start:batch_start + batch_size], args.k, probes)
+                        timings.append(time.perf_counter() - started)
+                        found.append(rows)
+                    found = np.concatenate(found)
+                    recall = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(found, exact[name])])
+                    first = f"{np.mean(found[:, 0] == originals):12.1%}" if name == "re-post" else f"{'':12}"
+                    print(f"{name:10} {probes:6d} {batch_size:5d} {percentile_ms(timings, 50):8.2f} "
+                          f"{percentile_ms(timings, 95):8.2f} {percentile_ms(timings, 50) / batch_size:9.2f} "
+                          f"{recall:9.3f} {first}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Compare scanner.preprocess with CLIPImageProcessor: max difference and latency.
+
+    python -m benchmarks.preprocess --processor clip_processor --images some/dir
+
+Fails when any image's pixel values differ from CLIPImageProcessor's by more
+than ``TOLERANCE`` after normalization.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+from scanner.model import IMAGE_MEAN, IMAGE_STD
+from scanner.preprocess import preprocess_images
+
+TOLERANCE = 1 / 255
+
+
+def load_images(directory, count, seed):
+    if directory:
+        names = sorted(os.listdir(directory))[:count]
+        return [Image.open(os.path.join(directory, name)).convert("RGB") for name in names]
+    # Random photos of common camera and screenshot sizes
+    rng = np.random.default_rng(seed)
+    sizes = [(480, 640), (720, 1280), (1080, 1080), (1200, 1600), (3024, 4032), (300, 200)]
+    return [Image.fromarray(rng.integers(0, 256, sizes[i % len(sizes)] + (3,), dtype=np.uint8)) for i in range(count)]
+
+
+def clip_processor_pixels(image_processor, images):
+    return image_processor(
+        images=images,
+        return_tensors="np",
+        do_convert_rgb=True,
+        do_normalize=True,
+        image_mean=IMAGE_MEAN.tolist(),
+        image_std=IMAGE_STD.tolist(),
+        input_data_format="channels_last"
+    )["pixel_values"]
+
+
+def max_difference(image_processor, images):
+    return max(float(np.abs(preprocess_images([image])[0] - clip_processor_pixels(image_processor, [image])[0]).max())
+               for image in images)
+
+
+def time_ms(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processor", default="clip_processor", help="CLIPProcessor directory")
+    parser.add_argument("--images", help="directory of images; random images when omitted")
+    parser.add_argument("--count", type=int, default=12)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    image_processor = CLIPImageProcessor.from_pretrained(args.processor)
+    images = load_images(args.images, args.count, args.seed)
+
+    diff = max_difference(image_processor, images)
+    print(f"max abs difference: {diff:.3g} (tolerance {TOLERANCE:.3g})")
+    for name, fn in [
+        ("CLIPImageProcessor, one by one", lambda: [clip_processor_pixels(image_processor, [image]) for image in images]),
+        ("preprocess_images, one by one", lambda: [preprocess_images.buffered([image]) for image in images]),
+        ("preprocess_images, one batch", lambda: preprocess_images.buffered(images)),
+    ]:
+        print(f"{name}: {time_ms(fn, args.repeats) / len(images):.2f} ms/image")
+    if diff > TOLERANCE:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
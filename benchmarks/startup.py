@@ -0,0 +1,106 @@
+"""Cold-start cost of the inference runtime, measured in fresh interpreters.
+
+    python -m benchmarks.startup --base-dir . --runs 3
+    python -m benchmarks.startup --base-dir . --legacy   # also time torch + transformers imports
+
+Reports import time, model-load time, first-inference time and peak RSS,
+each run in its own process so nothing is warm.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("torch", "transformers")
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def sample_image_bytes():
+    import numpy as np
+    from PIL import Image
+
+    pixels = np.random.default_rng(0).integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def child(base_dir, legacy):
+    start = time.perf_counter()
+    if legacy:
+        import torch  # noqa: F401
+        import transformers  # noqa: F401
+    from scanner.pipeline import load_model_and_processor, scan_post
+    imported = time.perf_counter()
+
+    classifier, processor = load_model_and_processor(base_dir, max_batch_size=1)
+    loaded = time.perf_counter()
+
+    image_bytes = sample_image_bytes()
+    before_scan = time.perf_counter()
+    scan_post("A headline to warm the model up", image_bytes, classifier, processor)
+    scanned = time.perf_counter()
+
+    print(json.dumps({
+        "import_s": imported - start,
+        "load_s": loaded - imported,
+        "first_inference_s": scanned - before_scan,
+        "peak_rss_mb": peak_rss_mb(),
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+def run(base_dir, legacy):
+    command = [sys.executable, "-m", "benchmarks.startup", "--child", "--base-dir", base_dir]
+    if legacy:
+        command.append("--legacy")
+    start = time.perf_counter()
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_s"] = time.perf_counter() - start
+    return result
+
+
+def summarize(label, results):
+    print(label)
+    for key in ("import_s", "load_s", "first_inference_s", "process_s", "peak_rss_mb"):
+        values = sorted(result[key] for result in results)
+        print(f"  {key:18} median {values[len(values) // 2]:8.3f}   min {values[0]:8.3f}   max {values[-1]:8.3f}")
+    print(f"  heavy modules loaded: {', '.join(results[0]['heavy_modules']) or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start time and memory of the runtime")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--legacy", action="store_true", help="also measure with torch and transformers imported")
+    parser.add_argument("--json", help="write the raw results here")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.base_dir, args.legacy)
+        return
+
+    results = {"slim": [run(args.base_dir, False) for _ in range(args.runs)]}
+    summarize("slim runtime", results["slim"])
+    if args.legacy:
+        results["legacy"] = [run(args.base_dir, True) for _ in range(args.runs)]
+        summarize("with torch + transformers", results["legacy"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
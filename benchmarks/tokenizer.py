@@ -0,0 +1,163 @@
+"""The cost of tokenization on its own, and how the slow CLIPTokenizer differs.
+
+    python -m benchmarks.tokenizer --processor clip_processor
+    python -m benchmarks.tokenizer --processor clip_processor --texts headlines.txt --repeats 5
+
+Parity of ``scanner.tokenizer.ClipTokenizer`` with ``CLIPProcessor`` and the
+fast tokenizer on the corpus below (Bangla and English headlines plus the
+hard cases: decomposed Bangla, zero-width joiners, mixed scripts, emoji,
+URLs, runs of whitespace, over-long articles) is tested by
+``tests/test_tokenizer.py``. Where the installed transformers still has the
+slow ``CLIPTokenizer`` it is compared here, for information only: the model
+was trained on the fast one.
+
+Cost: microseconds per text through ``CLIPProcessor`` one text at a time (the
+old path), ``ClipTokenizer`` one at a time, batched without the memo, and
+batched with the memo over a stream where texts recur as they do in practice.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import unicodedata
+
+import numpy as np
+
+from benchmarks.inference import BANGLA_WORDS, WORDS
+from scanner.model import MAX_TEXT_LENGTH
+from scanner.tokenizer import ClipTokenizer
+
+ZWJ, ZWNJ = "\u200d", "\u200c"
+HARD_CASES = [
+    "",
+    "   ",
+    "Breaking:   Flood in   Dhaka\n\nthousands stranded",
+    f"র{ZWJ}্যাবের অভিযানে আটক ৫",
+    f"র্{ZWJ}যাব " + ZWNJ.join(["ক", "ষ"]),
+    unicodedata.normalize("NFD", "ড়াকাত ধরা পড়েছে, বাংলাদেশের রাস্তায় কোন যানজট নেই"),
+    "ো" + " কো" + " কোন",
+    "ঢাকায় BREAKING news: ভাইরাল ছবি 😱🔥 https://example.com/a?b=1 #fake @someone",
+    "১২৩ ৪৫৬ 2024-05-01 ৳500",
+    "“Quoted” — ‘dashes’ … and ＦＵＬＬＷＩＤＴＨ",
+    "TAB\tSEPARATED\u00a0NBSP\u2003EM SPACE",
+]
+
+
+def sample_texts(count, seed):
+    rng = np.random.default_rng(seed)
+    texts = list(HARD_CASES)
+    for i in range(count - len(texts)):
+        words = BANGLA_WORDS if i % 2 else WORDS
+        length = int(rng.choice([6, 12, 30, 120]))
+        texts.append(" ".join(rng.choice(words, length)))
+    return texts
+
+
+def reference_processor(processor_dir, use_fast):
+    from transformers import AutoTokenizer, CLIPImageProcessor, CLIPProcessor
+
+    tokenizer = AutoTokenizer.from_pretrained(processor_dir, use_fast=use_fast)
+    if not use_fast and tokenizer.is_fast:
+        return None
+    return CLIPProcessor(image_processor=CLIPImageProcessor(), tokenizer=tokenizer)
+
+
+def slow_processor_dir(processor_dir):
+    """``processor_dir`` itself when it has the slow tokenizer's files, else a copy with
+    ``vocab.json`` and ``merges.txt`` written from ``tokenizer.json``."""
+    if all(os.path.exists(os.path.join(processor_dir, name)) for name in ("vocab.json", "merges.txt")):
+        return processor_dir
+    copy_dir = tempfile.mkdtemp(prefix="scanner-slow-tokenizer-")
+    shutil.copytree(processor_dir, copy_dir, dirs_exist_ok=True)
+    with open(os.path.join(processor_dir, "tokenizer.json"), encoding="utf-8") as f:
+        model = json.load(f)["model"]
+    with open(os.path.join(copy_dir, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(model["vocab"], f, ensure_ascii=False)
+    with open(os.path.join(copy_dir, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+        for merge in model["merges"]:
+            f.write((merge if isinstance(merge, str) else " ".join(merge)) + "\n")
+    os.remove(os.path.join(copy_dir, "tokenizer.json"))
+    return copy_dir
+
+
+def processor_encode(processor, texts):
+    encoded = processor(text=texts, padding="max_length", truncation=True, max_length=MAX_TEXT_LENGTH,
+                        return_tensors="np")
+    return encoded["input_ids"].astype(np.int64), encoded["attention_mask"].astype(np.int64)
+
+
+def mismatches(tokenizer, processor, texts):
+    ids, mask = tokenizer(texts)
+    expected_ids, expected_mask = processor_encode(processor, texts)
+    rows = np.flatnonzero((ids != expected_ids).any(axis=1) | (mask != expected_mask).any(axis=1))
+    return [texts[i] for i in rows]
+
+
+def time_us(fn, texts, repeats):
+    fn(texts[:8])
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(texts)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) / len(texts) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processor", default="clip_processor", help="CLIPProcessor directory")
+    parser.add_argument("--texts", help="file of texts, one per line; synthetic headlines when omitted")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as f:
+            texts = HARD_CASES + [line.rstrip("\n") for line in f]
+    else:
+        texts = sample_texts(args.count, args.seed)
+    tokenizer = ClipTokenizer.from_dir(args.processor, memo_entries=0)
+    fast = reference_processor(args.processor, use_fast=True)
+
+    slow_dir = slow_processor_dir(args.processor)
+    try:
+        slow = reference_processor(slow_dir, use_fast=False)
+        if slow is None:
+            print("slow CLIPTokenizer: not in this transformers version, skipped")
+        else:
+            differing = mismatches(tokenizer, slow, texts)
+            print(f"slow CLIPTokenizer: {len(texts) - len(differing)}/{len(texts)} texts identical (informational)")
+            for text in differing[:10]:
+                print(f"  differs: {text[:80]!r}")
+    finally:
+        if slow_dir != args.processor:
+            shutil.rmtree(slow_dir, ignore_errors=True)
+
+    batches = lambda fn: lambda items: [fn(items[start:start + args.batch_size])
+                                        for start in range(0, len(items), args.batch_size)]
+    # Re-posts: most of a stream is texts seen before
+    rng = np.random.default_rng(args.seed)
+    stream = [texts[i] for i in rng.zipf(1.3, len(texts) * 4) % len(texts)]
+    print(f"{'path':44} {'us/text':>9}")
+    for name, fn, items in [
+        ("CLIPProcessor, one text per call", lambda items: [processor_encode(fast, [text]) for text in items], texts),
+        ("ClipTokenizer, one text per call", lambda items: [tokenizer([text]) for text in items], texts),
+        (f"ClipTokenizer, batches of {args.batch_size}", batches(tokenizer), texts),
+        (f"ClipTokenizer, batches of {args.batch_size}, re-post stream", batches(tokenizer), stream),
+    ]:
+        print(f"{name:44} {time_us(fn, items, args.repeats):9.1f}")
+    # One pass from an empty memo, so the hits are only the stream's own repeats
+    memoized = ClipTokenizer.from_dir(args.processor, memo_entries=4096)
+    start = time.perf_counter()
+    batches(memoized)(stream)
+    elapsed = time.perf_counter() - start
+    print(f"{'  + memo, from empty':44} {elapsed / len(stream) * 1e6:9.1f}  (hit rate {memoized.stats()['hit_rate']:.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Inference helpers for the Multimodal BN-EN Fake News Scanner."""
@@ -0,0 +1,261 @@
+"""Dynamic micro-batching around a shared classifier.
+
+Every Streamlit session shares one cached classifier, but each click runs its
+own batch of one. ``MicroBatcher`` collects requests from concurrent callers
+for up to ``max_wait_ms`` (or until ``max_batch_size`` rows are waiting), runs
+them as one batch on a worker thread and resolves each caller's future with
+its own row. ``BatchedClassifier`` puts that in front of a classifier from
+``scanner.model`` without changing its interface.
+"""
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from scanner.model import MAX_TEXT_LENGTH, VIEWS, bucket_widths, multi_view_from_embeds
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT_MS = 5.0
+
+_STOP = object()
+
+_Request = collections.namedtuple("_Request", ["key", "item", "future"])
+
+
+class MicroBatcher:
+    """Run ``fn(items)`` over batches of concurrently submitted items.
+
+    ``fn`` receives a list of items that share the same ``key`` and must return
+    one result per item, in order. Items with different keys (for example
+    different sequence lengths) never share a batch.
+    """
+
+    def __init__(self, fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, name="micro-batcher"):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._held = collections.deque()
+        self._stopping = False
+        # Guards _closed, so nothing is queued behind _STOP
+        self._close_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item, key=None):
+        future = Future()
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError("batcher is closed")
+            self._queue.put(_Request(key, item, future))
+        return future
+
+    def __call__(self, item, key=None):
+        return self.submit(item, key).result()
+
+    def pending(self):
+        """Items submitted and not yet taken into a batch."""
+        return self._queue.qsize() + len(self._held)
+
+    def close(self):
+        """Run everything submitted so far, then stop; later ``submit`` calls raise ``RuntimeError``."""
+        with self._close_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(_STOP)
+        self._thread.join()
+        # Nothing should be left, but a future that is never resolved blocks its caller forever
+        leftovers = list(self._held)
+        self._held.clear()
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for request in leftovers:
+            if request is not _STOP and request.future.set_running_or_notify_cancel():
+                request.future.set_exception(RuntimeError("batcher is closed"))
+
+    def _collect(self):
+        if self._held:
+            first = self._held.popleft()
+        elif self._stopping:
+            return None
+        else:
+            first = self._queue.get()
+            if first is _STOP:
+                self._stopping = True
+                return None
+
+        batch = [first]
+        for request in list(self._held):
+            if len(batch) >= self.max_batch_size:
+                break
+            if request.key == first.key:
+                batch.append(request)
+                self._held.remove(request)
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size and not self._stopping:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is _STOP:
+                self._stopping = True
+            elif request.key == first.key:
+                batch.append(request)
+            else:
+                # Wait for its own batch on the next round
+                self._held.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.fn([request.item for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+
+class BatchedClassifier:
+    """Drop-in wrapper that micro-batches rows across concurrent callers.
+
+    Text and image rows go through separate batchers, so the two modalities
+    also run on separate worker threads. For the split towers only the encoder
+    outputs are batched, so image rows with different zero-text lengths can
+    share a batch; the joint graph needs one batch per length. Text rows are
+    batched per length bucket when bucketing is on (see ``scanner.model``). A call that
+    already brings ``max_batch_size`` rows runs directly as one batch.
+    """
+
+    def __init__(self, classifier, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self.classifier = classifier
+        self.max_batch_size = max_batch_size
+        self.towers = self.has_embeddings = classifier.has_embeddings
+        self.text_batcher = MicroBatcher(self._run_text, max_batch_size, max_wait_ms, "text-batcher")
+        self.image_batcher = MicroBatcher(self._run_image, max_batch_size, max_wait_ms, "image-batcher")
+        # The towers build joint verdicts from the two encoder batchers
+        self.joint_batcher = None if self.towers else MicroBatcher(self._run_joint, max_batch_size, max_wait_ms, "joint-batcher")
+        self.multi_view_batcher = None if self.towers else MicroBatcher(
+            self._run_multi_view, max_batch_size, max_wait_ms, "multi-view-batcher")
+
+    def close(self):
+        for batcher in (self.text_batcher, self.image_batcher, self.joint_batcher, self.multi_view_batcher):
+            if batcher is not None:
+                batcher.close()
+
+    def _run_text(self, items):
+        input_ids = np.stack([item[0] for item in items])
+        attention_mask = np.stack([item[1] for item in items])
+        if self.towers:
+            return self.classifier.text_embeds(input_ids, attention_mask)
+        return self.classifier.text_logits(input_ids, attention_mask)
+
+    def _run_image(self, items):
+        pixel_values = np.stack([item[0] for item in items])
+        if self.towers:
+            return self.classifier.image_embeds(pixel_values)
+        return self.classifier.image_logits(pixel_values, items[0][1])
+
+    def _run_joint(self, items):
+        input_ids = np.stack([item[0] for item in items])
+        attention_mask = np.stack([item[1] for item in items])
+        pixel_values = np.stack([item[2] for item in items])
+        return self.classifier.joint_logits(input_ids, attention_mask, pixel_values)
+
+    def _run_multi_view(self, items):
+        logits = self.classifier.multi_view_logits(*(np.stack([item[i] for item in items]) for i in range(3)))
+        return [tuple(logits[view][row] for view in VIEWS) for row in range(len(items))]
+
+    def text_logits_from_embeds(self, text_embeds):
+        return self.classifier.text_logits_from_embeds(text_embeds)
+
+    def image_logits_from_embeds(self, image_embeds, seq_len=MAX_TEXT_LENGTH):
+        return self.classifier.image_logits_from_embeds(image_embeds, seq_len)
+
+    def head(self, image_embeds, text_embeds):
+        return self.classifier.head(image_embeds, text_embeds)
+
+    def joint_logits_from_embeds(self, image_embeds, text_embeds, input_ids, attention_mask):
+        return self.classifier.joint_logits_from_embeds(image_embeds, text_embeds, input_ids, attention_mask)
+
+    @staticmethod
+    def _gather(futures):
+        return np.stack([future.result() for future in futures])
+
+    def _bucket_keys(self, attention_mask):
+        # Padded width and bucket, so every batch runs as a single bucket
+        widths = bucket_widths(attention_mask, self.classifier.text_buckets)
+        return [(np.shape(attention_mask)[1], int(width)) for width in widths]
+
+    def _is_full(self, rows):
+        return len(rows) >= self.max_batch_size
+
+    def text_embeds(self, input_ids, attention_mask):
+        if self._is_full(input_ids):
+            return self.classifier.text_embeds(input_ids, attention_mask)
+        return self._gather([self.text_batcher.submit((ids, mask), key)
+                             for ids, mask, key in zip(input_ids, attention_mask, self._bucket_keys(attention_mask))])
+
+    def image_embeds(self, pixel_values):
+        if self._is_full(pixel_values):
+            return self.classifier.image_embeds(pixel_values)
+        return self._gather([self.image_batcher.submit((pixels, None)) for pixels in pixel_values])
+
+    def text_logits(self, input_ids, attention_mask):
+        if self.towers:
+            return self.classifier.text_logits_from_embeds(self.text_embeds(input_ids, attention_mask))
+        if self._is_full(input_ids):
+            return self.classifier.text_logits(input_ids, attention_mask)
+        return self._gather([self.text_batcher.submit((ids, mask), key)
+                             for ids, mask, key in zip(input_ids, attention_mask, self._bucket_keys(attention_mask))])
+
+    def image_logits(self, pixel_values, seq_len=MAX_TEXT_LENGTH):
+        if self.towers:
+            return self.classifier.image_logits_from_embeds(self.image_embeds(pixel_values), seq_len)
+        if self._is_full(pixel_values):
+            return self.classifier.image_logits(pixel_values, seq_len)
+        seq_len = np.broadcast_to(seq_len, (len(pixel_values),))
+        return self._gather([self.image_batcher.submit((pixels, int(length)), int(length))
+                             for pixels, length in zip(pixel_values, seq_len)])
+
+    def joint_logits(self, input_ids, attention_mask, pixel_values):
+        if self.towers:
+            return self.classifier.joint_logits_from_embeds(self.image_embeds(pixel_values), self.text_embeds(input_ids, attention_mask),
+                                                            input_ids, attention_mask)
+        if self._is_full(input_ids):
+            return self.classifier.joint_logits(input_ids, attention_mask, pixel_values)
+        return self._gather([self.joint_batcher.submit((ids, mask, pixels), key) for ids, mask, pixels, key
+                             in zip(input_ids, attention_mask, pixel_values, self._bucket_keys(attention_mask))])
+
+    def multi_view_logits(self, input_ids, attention_mask, pixel_values):
+        if self.towers:
+            return multi_view_from_embeds(self.classifier, self.image_embeds(pixel_values),
+                                          self.text_embeds(input_ids, attention_mask), input_ids, attention_mask)
+        if self._is_full(input_ids):
+            return self.classifier.multi_view_logits(input_ids, attention_mask, pixel_values)
+        # One run per token length, see FullGraphClassifier.multi_view_logits
+        keys = [(np.shape(attention_mask)[1], int(length)) for length in np.sum(attention_mask, axis=1)]
+        rows = [future.result() for future in [self.multi_view_batcher.submit(item, key) for item, key
+                                               in zip(zip(input_ids, attention_mask, pixel_values), keys)]]
+        return {view: np.stack([row[i] for row in rows]) for i, view in enumerate(VIEWS)}
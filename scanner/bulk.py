@@ -0,0 +1,313 @@
+"""Offline bulk scanning over CSV/JSONL rows of (text, image_path).
+
+    python -m scanner.bulk rows.csv --image-root /data/images --output scores.jsonl
+    python -m scanner.bulk rows.jsonl --output scores/ --format parquet
+
+Rows are read in chunks, images are decoded and preprocessed on a thread pool
+while the previous chunk runs through the model, and results are appended to
+the output after every chunk. ``<output>.checkpoint.json`` records how many
+rows are safely written, so re-running the same command resumes where an
+interrupted run stopped. Memory is bounded by two chunks whatever the input
+size.
+
+A row may carry several images: a list in JSONL, or paths separated by
+``--image-separator`` in CSV. All images of a chunk run through the vision
+side in the same batches, and each row gets a post-level image verdict
+combined by ``--image-aggregate``, plus per-image verdicts under ``images``.
+Animated GIFs and video clips are scanned by their keyframes (see
+``scanner.frames``), listed with their verdicts under ``frames``.
+"""
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from scanner.cascade import load_cascade
+from scanner.frames import is_animated, keyframes
+from scanner.longtext import AGGREGATIONS, DEFAULT_AGGREGATION, aggregate_windows, long_text_logits
+from scanner.model import run_batches, to_verdicts
+from scanner.pipeline import encode_texts, load_model_and_processor, preprocess_image
+from scanner.preprocess import open_image, preprocess_images
+
+DEFAULT_CHUNK_SIZE = 256
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_IMAGE_SEPARATOR = "|"
+
+
+def read_rows(path):
+    if path.endswith((".jsonl", ".ndjson")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            yield from csv.DictReader(f)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_pixels(path):
+    # Runs on the worker pool; PIL releases the GIL while decoding and resizing
+    return preprocess_image(open_image(path))
+
+
+def load_frames(path):
+    """Pixel values of a still (one row) or of the keyframes of an animation or
+    clip, and the keyframe times (None for a still)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if is_animated(data):
+        times, crops = keyframes(data)
+        return preprocess_images(crops), times
+    return preprocess_image(open_image(io.BytesIO(data)))[None], None
+
+
+class JsonlWriter:
+    def __init__(self, path, state):
+        if state and (not os.path.exists(path) or os.path.getsize(path) < state["output_bytes"]):
+            # Resuming would skip the rows the checkpoint says are written
+            raise SystemExit(f"{path} is missing rows its checkpoint counts as written; "
+                             f"remove {path}.checkpoint.json to start over")
+        self.file = open(path, "r+b" if state else "wb")
+        if state:
+            # Drop anything written after the last checkpoint
+            self.file.truncate(state["output_bytes"])
+            self.file.seek(0, os.SEEK_END)
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"output_bytes": self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    # Parquet files cannot be appended to, so every chunk becomes its own part
+    def __init__(self, directory, state):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        # Fixed up front so a chunk of all-null columns cannot change the types
+        frames = pyarrow.list_(pyarrow.struct([
+            ("time", pyarrow.float64()), ("label", pyarrow.string()), ("conf", pyarrow.float64())]))
+        self.schema = pyarrow.schema([
+            ("row", pyarrow.int64()), ("id", pyarrow.string()),
+            ("text_label", pyarrow.string()), ("text_conf", pyarrow.float64()), ("text_stage", pyarrow.string()),
+            ("image_label", pyarrow.string()), ("image_conf", pyarrow.float64()),
+            ("frames", frames),
+            ("images", pyarrow.list_(pyarrow.struct([
+                ("label", pyarrow.string()), ("conf", pyarrow.float64()), ("error", pyarrow.string()),
+                ("frames", frames)]))),
+            ("error", pyarrow.string()),
+        ])
+        self.directory = directory
+        self.part = state["parts"] if state else 0
+        if any(not os.path.exists(self._path(part)) for part in range(self.part)):
+            raise SystemExit(f"{directory} is missing parts its checkpoint counts as written; "
+                             f"remove {directory}.checkpoint.json to start over")
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith("part-") and int(name[5:11]) >= self.part:
+                os.remove(os.path.join(directory, name))
+
+    def _path(self, part):
+        return os.path.join(self.directory, f"part-{part:06d}.parquet")
+
+    def write(self, records):
+        path = self._path(self.part)
+        records = [dict(record, id=None if record["id"] is None else str(record["id"])) for record in records]
+        self.pq.write_table(self.pa.Table.from_pylist(records, schema=self.schema), path)
+        self.part += 1
+        return {"parts": self.part}
+
+    def close(self):
+        pass
+
+
+def load_checkpoint(path, input_path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    if state["input"] != os.path.abspath(input_path):
+        raise SystemExit(f"{path} belongs to another input ({state['input']}); remove it to start over")
+    return state
+
+
+def save_checkpoint(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def scan_chunk(start, rows, pixel_futures, classifier, processor, args, cascade=None):
+    texts = [(row.get(args.text_column) or "").strip() for row in rows]
+    input_ids, attention_mask = encode_texts(texts, processor)
+    records = [dict(row=start + i, id=row.get(args.id_column), text_label=None, text_conf=None, text_stage=None,
+                    image_label=None, image_conf=None, error=None) for i, row in enumerate(rows)]
+
+    text_rows = [i for i, text in enumerate(texts) if text]
+    if text_rows and cascade is not None:
+        logits, settled = cascade.route([texts[i] for i in text_rows])
+        for i, (label, conf), done in zip(text_rows, to_verdicts(logits), settled):
+            if done:
+                records[i].update(text_label=label, text_conf=float(conf), text_stage="cascade")
+        text_rows = [i for i, done in zip(text_rows, settled) if not done]
+    if text_rows:
+        # Ordered by token count so each batch falls into as few length buckets as possible
+        text_rows.sort(key=lambda i: attention_mask[i].sum())
+        if args.long_text:
+            # One call per batch of articles, covering all of their windows
+            batches = [text_rows[start:start + args.batch_size] for start in range(0, len(text_rows), args.batch_size)]
+            logits = np.concatenate([long_text_logits([texts[i] for i in batch], classifier, processor, args.long_text)
+                                     for batch in batches])
+        else:
+            logits = run_batches(classifier.text_logits, (input_ids[text_rows], attention_mask[text_rows]), args.batch_size)
+        for i, (label, conf) in zip(text_rows, to_verdicts(logits)):
+            records[i].update(text_label=label, text_conf=float(conf), text_stage="clip")
+
+    # Every readable image of the chunk: its row, position in the row and keyframe times
+    owners, pixels = [], []
+    for i, futures in enumerate(pixel_futures):
+        if len(futures) > 1:
+            records[i]["images"] = [{"label": None, "conf": None, "error": None} for _ in futures]
+        for position, future in enumerate(futures):
+            try:
+                frames, times = future.result()
+            except Exception as e:
+                records[i]["error"] = f"Cannot open image: {e}"
+                if len(futures) > 1:
+                    records[i]["images"][position]["error"] = records[i]["error"]
+                continue
+            pixels.append(frames)
+            owners.append((i, position, times))
+    if owners:
+        # Image-only rows pair the image with zeroed text of the text's token length
+        counts = [len(frames) for frames in pixels]
+        image_rows = np.repeat([i for i, _, _ in owners], counts)
+        seq_lens = attention_mask[image_rows].sum(axis=1)
+        logits = run_batches(classifier.image_logits, (np.concatenate(pixels), seq_lens), args.batch_size)
+        bounds = np.cumsum([0] + counts)
+        row_logits = collections.defaultdict(list)
+        for (i, position, times), start, end in zip(owners, bounds[:-1], bounds[1:]):
+            image_logits = logits[start:end]
+            entry = records[i]["images"][position] if "images" in records[i] else None
+            if times is not None:
+                (entry if entry is not None else records[i])["frames"] = [
+                    {"time": time, "label": label, "conf": float(conf)}
+                    for time, (label, conf) in zip(times, to_verdicts(image_logits))]
+                image_logits = aggregate_windows(image_logits, args.image_aggregate)
+            if entry is not None:
+                label, conf = to_verdicts(image_logits)[0]
+                entry.update(label=label, conf=float(conf))
+            row_logits[i].append(image_logits)
+        for i, image_logits in row_logits.items():
+            label, conf = to_verdicts(aggregate_windows(np.concatenate(image_logits), args.image_aggregate))[0]
+            records[i].update(image_label=label, image_conf=float(conf))
+    return records
+
+
+def image_paths(row, args):
+    value = row.get(args.image_column)
+    if not value:
+        return []
+    paths = value if isinstance(value, list) else value.split(args.image_separator)
+    paths = [path.strip() for path in paths if path and path.strip()]
+    if args.image_root:
+        paths = [path if os.path.isabs(path) else os.path.join(args.image_root, path) for path in paths]
+    return paths
+
+
+def submit_images(pool, rows, args):
+    # One list of futures per row, empty for rows without an image
+    return [[pool.submit(load_frames, path) for path in image_paths(row, args)] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan CSV/JSONL rows of text and image paths in bulk")
+    parser.add_argument("input", help="CSV or JSONL file")
+    parser.add_argument("--output", required=True, help="JSONL file, or a directory of parquet parts")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--text-column", default="text")
+    parser.add_argument("--image-column", default="image_path")
+    parser.add_argument("--id-column", default="id")
+    parser.add_argument("--image-root", help="prefix for relative image paths")
+    parser.add_argument("--image-separator", default=DEFAULT_IMAGE_SEPARATOR,
+                        help="separates several image paths in one CSV cell")
+    parser.add_argument("--image-aggregate", choices=AGGREGATIONS, default=DEFAULT_AGGREGATION,
+                        help="how the verdicts of a row's images combine into its image verdict")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--long-text", choices=AGGREGATIONS,
+                        help="score whole texts in sliding windows, combined this way (default: first 77 tokens only)")
+    parser.add_argument("--no-cascade", action="store_true", help="send every text to CLIP even if a cascade is trained")
+    args = parser.parse_args()
+
+    checkpoint_path = args.output.rstrip("/") + ".checkpoint.json"
+    state = load_checkpoint(checkpoint_path, args.input)
+    rows_done = state["rows_done"] if state else 0
+    if rows_done:
+        print(f"Resuming after {rows_done} rows", file=sys.stderr)
+
+    # Whole chunks already form batches, so skip the cross-request batcher
+    classifier, processor = load_model_and_processor(args.base_dir, max_batch_size=1, concurrent=False)
+    cascade = None if args.no_cascade else load_cascade(args.base_dir)
+    writer = (ParquetWriter if args.format == "parquet" else JsonlWriter)(args.output, state)
+
+    rows = itertools.islice(read_rows(args.input), rows_done, None)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        chunks = chunked(rows, args.chunk_size)
+        current = next(chunks, None)
+        pending = submit_images(pool, current, args) if current else None
+        start = rows_done
+        try:
+            while current is not None:
+                # Decode the next chunk while this one runs through the model
+                upcoming = next(chunks, None)
+                upcoming_futures = submit_images(pool, upcoming, args) if upcoming else None
+
+                records = scan_chunk(start, current, pending, classifier, processor, args, cascade)
+                start += len(current)
+                save_checkpoint(checkpoint_path, {
+                    "input": os.path.abspath(args.input), "rows_done": start, **writer.write(records),
+                })
+                print(f"{start} rows scanned", file=sys.stderr)
+                current, pending = upcoming, upcoming_futures
+        finally:
+            writer.close()
+    if cascade is not None:
+        stats = cascade.stats()
+        print(f"Cascade settled {stats['short_circuited']} of {stats['texts']} texts "
+              f"({stats['short_circuit_rate']:.1%}) without CLIP", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
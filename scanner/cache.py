@@ -0,0 +1,219 @@
+"""Content-addressed cache of per-modality embeddings and verdicts.
+
+Viral posts come back with the same headline and the same image bytes, so
+results are keyed by a hash of the normalized text and a hash of the raw image
+bytes, each looked up on its own: editing only the text of a post still reuses
+the cached image side, and the other way round.
+
+With the split towers the cache holds encoder embeddings, and the verdict is
+rebuilt from them with the fc head. The joint graph only yields logits, and an
+image-only row there also depends on the token length of the zeroed text, so
+its image entries are keyed by (image hash, token length).
+
+``EmbeddingCache`` is an in-memory LRU in front of a SQLite file that keeps
+entries across restarts and evicts the least recently used ones once it grows
+past ``max_bytes``. Keys carry the model fingerprint, so replacing the model
+never serves stale results.
+
+Disk lookups read through a connection per thread, outside the lock writers
+take: in WAL mode readers never wait for one another or for a write. A disk
+hit only notes its access time in memory; the times are written in one
+statement with the next ``put``, before an eviction picks its victims, or
+once ``TOUCH_BATCH`` of them are pending.
+"""
+import collections
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from scanner.model import model_fingerprint
+
+DEFAULT_MEMORY_ENTRIES = 4096
+DEFAULT_MAX_MB = 512
+TOUCH_BATCH = 1024
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    # Mirrors the CLIP tokenizer's normalizer (NFC, collapsed whitespace,
+    # lowercase), so texts that share a key always tokenize the same way
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip().lower()
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def image_key(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class EmbeddingCache:
+    """Two-level LRU of float32 vectors keyed by ``(kind, content key)``.
+
+    ``kind`` is ``"text"`` or ``"image"`` and only splits the hit/miss counters.
+    With ``path=None`` the cache lives in memory only.
+    """
+
+    def __init__(self, path=None, namespace="", memory_entries=DEFAULT_MEMORY_ENTRIES, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.namespace = namespace
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._db = None
+        self._disk_bytes = 0
+        # Access times of disk hits not written yet, by key
+        self._touched = {}
+        self._readers = threading.local()
+        self._reader_dbs = []
+        self.path = path
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = _connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._db.commit()
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _full_key(self, kind, key):
+        return f"{self.namespace}:{kind}:{key}"
+
+    def _remember(self, full_key, value):
+        self._memory[full_key] = value
+        self._memory.move_to_end(full_key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _reader(self):
+        db = getattr(self._readers, "db", None)
+        if db is None:
+            db = self._readers.db = _connect(self.path)
+            with self._lock:
+                self._reader_dbs.append(db)
+        return db
+
+    def _write_touched(self):
+        # Called with the lock held
+        if self._touched:
+            self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                 [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+
+    def get(self, kind, key):
+        full_key = self._full_key(kind, key)
+        with self._lock:
+            value = self._memory.get(full_key)
+            if value is not None:
+                self._memory.move_to_end(full_key)
+                self._counters[f"{kind}_memory_hits"] += 1
+                return value
+            if self._db is None:
+                self._counters[f"{kind}_misses"] += 1
+                return None
+        try:
+            row = self._reader().execute("SELECT value FROM entries WHERE key = ?", (full_key,)).fetchone()
+        except sqlite3.ProgrammingError:
+            # Closed under us
+            row = None
+        with self._lock:
+            if row is None:
+                self._counters[f"{kind}_misses"] += 1
+                return None
+            value = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(full_key, value)
+            self._counters[f"{kind}_disk_hits"] += 1
+            self._touched[full_key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH and self._db is not None:
+                self._write_touched()
+                self._db.commit()
+            return value
+
+    def put(self, kind, key, value):
+        full_key = self._full_key(kind, key)
+        value = np.ascontiguousarray(value, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._remember(full_key, value)
+            if self._db is None:
+                return
+            blob = value.tobytes()
+            self._touched.pop(full_key, None)
+            self._write_touched()
+            previous = self._db.execute("SELECT size FROM entries WHERE key = ?", (full_key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                             (full_key, blob, len(blob), time.time()))
+            self._disk_bytes += len(blob) - (previous[0] if previous else 0)
+            if self._disk_bytes > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Trim to 90% so eviction does not run again on the very next insert
+        target = self.max_bytes * 0.9
+        self._write_touched()
+        while self._disk_bytes > target:
+            rows = self._db.execute("SELECT key, size FROM entries ORDER BY last_used LIMIT 256").fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self._disk_bytes <= target:
+                    break
+                evicted.append((key,))
+                self._disk_bytes -= size
+            self._db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+            self._counters["evictions"] += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        for kind in ("text", "image"):
+            hits = stats.get(f"{kind}_memory_hits", 0) + stats.get(f"{kind}_disk_hits", 0)
+            lookups = hits + stats.get(f"{kind}_misses", 0)
+            stats[f"{kind}_hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._write_touched()
+                self._db.commit()
+                self._db.close()
+                self._db = None
+            for db in self._reader_dbs:
+                db.close()
+            self._reader_dbs = []
+
+
+def open_cache(base_dir, path=None, max_mb=None):
+    """Open the on-disk cache configured by ``SCANNER_CACHE_PATH`` / ``SCANNER_CACHE_MAX_MB``.
+
+    Returns ``None`` when the size limit is 0, which turns caching off.
+    """
+    if max_mb is None:
+        max_mb = float(os.environ.get("SCANNER_CACHE_MAX_MB", DEFAULT_MAX_MB))
+    if max_mb <= 0:
+        return None
+    if path is None:
+        path = os.environ.get("SCANNER_CACHE_PATH") or os.path.join(base_dir, ".cache", "scanner.sqlite")
+    namespace = model_fingerprint(os.path.join(base_dir, "clip_model"))
+    return EmbeddingCache(path, namespace=namespace, max_bytes=int(max_mb * 1024 * 1024))
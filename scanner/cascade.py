@@ -0,0 +1,300 @@
+"""A cheap first-stage text model that settles obvious posts before CLIP.
+
+    python -m scanner.cascade --data dataset.csv --base-dir .
+
+A logistic regression over hashed word unigrams, bigrams and character
+trigrams scores a 200-word text in about 2 ms on one core, against tens of
+milliseconds for a CLIP forward pass. Each language has a band
+on its probability of Real: below ``low`` the text is Fake, above ``high`` it
+is Real, and only scores inside the band go on to the CLIP session.
+
+Training uses the train split of the dataset (split like the training
+notebook, see ``scanner.quantize``). The bands are then tuned on the
+validation split: per language, the widest short-circuit whose combined
+accuracy is no lower than CLIP's text-only accuracy (less ``--tolerance``).
+The test split is reported in ``cascade_report.json``, and the model is saved
+as ``clip_model/cascade.npz``, which ``load_cascade`` picks up
+(``SCANNER_CASCADE=0`` turns it off).
+"""
+import argparse
+import json
+import os
+import re
+import string
+import sys
+import threading
+import zlib
+
+import numpy as np
+
+from scanner.model import softmax
+
+CASCADE_FILE = "cascade.npz"
+REPORT_FILE = "cascade_report.json"
+DEFAULT_FEATURES = 2 ** 18
+LANGUAGES = ("bn", "en")
+# Share of letters in the Bengali block from which a text counts as Bangla
+BANGLA_SHARE = 0.3
+# Band edges that never match: nothing is short-circuited
+NEVER = (-1.0, 2.0)
+MAX_CANDIDATES = 512
+
+_NOISE = re.compile(r"\S+@\S+\.\S+|https?://\S+|www\.\S+|[#@]\w+")
+_PUNCTUATION = str.maketrans({char: " " for char in string.punctuation + "“”‘’।॥"})
+# \d also matches Bengali digits
+_DIGITS = re.compile(r"\d+")
+
+
+def normalize(text):
+    """Words of ``text`` cleaned like the text-cleaning notebook does, minus lemmatization."""
+    text = _NOISE.sub(" ", text.lower()).translate(_PUNCTUATION)
+    return _DIGITS.sub(" ", text).split()
+
+
+def language(text):
+    letters = [char for char in text if char.isalpha()]
+    bangla = sum("\u0980" <= char <= "\u09ff" for char in letters)
+    return "bn" if letters and bangla / len(letters) >= BANGLA_SHARE else "en"
+
+
+def hashed_features(text, n_features=DEFAULT_FEATURES):
+    """Column indices and values of one text's unit-length, signed hashed n-gram vector."""
+    words = normalize(text)
+    grams = ["w" + word for word in words]
+    grams += ["b" + first + " " + second for first, second in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        grams += ["c" + padded[i:i + 3] for i in range(len(padded) - 2)]
+    hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams))
+    # The top bit picks the sign, so colliding n-grams tend to cancel out
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+    columns, inverse = np.unique((hashes & (n_features - 1)).astype(np.int64), return_inverse=True)
+    counts = np.bincount(inverse, weights=signs, minlength=len(columns))
+    values = np.sign(counts) * np.log1p(np.abs(counts))
+    norm = np.linalg.norm(values)
+    return columns, (values / norm if norm else values).astype(np.float32)
+
+
+def featurize(texts, n_features=DEFAULT_FEATURES):
+    """CSR rows ``(indptr, indices, values)`` for ``texts``."""
+    rows = [hashed_features(text, n_features) for text in texts]
+    indptr = np.cumsum([0] + [len(columns) for columns, _ in rows])
+    if not rows:
+        return indptr, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    return indptr, np.concatenate([columns for columns, _ in rows]), np.concatenate([values for _, values in rows])
+
+
+def _row_ids(indptr):
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+
+def train_logistic(features, labels, n_features=DEFAULT_FEATURES, iterations=300, learning_rate=0.05, l2=1e-5):
+    """Full-batch Adam on the L2-regularized log loss; returns ``(weights, bias)``."""
+    indptr, indices, values = features
+    rows = _row_ids(indptr)
+    labels = np.asarray(labels, dtype=np.float64)
+    count = len(labels)
+    params = np.zeros(n_features + 1)
+    first = np.zeros_like(params)
+    second = np.zeros_like(params)
+    for step in range(1, iterations + 1):
+        margins = np.bincount(rows, weights=values * params[indices], minlength=count) + params[-1]
+        errors = 1.0 / (1.0 + np.exp(-margins)) - labels
+        grad = np.empty_like(params)
+        grad[:-1] = np.bincount(indices, weights=values * errors[rows], minlength=n_features) / count + l2 * params[:-1]
+        grad[-1] = errors.mean()
+        first = 0.9 * first + 0.1 * grad
+        second = 0.999 * second + 0.001 * grad ** 2
+        params -= learning_rate * (first / (1 - 0.9 ** step)) / (np.sqrt(second / (1 - 0.999 ** step)) + 1e-8)
+    return params[:-1].astype(np.float32), float(params[-1])
+
+
+class TextCascade:
+    """Hashed n-gram logistic regression plus a per-language band of scores left to CLIP."""
+
+    def __init__(self, weights, bias, bands):
+        self.weights = weights
+        self.bias = bias
+        self.bands = bands
+        self._lock = threading.Lock()
+        self._counts = {lang: [0, 0] for lang in LANGUAGES}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            bands = {lang: tuple(float(edge) for edge in data[f"band_{lang}"]) for lang in LANGUAGES}
+            return cls(data["weights"], float(data["bias"]), bands)
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=np.float32(self.bias),
+                 **{f"band_{lang}": np.array(self.bands.get(lang, NEVER), dtype=np.float64) for lang in LANGUAGES})
+
+    def probabilities(self, texts):
+        """Probability of Real for each text."""
+        indptr, indices, values = featurize(texts, len(self.weights))
+        margins = np.bincount(_row_ids(indptr), weights=values * self.weights[indices], minlength=len(texts))
+        return 1.0 / (1.0 + np.exp(-(margins + self.bias)))
+
+    def route(self, texts):
+        """``(logits, settled)``: first-stage logits of every text, and which of them need no CLIP run."""
+        probs = self.probabilities(texts)
+        langs = [language(text) for text in texts]
+        low, high = np.array([self.bands.get(lang, NEVER) for lang in langs]).reshape(-1, 2).T
+        settled = (probs < low) | (probs > high)
+        with self._lock:
+            for lang, done in zip(langs, settled):
+                self._counts[lang][0] += 1
+                self._counts[lang][1] += int(done)
+        # Shaped like CLIP's text logits, so a settled text's verdict goes through to_verdicts unchanged
+        logits = np.log(np.maximum(np.stack([1 - probs, probs], axis=1), 1e-12)).astype(np.float32)
+        return logits, settled
+
+    def stats(self):
+        with self._lock:
+            counts = {lang: tuple(count) for lang, count in self._counts.items()}
+        total = sum(seen for seen, _ in counts.values())
+        settled = sum(done for _, done in counts.values())
+        return {
+            "texts": total,
+            "short_circuited": settled,
+            "short_circuit_rate": settled / total if total else 0.0,
+            "by_language": {lang: {"texts": seen, "short_circuited": done} for lang, (seen, done) in counts.items()},
+        }
+
+
+def load_cascade(base_dir):
+    """The trained cascade under ``clip_model/``, or ``None`` when there is none or
+    ``SCANNER_CASCADE=0``."""
+    path = os.path.join(base_dir, "clip_model", CASCADE_FILE)
+    if os.environ.get("SCANNER_CASCADE") == "0" or not os.path.exists(path):
+        return None
+    return TextCascade.load(path)
+
+
+def _boundaries(sorted_probs, below_half):
+    # Cut positions between distinct scores on one side of 0.5, at most MAX_CANDIDATES of them
+    side = sorted_probs < 0.5 if below_half else sorted_probs > 0.5
+    cuts = np.flatnonzero(np.diff(sorted_probs) > 0) + 1
+    cuts = cuts[side[cuts - 1]] if below_half else cuts[side[cuts]]
+    if len(cuts) > MAX_CANDIDATES:
+        cuts = cuts[np.linspace(0, len(cuts) - 1, MAX_CANDIDATES).astype(int)]
+    return cuts
+
+
+def tune_band(probs, labels, clip_preds, tolerance=0.0):
+    """``(low, high)`` settling the most texts while the combined accuracy stays within
+    ``tolerance`` of ``clip_preds``' accuracy."""
+    if len(probs) == 0:
+        return NEVER
+    order = np.argsort(probs, kind="stable")
+    probs, labels, clip_correct = probs[order], labels[order], (clip_preds == labels)[order]
+    count = len(probs)
+    # Correct verdicts among the lowest a rows if settled as Fake, the highest b if
+    # settled as Real, and CLIP's correct verdicts over any prefix
+    fake_prefix = np.concatenate([[0], np.cumsum(labels == 0)])
+    real_suffix = np.concatenate([[0], np.cumsum((labels == 1)[::-1])])
+    clip_prefix = np.concatenate([[0], np.cumsum(clip_correct)])
+
+    lows = np.concatenate([[0], _boundaries(probs, True)])
+    highs = np.concatenate([[0], count - _boundaries(probs, False)])
+    a, b = lows[:, None], highs[None, :]
+    correct = fake_prefix[a] + (clip_prefix[count - b] - clip_prefix[a]) + real_suffix[b]
+    settled = np.where(correct >= clip_prefix[-1] - tolerance * count, a + b, -1)
+    i, j = np.unravel_index(np.argmax(settled), settled.shape)
+    a, b = lows[i], highs[j]
+    low = (probs[a - 1] + probs[a]) / 2 if a else NEVER[0]
+    high = (probs[count - b - 1] + probs[count - b]) / 2 if b else NEVER[1]
+    return float(low), float(high)
+
+
+def evaluate(cascade, texts, labels, clip_preds):
+    """Per language and overall: rows, CLIP and cascade accuracy, share short-circuited."""
+    logits, settled = cascade.route(texts)
+    preds = np.where(settled, logits.argmax(axis=1), clip_preds)
+    langs = np.array([language(text) for text in texts])
+    report = {}
+    for lang in LANGUAGES + ("all",):
+        rows = langs == lang if lang != "all" else np.ones(len(texts), dtype=bool)
+        if not rows.any():
+            continue
+        report[lang] = {
+            "rows": int(rows.sum()),
+            "clip_accuracy": float((clip_preds[rows] == labels[rows]).mean()),
+            "cascade_accuracy": float((preds[rows] == labels[rows]).mean()),
+            "short_circuit_rate": float(settled[rows].mean()),
+        }
+    return report
+
+
+def clip_text_predictions(texts, classifier, processor, batch_size=32):
+    from scanner.pipeline import encode_texts
+
+    preds = []
+    for start in range(0, len(texts), batch_size):
+        input_ids, attention_mask = encode_texts(texts[start:start + batch_size], processor)
+        preds.append(softmax(classifier.text_logits(input_ids, attention_mask)).argmax(axis=1))
+    return np.concatenate(preds) if preds else np.empty(0, dtype=np.int64)
+
+
+def main():
+    from scanner.pipeline import load_model_and_processor
+    from scanner.quantize import notebook_split, read_dataset
+
+    parser = argparse.ArgumentParser(description="Train the first-stage text model and tune its bands against CLIP")
+    parser.add_argument("--data", required=True, help="training dataframe as CSV with text and label columns")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/; the cascade is saved there")
+    parser.add_argument("--features", type=int, default=DEFAULT_FEATURES, help="hash space size (a power of two)")
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--l2", type=float, default=1e-5)
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="accuracy below CLIP-only allowed on the validation split, per language")
+    parser.add_argument("--seed", type=int, default=42, help="split seed of the training notebook")
+    args = parser.parse_args()
+    if args.features & (args.features - 1):
+        raise SystemExit("--features must be a power of two")
+
+    rows = read_dataset(args.data)
+    train, val, test = notebook_split(len(rows), args.seed)
+    texts = [row["text"] for row in rows]
+    labels = np.array([row["label"] for row in rows])
+
+    print(f"Training on {len(train)} texts", file=sys.stderr)
+    weights, bias = train_logistic(featurize([texts[i] for i in train], args.features), labels[train],
+                                   args.features, args.iterations, l2=args.l2)
+    cascade = TextCascade(weights, bias, {})
+
+    classifier, processor = load_model_and_processor(args.base_dir, max_batch_size=1, concurrent=False)
+    print(f"CLIP text verdicts for {len(val) + len(test)} texts", file=sys.stderr)
+    val_texts, test_texts = [texts[i] for i in val], [texts[i] for i in test]
+    val_clip = clip_text_predictions(val_texts, classifier, processor)
+    test_clip = clip_text_predictions(test_texts, classifier, processor)
+
+    val_probs = cascade.probabilities(val_texts)
+    val_langs = np.array([language(text) for text in val_texts])
+    for lang in LANGUAGES:
+        rows_lang = val_langs == lang
+        cascade.bands[lang] = tune_band(val_probs[rows_lang], labels[val][rows_lang], val_clip[rows_lang], args.tolerance)
+
+    report = {
+        "bands": cascade.bands,
+        "validation": evaluate(cascade, val_texts, labels[val], val_clip),
+        "test": evaluate(cascade, test_texts, labels[test], test_clip),
+    }
+    model_dir = os.path.join(args.base_dir, "clip_model")
+    cascade.save(os.path.join(model_dir, CASCADE_FILE))
+    with open(os.path.join(model_dir, REPORT_FILE), "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'split':10} {'lang':4} {'rows':>6} {'CLIP acc':>9} {'cascade acc':>12} {'short-circuited':>16}")
+    for split in ("validation", "test"):
+        for lang, row in report[split].items():
+            print(f"{split:10} {lang:4} {row['rows']:6d} {row['clip_accuracy']:9.4f} {row['cascade_accuracy']:12.4f} "
+                  f"{row['short_circuit_rate']:16.1%}")
+    for lang, (low, high) in cascade.bands.items():
+        print(f"{lang}: Fake below {low:.3f}, Real above {high:.3f}")
+    print(f"Cascade written to {os.path.join(model_dir, CASCADE_FILE)}")
+
+
+if __name__ == "__main__":
+    main()
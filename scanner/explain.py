@@ -0,0 +1,222 @@
+"""Occlusion attributions: which words and image regions drove a verdict.
+
+    python -m scanner.explain --text "..." --image photo.jpg --heatmap heatmap.png
+
+Every occluded variant of a post is built up front and run through the
+classifier in a few large batches, instead of one scan per variant:
+
+* text - one copy of the post per token between the start and end tokens,
+  with that token's ``attention_mask`` set to 0 so nothing attends to it.
+  The ids are left alone (the pad token is the end token the text is pooled
+  at), and every copy keeps the text's last token, so they all share one
+  length bucket. Only the first ``MAX_TEXT_LENGTH`` tokens are covered.
+* image - one copy per cell of a ``grid`` x ``grid`` split of the 224x224
+  crop (7x7 by default, ViT-B/32's patch grid) with that cell set to 0 in
+  ``pixel_values``, which is the dataset's mean color.
+
+A token's or cell's importance is how much the probability of the verdict's
+label drops when it is hidden: positive where it argues for the verdict,
+negative where it argues against it. The text and image verdicts are
+explained by their own input, and with both inputs the joint verdict by
+each token and each cell. With the split towers the joint attributions come
+from the same occluded embeddings through the head; the full graph runs
+them as batches of their own.
+"""
+import argparse
+import os
+import unicodedata
+
+import numpy as np
+from PIL import Image
+
+from scanner.metrics import metrics
+from scanner.model import IMAGE_SIZE, LABELS, run_batches, softmax
+from scanner.preprocess import open_image, preprocess_images, resize_and_crop
+
+DEFAULT_GRID = 7
+DEFAULT_BATCH_SIZE = 64
+MAX_GRID = 28
+
+
+def token_variants(input_ids, attention_mask):
+    """Positions of the content tokens of one encoded text, and one
+    ``(input_ids, attention_mask)`` row per position with that token masked out."""
+    positions = np.flatnonzero(attention_mask[0])[1:-1]
+    ids = np.repeat(input_ids, len(positions), axis=0)
+    mask = np.repeat(attention_mask, len(positions), axis=0)
+    mask[np.arange(len(positions)), positions] = 0
+    return positions, ids, mask
+
+
+def cell_edges(grid, size=IMAGE_SIZE):
+    return np.linspace(0, size, grid + 1).round().astype(int)
+
+
+def cell_variants(pixel_values, grid=DEFAULT_GRID):
+    """``grid * grid`` copies of ``(1, 3, H, W)`` pixel values, row by row, each
+    with one cell set to 0."""
+    edges = cell_edges(grid, pixel_values.shape[-1])
+    variants = np.repeat(pixel_values, grid * grid, axis=0)
+    for row in range(grid):
+        for col in range(grid):
+            variants[row * grid + col, :, edges[row]:edges[row + 1], edges[col]:edges[col + 1]] = 0
+    return variants
+
+
+def _tower_logits(classifier, input_ids, attention_mask, pixel_values, tokens, cells, batch_size):
+    base, by_token, by_cell = {}, {}, {}
+    seq_len = int(attention_mask.sum())
+    if tokens is not None:
+        text_embeds = classifier.text_embeds(input_ids, attention_mask)
+        token_embeds = run_batches(classifier.text_embeds, tokens, batch_size)
+        base["text"] = classifier.text_logits_from_embeds(text_embeds)
+        by_token["text"] = classifier.text_logits_from_embeds(token_embeds)
+    if cells is not None:
+        image_embeds = classifier.image_embeds(pixel_values)
+        cell_embeds = run_batches(classifier.image_embeds, (cells,), batch_size)
+        base["image"] = classifier.image_logits_from_embeds(image_embeds, seq_len)
+        by_cell["image"] = classifier.image_logits_from_embeds(cell_embeds, seq_len)
+    if tokens is not None and cells is not None:
+        token_ids, token_mask = tokens
+        base["joint"] = classifier.joint_logits_from_embeds(image_embeds, text_embeds, input_ids, attention_mask)
+        by_token["joint"] = classifier.joint_logits_from_embeds(
+            np.repeat(image_embeds, len(token_ids), axis=0), token_embeds, token_ids, token_mask)
+        by_cell["joint"] = classifier.joint_logits_from_embeds(
+            cell_embeds, np.repeat(text_embeds, len(cells), axis=0),
+            np.repeat(input_ids, len(cells), axis=0), np.repeat(attention_mask, len(cells), axis=0))
+    return base, by_token, by_cell
+
+
+def _graph_logits(classifier, input_ids, attention_mask, pixel_values, tokens, cells, batch_size):
+    base, by_token, by_cell = {}, {}, {}
+    seq_len = int(attention_mask.sum())
+    if tokens is not None:
+        base["text"] = classifier.text_logits(input_ids, attention_mask)
+        by_token["text"] = run_batches(classifier.text_logits, tokens, batch_size)
+    if cells is not None:
+        base["image"] = classifier.image_logits(pixel_values, seq_len)
+        by_cell["image"] = run_batches(lambda pixels: classifier.image_logits(pixels, seq_len), (cells,), batch_size)
+    if tokens is not None and cells is not None:
+        token_ids, token_mask = tokens
+        base["joint"] = classifier.joint_logits(input_ids, attention_mask, pixel_values)
+        by_token["joint"] = run_batches(
+            classifier.joint_logits, (token_ids, token_mask, np.repeat(pixel_values, len(token_ids), axis=0)), batch_size)
+        by_cell["joint"] = run_batches(
+            classifier.joint_logits, (np.repeat(input_ids, len(cells), axis=0),
+                                      np.repeat(attention_mask, len(cells), axis=0), cells), batch_size)
+    return base, by_token, by_cell
+
+
+def _drops(base_logits, variant_logits):
+    # Drop in the probability of the base verdict's label, one per variant
+    base = softmax(base_logits)[0]
+    label = int(base.argmax())
+    return base[label] - softmax(variant_logits)[:, label]
+
+
+def _token_entries(text, positions, spans, importances):
+    # A Bangla letter is several byte-level tokens over the same characters; they are one entry
+    entries = []
+    for i, position in enumerate(positions):
+        start, end = spans[position]
+        if entries and (entries[-1]["start"], entries[-1]["end"]) == (start, end):
+            for view, values in importances.items():
+                entries[-1]["importance"][view] += float(values[i])
+            continue
+        entries.append({"token": text[start:end], "start": start, "end": end,
+                        "importance": {view: float(values[i]) for view, values in importances.items()}})
+    return entries
+
+
+def explain(text, image, classifier, processor, grid=DEFAULT_GRID, batch_size=DEFAULT_BATCH_SIZE):
+    """Occlusion attributions for a post; ``text`` or ``image`` (an RGB image) may be None.
+
+    Returns ``{"verdicts": {view: {"label", "conf"}}, "tokens": [...],
+    "heatmaps": {view: grid x grid lists}}``. Each token entry has its
+    ``token`` text, its ``start``/``end`` character offsets into the
+    NFC-normalized text and its ``importance`` by view; the heatmaps are row
+    by row over the 224x224 crop, for the ``image`` and ``joint`` views.
+    """
+    if not 1 <= grid <= MAX_GRID:
+        raise ValueError(f"grid must be between 1 and {MAX_GRID}")
+    text = text if text and text.strip() else None
+    if text is None and image is None:
+        raise ValueError("Send news text, an image or both.")
+    with metrics.stage("tokenize"):
+        input_ids, attention_mask = processor([text or ""])
+    tokens = positions = None
+    if text is not None:
+        positions, token_ids, token_mask = token_variants(input_ids, attention_mask)
+        tokens = (token_ids, token_mask)
+    pixel_values = cells = None
+    if image is not None:
+        with metrics.stage("preprocess"):
+            pixel_values = preprocess_images([image])
+            cells = cell_variants(pixel_values, grid)
+
+    logits = _tower_logits if classifier.has_embeddings else _graph_logits
+    with metrics.stage("inference", modality="explain"):
+        base, by_token, by_cell = logits(classifier, input_ids, attention_mask, pixel_values, tokens, cells, batch_size)
+
+    verdicts = {}
+    for view, view_logits in base.items():
+        probs = softmax(view_logits)[0]
+        verdicts[view] = {"label": LABELS[int(probs.argmax())], "conf": float(probs.max())}
+    result = {"verdicts": verdicts, "tokens": [], "heatmaps": {}}
+    if text is not None:
+        text = unicodedata.normalize("NFC", text)
+        importances = {view: _drops(base[view], variant_logits) for view, variant_logits in by_token.items()}
+        result["tokens"] = _token_entries(text, positions, processor.spans(text), importances)
+    for view, variant_logits in by_cell.items():
+        result["heatmaps"][view] = _drops(base[view], variant_logits).reshape(grid, grid).tolist()
+    return result
+
+
+def heatmap_overlay(image, heatmap, alpha=0.6):
+    """The 224x224 crop the model saw with ``heatmap`` laid over it: red where
+    a cell argues for the verdict, blue where it argues against it, stronger
+    for larger importances."""
+    crop = Image.fromarray(resize_and_crop(image))
+    heat = np.asarray(heatmap, dtype=np.float32)
+    heat = heat / (np.abs(heat).max() or 1.0)
+    colors = np.zeros(heat.shape + (3,), dtype=np.uint8)
+    colors[..., 0] = (heat > 0) * 255
+    colors[..., 2] = (heat < 0) * 255
+    overlay = Image.fromarray(colors).resize(crop.size, Image.NEAREST)
+    strength = Image.fromarray((np.abs(heat) * 255 * alpha).astype(np.uint8)).resize(crop.size, Image.BILINEAR)
+    return Image.composite(overlay, crop, strength)
+
+
+def main():
+    from scanner.pipeline import load_model_and_processor
+
+    parser = argparse.ArgumentParser(description="Which words and image regions drove a verdict")
+    parser.add_argument("--text", help="news text")
+    parser.add_argument("--image", help="image file")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--grid", type=int, default=DEFAULT_GRID, help="image cells per side")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--top", type=int, default=10, help="tokens to print per view")
+    parser.add_argument("--heatmap", help="where to save the heatmap over the image, as PNG")
+    args = parser.parse_args()
+    if not args.text and not args.image:
+        parser.error("pass --text, --image or both")
+
+    classifier, processor = load_model_and_processor(args.base_dir, max_batch_size=1, concurrent=False)
+    image = open_image(args.image) if args.image else None
+    result = explain(args.text, image, classifier, processor, args.grid, args.batch_size)
+    for view, verdict in result["verdicts"].items():
+        print(f"{view}: {verdict['label']} ({verdict['conf']:.2%})")
+        ranked = sorted((token for token in result["tokens"] if view in token["importance"]),
+                        key=lambda token: -abs(token["importance"][view]))
+        for token in ranked[:args.top]:
+            print(f"  {token['importance'][view]:+.4f}  {token['token']!r}")
+    if args.heatmap and result["heatmaps"]:
+        view = "joint" if "joint" in result["heatmaps"] else "image"
+        heatmap_overlay(image, result["heatmaps"][view]).save(args.heatmap)
+        print(f"{view} heatmap saved to {args.heatmap}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Export the trained CLIPClassifier as separate text and image towers.
+
+    python -m scanner.export_towers --weights trained_model.pth --out-dir clip_model
+
+Writes ``text_tower.onnx``, ``image_tower.onnx`` (dynamically quantized like
+``train_quantized.onnx``) and ``head.npz`` with the fc weights and the
+embeddings of the zeroed inputs the app feeds for single-modality scans. When
+the original ``train_quantized.onnx`` sits in the output directory the towers
+are checked against it before the script exits.
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from transformers import CLIPModel
+
+from scanner.model import (
+    EMBED_DIM, FULL_MODEL_FILE, HEAD_FILE, IMAGE_SIZE, IMAGE_TOWER_FILE, MAX_TEXT_LENGTH,
+    TEXT_TOWER_FILE, FullGraphClassifier, TowerClassifier, create_session, softmax,
+    zero_embeddings, zero_pixel_values,
+)
+
+
+class CLIPClassifier(nn.Module):
+    def __init__(self, clip_model, num_classes=2):
+        super().__init__()
+        self.clip = clip_model
+        self.fc = nn.Linear(512 + 512, num_classes)
+
+    def forward(self, input_ids, pixel_values, attention_mask):
+        outputs = self.clip(input_ids=input_ids, pixel_values=pixel_values, attention_mask=attention_mask)
+        combined = torch.cat([outputs.image_embeds, outputs.text_embeds], dim=1)
+        return self.fc(combined)
+
+
+class TextTower(nn.Module):
+    # Same computation as CLIPModel.forward's text_embeds, without the vision side
+    def __init__(self, clip_model):
+        super().__init__()
+        self.clip = clip_model
+
+    def forward(self, input_ids, attention_mask):
+        pooled = self.clip.text_model(input_ids=input_ids, attention_mask=attention_mask)[1]
+        embeds = self.clip.text_projection(pooled)
+        return embeds / embeds.norm(p=2, dim=-1, keepdim=True)
+
+
+class ImageTower(nn.Module):
+    def __init__(self, clip_model):
+        super().__init__()
+        self.clip = clip_model
+
+    def forward(self, pixel_values):
+        pooled = self.clip.vision_model(pixel_values=pixel_values)[1]
+        embeds = self.clip.visual_projection(pooled)
+        return embeds / embeds.norm(p=2, dim=-1, keepdim=True)
+
+
+def load_model(weights, base_model):
+    model = CLIPClassifier(CLIPModel.from_pretrained(base_model), num_classes=2)
+    model.load_state_dict(torch.load(weights, map_location="cpu"))
+    model.eval()
+    return model
+
+
+def export_onnx(module, args, path, input_names, output_name, dynamic_axes):
+    torch.onnx.export(
+        module,
+        args,
+        path,
+        export_params=True,
+        opset_version=14,
+        do_constant_folding=True,
+        input_names=input_names,
+        output_names=[output_name],
+        dynamic_axes=dynamic_axes,
+    )
+
+
+def calibrate_image_only_bias(out_dir, zero_image, weight):
+    # A fully masked text row depends on the attention implementation the joint
+    # graph was traced with, so read the zero-text contribution of every token
+    # length straight from train_quantized.onnx rather than trusting the tower.
+    # The joint logits already include the fc bias; only the image half is removed
+    session = create_session(os.path.join(out_dir, FULL_MODEL_FILE))
+    image_part = zero_image @ weight[:, :EMBED_DIM].T
+    rows = []
+    for length in range(1, MAX_TEXT_LENGTH + 1):
+        zeros = np.zeros((1, length), dtype=np.int64)
+        logits = session.run(["logits"], {
+            "input_ids": zeros, "attention_mask": zeros, "pixel_values": zero_pixel_values(1),
+        })[0][0]
+        rows.append(logits - image_part)
+    return np.stack(rows).astype(np.float32)
+
+
+def export_towers(model, out_dir, quantize=True):
+    os.makedirs(out_dir, exist_ok=True)
+    text_tower = TextTower(model.clip).eval()
+    image_tower = ImageTower(model.clip).eval()
+
+    targets = [
+        (text_tower, (torch.zeros(1, MAX_TEXT_LENGTH, dtype=torch.long), torch.ones(1, MAX_TEXT_LENGTH, dtype=torch.long)),
+         TEXT_TOWER_FILE, ["input_ids", "attention_mask"], "text_embeds",
+         {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "text_embeds": {0: "batch"}}),
+        (image_tower, (torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE),),
+         IMAGE_TOWER_FILE, ["pixel_values"], "image_embeds",
+         {"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}}),
+    ]
+    for module, args, name, input_names, output_name, dynamic_axes in targets:
+        path = os.path.join(out_dir, name)
+        if not quantize:
+            export_onnx(module, args, path, input_names, output_name, dynamic_axes)
+            continue
+        fp32_path = path.replace(".onnx", "_fp32.onnx")
+        export_onnx(module, args, fp32_path, input_names, output_name, dynamic_axes)
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QUInt8)
+        os.remove(fp32_path)
+
+    zero_text, zero_image = zero_embeddings(out_dir)
+    head = {
+        "weight": model.fc.weight.detach().numpy().astype(np.float32),
+        "bias": model.fc.bias.detach().numpy().astype(np.float32),
+        "zero_text_embeds": zero_text,
+        "zero_image_embeds": zero_image,
+    }
+    if os.path.exists(os.path.join(out_dir, FULL_MODEL_FILE)):
+        head["image_only_bias"] = calibrate_image_only_bias(out_dir, zero_image, head["weight"])
+    np.savez(os.path.join(out_dir, HEAD_FILE), **head)
+
+
+def check_against_full_graph(out_dir, samples=8, seed=0):
+    """Compare tower verdicts with train_quantized.onnx on random inputs."""
+    rng = np.random.default_rng(seed)
+    full = FullGraphClassifier(create_session(os.path.join(out_dir, FULL_MODEL_FILE)))
+    with np.load(os.path.join(out_dir, HEAD_FILE)) as head:
+        towers = TowerClassifier(
+            create_session(os.path.join(out_dir, TEXT_TOWER_FILE)),
+            create_session(os.path.join(out_dir, IMAGE_TOWER_FILE)),
+            dict(head),
+        )
+
+    worst = 0.0
+    agree = 0
+    for _ in range(samples):
+        length = int(rng.integers(2, MAX_TEXT_LENGTH + 1))
+        input_ids = rng.integers(1, 49407, size=(1, length)).astype(np.int64)
+        attention_mask = np.ones_like(input_ids)
+        pixel_values = rng.standard_normal((1, 3, IMAGE_SIZE, IMAGE_SIZE)).astype(np.float32)
+        pairs = [
+            (full.text_logits(input_ids, attention_mask), towers.text_logits(input_ids, attention_mask)),
+            (full.image_logits(pixel_values, length), towers.image_logits(pixel_values, length)),
+        ]
+        for expected, actual in pairs:
+            expected, actual = softmax(expected), softmax(actual)
+            worst = max(worst, float(np.abs(expected - actual).max()))
+            agree += int(expected.argmax() == actual.argmax())
+    return agree, 2 * samples, worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--weights", required=True, help="CLIPClassifier state dict (trained_model.pth)")
+    parser.add_argument("--base-model", default="openai/clip-vit-base-patch32")
+    parser.add_argument("--out-dir", default="clip_model")
+    parser.add_argument("--no-quantize", action="store_true", help="keep fp32 towers")
+    args = parser.parse_args()
+
+    model = load_model(args.weights, args.base_model)
+    export_towers(model, args.out_dir, quantize=not args.no_quantize)
+    print(f"Towers written to {args.out_dir}")
+
+    if os.path.exists(os.path.join(args.out_dir, FULL_MODEL_FILE)):
+        agree, total, worst = check_against_full_graph(args.out_dir)
+        print(f"Verdicts matching {FULL_MODEL_FILE}: {agree}/{total}, max probability diff {worst:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Move the weights of the exported graphs into external data files.
+
+    python -m scanner.external_data --model-dir clip_model
+
+Rewrites every ``*.onnx`` in the model directory in place as a small graph
+file plus ``<name>.onnx.data`` holding its initializers. onnxruntime
+memory-maps that file read-only and, with prepacking off (see
+``scanner.tuning.share_weights``), runs on the mapped weights directly, so
+replicas on one host share a single physical copy through the page cache
+instead of each holding a private one. The verdicts do not change.
+
+Re-run ``python -m scanner.tuning`` afterwards: the rewritten graphs no longer
+match the tuned profile.
+"""
+import argparse
+import glob
+import os
+
+import onnx
+from onnx.external_data_helper import convert_model_to_external_data
+
+from scanner.tuning import EXTERNAL_DATA_MIN_BYTES, EXTERNAL_DATA_SUFFIX, has_external_data
+
+
+def externalize(model_path, min_bytes=EXTERNAL_DATA_MIN_BYTES):
+    """Rewrite ``model_path`` with its initializers of ``min_bytes`` or more in ``<model_path>.data``."""
+    data_path = model_path + EXTERNAL_DATA_SUFFIX
+    model = onnx.load(model_path)
+    convert_model_to_external_data(model, all_tensors_to_one_file=True, location=os.path.basename(data_path),
+                                   size_threshold=min_bytes)
+    # onnx appends to an existing data file; the graph is swapped in last so a
+    # failure leaves the original loadable
+    tmp_path = model_path + ".tmp"
+    if os.path.exists(data_path):
+        os.remove(data_path)
+    onnx.save_model(model, tmp_path)
+    os.replace(tmp_path, model_path)
+    return os.path.getsize(model_path), os.path.getsize(data_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="clip_model")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.model_dir, "*.onnx")))
+    if not paths:
+        raise SystemExit(f"No ONNX graphs under {args.model_dir}")
+    for path in paths:
+        if has_external_data(path):
+            print(f"{os.path.basename(path)}: already external")
+            continue
+        graph_bytes, data_bytes = externalize(path)
+        print(f"{os.path.basename(path)}: graph {graph_bytes / 1e6:.1f} MB, weights {data_bytes / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
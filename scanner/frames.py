@@ -0,0 +1,163 @@
+"""Keyframes of animated GIFs and short video clips.
+
+An upload that moves - an animated GIF, PNG or WebP, or an MP4/MOV/WebM/AVI
+clip - is scanned as a few of its frames instead of one still. Frames are
+decoded one at a time and sampled at ``SCANNER_FRAME_RATE`` frames per second
+(default 1, always starting with the first frame). A sampled frame whose
+difference hash is within ``SCANNER_FRAME_DIFF`` bits (of 64) of the last
+kept frame is dropped as a near duplicate, so a static scene costs one frame.
+Only the 224x224 crops of the kept frames are held, at most
+``SCANNER_MAX_FRAMES`` of them, and reading stops there, so a long clip is
+never in memory whole. Reading also stops after ``SAMPLED_PER_KEPT`` times
+that many sampled frames (64 seconds at the defaults), so a long static clip
+is not decoded to its end for the one frame it keeps.
+
+Animated images are read with Pillow. Video needs PyAV (``pip install av``);
+without it a clip is refused with an ``OSError``, like an unreadable image,
+and the app does not offer ``VIDEO_EXTENSIONS`` for upload.
+"""
+import io
+import math
+import os
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from scanner.preprocess import max_pixels_from_env, resize_and_crop
+
+DEFAULT_FRAME_RATE = 1.0
+DEFAULT_MAX_FRAMES = 16
+DEFAULT_FRAME_DIFF = 6
+SAMPLED_PER_KEPT = 4
+HASH_SIZE = 8
+# Browsers show GIF frames of 10 ms or less for 100 ms, and so do we
+MIN_GIF_FRAME_MS = 10
+DEFAULT_GIF_FRAME_MS = 100
+ANIMATED_FORMATS = ("GIF", "PNG", "WEBP")
+# Offered for upload only when PyAV is installed
+VIDEO_EXTENSIONS = ("mp4", "mov", "webm")
+# ISO media files that are still images, not video
+HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"mif1", b"msf1", b"avif")
+
+
+def frame_settings():
+    """``(rate, max_frames, max_diff)`` from ``SCANNER_FRAME_RATE``, ``SCANNER_MAX_FRAMES``
+    and ``SCANNER_FRAME_DIFF``."""
+    return (float(os.environ.get("SCANNER_FRAME_RATE", DEFAULT_FRAME_RATE)),
+            int(os.environ.get("SCANNER_MAX_FRAMES", DEFAULT_MAX_FRAMES)),
+            int(os.environ.get("SCANNER_FRAME_DIFF", DEFAULT_FRAME_DIFF)))
+
+
+def can_decode_video():
+    try:
+        import av
+    except ImportError:
+        return False
+    return True
+
+
+def is_video(data):
+    head = bytes(data[:12])
+    if head[4:8] == b"ftyp":
+        return head[8:12] not in HEIF_BRANDS
+    return head.startswith(b"\x1a\x45\xdf\xa3") or (head.startswith(b"RIFF") and head[8:12] == b"AVI ")
+
+
+def is_animated(data):
+    """Whether upload bytes hold moving pictures: a video clip, or a GIF, PNG or WebP
+    with more than one frame. Anything unreadable is left to the still-image path."""
+    if is_video(data):
+        return True
+    if bytes(data[:4]) not in (b"GIF8", b"\x89PNG", b"RIFF"):
+        return False
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.format in ANIMATED_FORMATS and bool(getattr(image, "is_animated", False))
+    except OSError:
+        return False
+
+
+def difference_hash(pixels, size=HASH_SIZE):
+    """``size * size`` bits, packed: whether each pixel of a grayscale thumbnail
+    is brighter than its left neighbor."""
+    thumbnail = Image.fromarray(np.asarray(pixels)).convert("L").resize((size + 1, size), Image.BILINEAR)
+    thumbnail = np.asarray(thumbnail, dtype=np.int16)
+    return np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1])
+
+
+def hash_distance(a, b):
+    return int(np.unpackbits(a ^ b).sum())
+
+
+def _image_frames(data, max_pixels):
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height > max_pixels:
+            raise Image.DecompressionBombError(
+                f"{image.width}x{image.height} animation exceeds the limit of {max_pixels} pixels")
+        time = 0.0
+        # Pillow decodes one frame per seek, compositing it onto the previous one
+        for frame in ImageSequence.Iterator(image):
+            yield time, frame
+            duration = frame.info.get("duration") or 0
+            time += (duration if duration > MIN_GIF_FRAME_MS else DEFAULT_GIF_FRAME_MS) / 1000
+
+
+def _video_frames(data, max_pixels):
+    try:
+        import av
+    except ImportError:
+        raise OSError("Scanning video needs PyAV: pip install av")
+    try:
+        with av.open(io.BytesIO(data)) as container:
+            if not container.streams.video:
+                raise OSError("The clip has no video stream")
+            stream = container.streams.video[0]
+            if stream.width * stream.height > max_pixels:
+                raise Image.DecompressionBombError(
+                    f"{stream.width}x{stream.height} video exceeds the limit of {max_pixels} pixels")
+            stream.thread_type = "AUTO"
+            for frame in container.decode(stream):
+                yield frame.time or 0.0, frame
+    except av.error.FFmpegError as e:
+        raise OSError(f"Cannot decode video: {e}")
+
+
+def _sampled(frames, rate):
+    # The first frame at or after each multiple of 1 / rate seconds
+    next_time = 0.0
+    for time, frame in frames:
+        if time + 1e-6 >= next_time:
+            yield time, frame
+            next_time = (math.floor(time * rate + 1e-6) + 1) / rate
+
+
+def keyframes(data, rate=None, max_frames=None, max_diff=None, max_pixels=None):
+    """``(times, crops)`` of the kept frames of an animation or clip: their
+    timestamps in seconds and uint8 224x224 crops for ``preprocess_images``.
+
+    Settings default to ``frame_settings()``, and ``max_pixels`` to
+    ``SCANNER_MAX_IMAGE_PIXELS`` per frame.
+    """
+    settings = frame_settings()
+    rate = rate or settings[0]
+    max_frames = max_frames or settings[1]
+    max_diff = settings[2] if max_diff is None else max_diff
+    if max_pixels is None:
+        max_pixels = max_pixels_from_env()
+    frames = _video_frames(data, max_pixels) if is_video(data) else _image_frames(data, max_pixels)
+    times, crops, last_hash = [], [], None
+    for sampled, (time, frame) in enumerate(_sampled(frames, rate)):
+        if sampled >= max_frames * SAMPLED_PER_KEPT:
+            break
+        crop = resize_and_crop(frame if isinstance(frame, Image.Image) else frame.to_image())
+        frame_hash = difference_hash(crop)
+        if last_hash is not None and hash_distance(frame_hash, last_hash) <= max_diff:
+            continue
+        times.append(round(time, 3))
+        crops.append(crop)
+        last_hash = frame_hash
+        if len(crops) >= max_frames:
+            break
+    if not crops:
+        raise OSError("No frames could be decoded")
+    return times, crops
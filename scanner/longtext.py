@@ -0,0 +1,58 @@
+"""Text verdicts over whole articles instead of their first 77 tokens.
+
+``ClipTokenizer.windows`` cuts each article into overlapping full-length
+windows. The windows of every text in a call run through the classifier as one
+batch, and each text's window probabilities are combined by one of
+``AGGREGATIONS``:
+
+* ``mean`` - the average probability over the windows.
+* ``max`` - the verdict of the most confident window.
+* ``attention`` - an average weighted by ``softmax(confidence / temperature)``,
+  so confident windows count more without one of them deciding alone.
+
+A text that fits in one window gets exactly its ``predict_text_only`` verdict.
+"""
+import numpy as np
+
+from scanner.model import softmax
+from scanner.tokenizer import DEFAULT_MAX_WINDOWS, DEFAULT_WINDOW_STRIDE
+
+AGGREGATIONS = ("mean", "max", "attention")
+DEFAULT_AGGREGATION = "mean"
+DEFAULT_TEMPERATURE = 0.1
+
+
+def check_aggregation(method):
+    if method not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {method!r}; expected one of {', '.join(AGGREGATIONS)}")
+    return method
+
+
+def aggregate_windows(logits, method=DEFAULT_AGGREGATION, temperature=DEFAULT_TEMPERATURE):
+    """Combine ``(windows, 2)`` logits into ``(1, 2)`` logits for ``to_verdicts``."""
+    check_aggregation(method)
+    if len(logits) == 1:
+        return logits
+    probs = softmax(logits)
+    if method == "mean":
+        combined = probs.mean(axis=0)
+    elif method == "max":
+        combined = probs[probs.max(axis=1).argmax()]
+    else:
+        weights = softmax(probs.max(axis=1) / temperature)
+        combined = weights @ probs
+    # Log-probabilities are valid logits: softmax gives the probabilities back
+    return np.log(np.maximum(combined, 1e-12))[None].astype(np.float32)
+
+
+def long_text_logits(texts, classifier, processor, method=DEFAULT_AGGREGATION, stride=DEFAULT_WINDOW_STRIDE,
+                     max_windows=DEFAULT_MAX_WINDOWS, temperature=DEFAULT_TEMPERATURE):
+    """One row of aggregated logits per text, from a single classifier call over all windows."""
+    check_aggregation(method)
+    windows = [processor.windows(text, stride, max_windows) for text in texts]
+    input_ids = np.concatenate([ids for ids, _ in windows])
+    attention_mask = np.concatenate([mask for _, mask in windows])
+    logits = classifier.text_logits(input_ids, attention_mask)
+    bounds = np.cumsum([0] + [len(ids) for ids, _ in windows])
+    return np.concatenate([aggregate_windows(logits[start:end], method, temperature)
+                           for start, end in zip(bounds[:-1], bounds[1:])])
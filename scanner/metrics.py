@@ -0,0 +1,278 @@
+"""Per-stage latency metrics for the scan hot path.
+
+    with metrics.stage("decode"):
+        image = decode_image(image_bytes)
+
+Every stage (with its labels) keeps a cumulative Prometheus histogram plus a
+rolling window of its latest timings for percentiles. ``render_prometheus``
+gives the text exposition format, served at ``/metrics`` by
+``scanner.service`` and, for the Streamlit app, by ``start_metrics_server`` on
+``SCANNER_METRICS_PORT``. A stage costs two ``perf_counter`` calls and a lock;
+``SCANNER_METRICS=0`` turns timing off altogether.
+
+``SCANNER_ORT_PROFILE_RATE`` (0 to 1) sends that fraction of ``session.run``
+calls through a second session with onnxruntime's profiler on. Its trace is
+written to ``SCANNER_ORT_PROFILE_DIR`` every ``SCANNER_ORT_PROFILE_RUNS``
+profiled runs and at exit.
+"""
+import atexit
+import bisect
+import collections
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Seconds; spans a cached lookup up to a cold full-size scan
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_WINDOW = 1024
+DEFAULT_PROFILE_RUNS = 20
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Cumulative bucket counts for Prometheus plus the last ``window`` samples."""
+
+    def __init__(self, buckets=BUCKETS, window=DEFAULT_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+
+class _Stage:
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _Disabled:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_DISABLED = _Disabled()
+
+
+class Metrics:
+    """Thread-safe registry of stage histograms."""
+
+    def __init__(self, enabled=True, window=DEFAULT_WINDOW):
+        self.enabled = enabled
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stage(self, name, **labels):
+        """Context manager timing one stage, e.g. ``stage("inference", modality="text")``."""
+        return _Stage(self, name, labels) if self.enabled else _DISABLED
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(window=self.window)
+            histogram.observe(seconds)
+        timings = getattr(self._local, "timings", None)
+        if timings is not None:
+            timings.append({"stage": name, **labels, "ms": seconds * 1000})
+
+    def collect(self):
+        """Context manager returning a list that fills with the stages timed on this thread."""
+        return _Collector(self._local)
+
+    def propagate(self, fn):
+        """``fn`` wrapped so that, run on another thread, its stages also go to this thread's collector."""
+        timings = getattr(self._local, "timings", None)
+
+        def run(*args, **kwargs):
+            previous = getattr(self._local, "timings", None)
+            self._local.timings = timings
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.timings = previous
+        return run
+
+    def snapshot(self):
+        """One dict per stage: count, mean and rolling p50/p95/p99 in milliseconds."""
+        with self._lock:
+            items = [(key, histogram.count, histogram.sum, list(histogram.recent))
+                     for key, histogram in self._histograms.items()]
+        rows = []
+        for (name, labels), count, total, recent in sorted(items):
+            p50, p95, p99 = np.percentile(recent, [q * 100 for q in QUANTILES]) * 1000
+            rows.append({"stage": name, **dict(labels), "count": count, "mean_ms": total / count * 1000,
+                         "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)})
+        return rows
+
+    def render_prometheus(self):
+        lines = ["# HELP scanner_stage_seconds Time spent in each stage of a scan.",
+                 "# TYPE scanner_stage_seconds histogram"]
+        with self._lock:
+            items = sorted((key, list(histogram.counts), histogram.sum, histogram.count)
+                           for key, histogram in self._histograms.items())
+        for (name, labels), counts, total, count in items:
+            label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in (("stage", name),) + labels)
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'scanner_stage_seconds_bucket{{{label_text},le="{le}"}} {cumulative}')
+            lines.append(f"scanner_stage_seconds_sum{{{label_text}}} {total!r}")
+            lines.append(f"scanner_stage_seconds_count{{{label_text}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class _Collector:
+    def __init__(self, local):
+        self.local = local
+
+    def __enter__(self):
+        self.previous = getattr(self.local, "timings", None)
+        self.local.timings = []
+        return self.local.timings
+
+    def __exit__(self, *exc):
+        self.local.timings = self.previous
+        return False
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics(enabled=os.environ.get("SCANNER_METRICS", "1") != "0")
+
+
+class InstrumentedSession:
+    """``InferenceSession`` stand-in that times ``run`` per graph and profiles a sample of calls.
+
+    ``profiling_factory(prefix)`` must build an equivalent session with
+    ``enable_profiling`` on; it is created on the first sampled call and
+    replaced after every ``runs_per_trace`` profiled runs, when its trace is
+    written out.
+    """
+
+    def __init__(self, session, name, profiling_factory=None, profile_rate=0.0, profile_dir=".",
+                 runs_per_trace=DEFAULT_PROFILE_RUNS, registry=metrics):
+        self.session = session
+        self.name = name
+        self.profiling_factory = profiling_factory
+        self.profile_rate = profile_rate if profiling_factory is not None else 0.0
+        self.profile_dir = profile_dir
+        self.runs_per_trace = runs_per_trace
+        self.registry = registry
+        self._profiling = None
+        self._profiled_runs = 0
+        self._profile_lock = threading.Lock()
+        if self.profile_rate:
+            atexit.register(self.end_profiling)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def run(self, output_names, input_feed, run_options=None):
+        if self.profile_rate and random.random() < self.profile_rate:
+            return self._run_profiled(output_names, input_feed, run_options)
+        with self.registry.stage("session_run", graph=self.name):
+            return self.session.run(output_names, input_feed, run_options)
+
+    def _run_profiled(self, output_names, input_feed, run_options):
+        # The profiling session is shared, and end_profiling must not race a run
+        with self._profile_lock:
+            if self._profiling is None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                self._profiling = self.profiling_factory(os.path.join(self.profile_dir, f"ort_{self.name}"))
+            with self.registry.stage("session_run_profiled", graph=self.name):
+                outputs = self._profiling.run(output_names, input_feed, run_options)
+            self._profiled_runs += 1
+            if self._profiled_runs >= self.runs_per_trace:
+                self._end_profiling_locked()
+        return outputs
+
+    def _end_profiling_locked(self):
+        if self._profiling is None:
+            return None
+        path = self._profiling.end_profiling()
+        self._profiling = None
+        self._profiled_runs = 0
+        print(f"onnxruntime profile written to {path}", file=sys.stderr)
+        return path
+
+    def end_profiling(self):
+        """Write out the trace of the runs profiled so far, if any."""
+        with self._profile_lock:
+            return self._end_profiling_locked()
+
+
+def instrument_session(session, path, profiling_factory):
+    """Wrap ``session`` per the ``SCANNER_METRICS`` / ``SCANNER_ORT_PROFILE_*`` settings,
+    or return it unchanged when both are off."""
+    profile_rate = float(os.environ.get("SCANNER_ORT_PROFILE_RATE", 0))
+    if not metrics.enabled and profile_rate <= 0:
+        return session
+    return InstrumentedSession(
+        session,
+        os.path.splitext(os.path.basename(path))[0],
+        profiling_factory,
+        profile_rate,
+        os.environ.get("SCANNER_ORT_PROFILE_DIR", "ort_profiles"),
+        int(os.environ.get("SCANNER_ORT_PROFILE_RUNS", DEFAULT_PROFILE_RUNS)),
+    )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = metrics
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve ``GET /metrics`` from a daemon thread; for processes without their own HTTP server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,420 @@
+"""ONNX Runtime wrappers around the exported CLIPClassifier.
+
+Two artifact layouts are supported in the model directory:
+
+* ``train_quantized.onnx`` - the original single graph, which always runs both
+  encoders and gets the missing modality as a zeroed input.
+* ``text_tower.onnx`` + ``image_tower.onnx`` + ``head.npz`` - produced by
+  ``python -m scanner.export_towers``. The head file carries the
+  ``CLIPClassifier.fc`` weights and the precomputed embeddings of the zeroed
+  inputs (one per token length for the zero text), so a single-modality
+  verdict runs only one encoder.
+
+Both classifiers expose the same ``text_logits`` / ``image_logits`` /
+``joint_logits`` methods over batched NumPy arrays, and ``multi_view_logits``
+for all three views of a post at once.
+
+Text arrives padded to 77 tokens and, by default, runs at 77 tokens. Length
+bucketing is opt-in (``SCANNER_TEXT_BUCKETS=16,32,48,77``, i.e.
+``TEXT_BUCKETS``): each row then only runs padded to the shortest bucket that
+holds it, grouped by bucket. CLIP's text encoder is causal and pools at the
+end-of-text token, so the padding cut off never influenced the result; in
+fp32 the logits are bit-identical. Quantized graphs, ``train_quantized.onnx``
+and the default tower export, pick activation ranges over the whole tensor,
+padding included, so bucketed probabilities differ from full-length ones (a
+few 1e-4 on the trained model, up to 1e-2 on the random-weight fixture). A
+batch with a row whose verdict is closer than ``BUCKET_RECHECK_MARGIN`` to the
+decision boundary is run again at full length, but nothing bounds the shift,
+so a verdict just outside the margin can still differ from the full-length
+one. Opt in only with fp32 graphs, or where that trade for a shorter text
+pass is acceptable.
+"""
+import hashlib
+import os
+
+import numpy as np
+import onnxruntime as ort
+
+from scanner.metrics import instrument_session
+from scanner.tuning import share_weights, tuned_session_args
+
+IMAGE_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+IMAGE_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+IMAGE_SIZE = 224
+MAX_TEXT_LENGTH = 77
+EMBED_DIM = 512
+LABELS = ("Fake", "Real")
+# Text-only, image-only and the joint input CLIPClassifier was trained on
+VIEWS = ("text", "image", "joint")
+
+FULL_MODEL_FILE = "train_quantized.onnx"
+TEXT_TOWER_FILE = "text_tower.onnx"
+IMAGE_TOWER_FILE = "image_tower.onnx"
+HEAD_FILE = "head.npz"
+
+# No bucketing: verdicts are those of the full-length graph whatever its precision
+DEFAULT_TEXT_BUCKETS = (MAX_TEXT_LENGTH,)
+# The lengths SCANNER_TEXT_BUCKETS usually opts into
+TEXT_BUCKETS = (16, 32, 48, MAX_TEXT_LENGTH)
+# Probability gap between the two labels below which a bucketed batch is re-run at full length
+BUCKET_RECHECK_MARGIN = 0.02
+# Share of the cores the image tower gets when both towers run at once
+IMAGE_THREAD_SHARE = 0.75
+
+
+def zero_pixel_values(batch_size=1):
+    # An all-black image after CLIP normalization, used for text-only rows
+    zeros = np.zeros((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+    return (zeros - IMAGE_MEAN.reshape(1, 3, 1, 1)) / IMAGE_STD.reshape(1, 3, 1, 1)
+
+
+def softmax(logits):
+    logits = np.asarray(logits, dtype=np.float32)
+    shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return shifted / shifted.sum(axis=-1, keepdims=True)
+
+
+def to_verdicts(logits):
+    """Turn a ``(batch, 2)`` logits array into ``(label, confidence)`` pairs."""
+    probs = softmax(logits)
+    preds = probs.argmax(axis=-1)
+    return [(LABELS[pred], probs[i, pred]) for i, pred in enumerate(preds)]
+
+
+def text_buckets_from_env():
+    """``SCANNER_TEXT_BUCKETS`` as a tuple of lengths; unset (or ``77`` alone) runs every text at 77 tokens."""
+    value = os.environ.get("SCANNER_TEXT_BUCKETS")
+    if not value:
+        return DEFAULT_TEXT_BUCKETS
+    return tuple(sorted(int(length) for length in value.split(",")))
+
+
+def bucket_widths(attention_mask, buckets=TEXT_BUCKETS):
+    """Per row, the shortest bucket that holds all attended tokens, capped at the padded width."""
+    attention_mask = np.asarray(attention_mask)
+    width = attention_mask.shape[1]
+    # Up to the last attended token, so nothing but right padding is ever cut;
+    # fully masked rows (zeroed text) keep their length
+    lengths = width - np.argmax(attention_mask[:, ::-1] != 0, axis=1)
+    sizes = np.array(sorted({length for length in buckets if length < width} | {width}))
+    return sizes[np.searchsorted(sizes, lengths)]
+
+
+def run_bucketed(fn, input_ids, attention_mask, *row_arrays, buckets=TEXT_BUCKETS):
+    """``fn(input_ids, attention_mask, *row_arrays)`` once per bucket, over that bucket's
+    rows cut to its width; the outputs come back in row order."""
+    widths = bucket_widths(attention_mask, buckets)
+    if len(widths) == 0 or (widths == widths[0]).all():
+        width = widths[0] if len(widths) else np.shape(attention_mask)[1]
+        return fn(input_ids[:, :width], attention_mask[:, :width], *row_arrays)
+    output = None
+    for width in np.unique(widths):
+        rows = np.flatnonzero(widths == width)
+        result = fn(input_ids[rows, :width], attention_mask[rows, :width], *(array[rows] for array in row_arrays))
+        if output is None:
+            output = np.empty((len(widths),) + result.shape[1:], dtype=result.dtype)
+        output[rows] = result
+    return output
+
+
+def run_batches(fn, arrays, batch_size):
+    """``fn`` over consecutive ``batch_size`` slices of the row-aligned ``arrays``,
+    outputs concatenated; no rows give empty ``(0, 2)`` logits."""
+    outputs = [fn(*(array[start:start + batch_size] for array in arrays))
+               for start in range(0, len(arrays[0]), batch_size)]
+    return np.concatenate(outputs) if outputs else np.empty((0, len(LABELS)), dtype=np.float32)
+
+
+def near_boundary(logits, margin=BUCKET_RECHECK_MARGIN):
+    probs = np.sort(softmax(logits), axis=-1)
+    return probs[:, -1] - probs[:, -2] < margin
+
+
+def needs_recheck(logits, attention_mask, buckets=TEXT_BUCKETS, margin=BUCKET_RECHECK_MARGIN):
+    """Whether a row was cut to a bucket and its two label probabilities are
+    within ``margin`` of each other.
+
+    The whole batch is re-run then: quantized results depend on the batch
+    they ran in, so only the same full-length batch reproduces them. Rows
+    outside the margin keep their bucketed logits, whose verdict may still
+    differ from the full-length one if quantization moved them further.
+    """
+    cut = bucket_widths(attention_mask, buckets) < np.shape(attention_mask)[1]
+    return bool((near_boundary(logits, margin) & cut).any())
+
+
+def tower_threads(cores=None):
+    """``(text, image)`` intra-op thread counts for towers whose passes run at the same time.
+
+    Together they fill the cores instead of each tower starting a pool of its
+    own per core. The image tower gets ``IMAGE_THREAD_SHARE`` of them: on a
+    headline it does about three times the work of the bucketed text tower.
+    ``SCANNER_TOWER_THREADS=text,image`` sets them explicitly.
+    """
+    value = os.environ.get("SCANNER_TOWER_THREADS")
+    if value:
+        text, image = (int(part) for part in value.split(","))
+        return text, image
+    cores = cores or os.cpu_count() or 1
+    if cores < 2:
+        return 1, 1
+    image = min(cores - 1, max(1, round(cores * IMAGE_THREAD_SHARE)))
+    return cores - image, image
+
+
+def _inference_session(path, providers=None, profile_prefix=None, intra_op_threads=None):
+    options = ort.SessionOptions()
+    if providers is None:
+        tuned = tuned_session_args(path)
+        if tuned is not None:
+            path, options, providers = tuned
+    if intra_op_threads:
+        # A tuned count was picked for the graph running alone; never go above the share
+        options.intra_op_num_threads = min(options.intra_op_num_threads or intra_op_threads, intra_op_threads)
+    share_weights(options, path)
+    if profile_prefix is not None:
+        options.enable_profiling = True
+        options.profile_file_prefix = profile_prefix
+    return ort.InferenceSession(path, options, providers=providers or ["CPUExecutionProvider"])
+
+
+def create_session(path, providers=None, intra_op_threads=None):
+    """Session for ``path``, with the settings ``python -m scanner.tuning`` picked
+    for this host unless ``providers`` are given explicitly, and at most
+    ``intra_op_threads`` threads when set.
+
+    ``run`` is timed into ``scanner.metrics`` (see there for sampled profiling).
+    """
+    session = _inference_session(path, providers, intra_op_threads=intra_op_threads)
+    return instrument_session(session, path,
+                              lambda prefix: _inference_session(path, providers, prefix, intra_op_threads))
+
+
+class FullGraphClassifier:
+    """Runs the original joint graph, zeroing out the modality that is not scanned."""
+
+    # Only logits come out of the joint graph
+    has_embeddings = False
+
+    def __init__(self, session, text_buckets=DEFAULT_TEXT_BUCKETS, recheck_margin=BUCKET_RECHECK_MARGIN):
+        self.session = session
+        self.text_buckets = text_buckets
+        self.recheck_margin = recheck_margin
+
+    def _run(self, input_ids, attention_mask, pixel_values):
+        return self.session.run(["logits"], {
+            "input_ids": np.asarray(input_ids, dtype=np.int64),
+            "attention_mask": np.asarray(attention_mask, dtype=np.int64),
+            "pixel_values": np.asarray(pixel_values, dtype=np.float32),
+        })[0]
+
+    def _run_bucketed(self, input_ids, attention_mask, pixel_values):
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        pixel_values = np.asarray(pixel_values, dtype=np.float32)
+        logits = run_bucketed(self._run, input_ids, attention_mask, pixel_values, buckets=self.text_buckets)
+        if needs_recheck(logits, attention_mask, self.text_buckets, self.recheck_margin):
+            return self._run(input_ids, attention_mask, pixel_values)
+        return logits
+
+    def text_logits(self, input_ids, attention_mask):
+        return self._run_bucketed(input_ids, attention_mask, zero_pixel_values(len(input_ids)))
+
+    def image_logits(self, pixel_values, seq_len=MAX_TEXT_LENGTH):
+        # The app tokenizes the text before zeroing it, so the zeroed text keeps
+        # the token length of the original input. seq_len may be one length per
+        # row; rows of different lengths need separate runs.
+        pixel_values = np.asarray(pixel_values, dtype=np.float32)
+        seq_len = np.broadcast_to(seq_len, (len(pixel_values),))
+        logits = np.empty((len(pixel_values), len(LABELS)), dtype=np.float32)
+        for length in np.unique(seq_len):
+            rows = seq_len == length
+            zeros = np.zeros((int(rows.sum()), int(length)), dtype=np.int64)
+            logits[rows] = self._run(zeros, zeros, pixel_values[rows])
+        return logits
+
+    def joint_logits(self, input_ids, attention_mask, pixel_values):
+        return self._run_bucketed(input_ids, attention_mask, pixel_values)
+
+    def multi_view_logits(self, input_ids, attention_mask, pixel_values):
+        """``{view: logits}`` for ``VIEWS``, stacking each post's three inputs into one run.
+
+        The zeroed text of the image-only input keeps the text's token length
+        and every row of a run must share a length. With bucketing on, the
+        text is cut to exactly that length (only padding goes) and there is
+        one run per distinct length; if a cut text or joint verdict is within
+        the recheck margin, those rows run again at full length. With it off,
+        the text and joint rows run at full length and the image rows apart.
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        pixel_values = np.asarray(pixel_values, dtype=np.float32)
+        width = attention_mask.shape[1]
+        seq_len = attention_mask.sum(axis=1)
+        logits = {view: np.empty((len(input_ids), len(LABELS)), dtype=np.float32) for view in VIEWS}
+        bucketed = any(length < width for length in self.text_buckets)
+        for length in np.unique(seq_len):
+            rows = np.flatnonzero(seq_len == length)
+            count = len(rows)
+            ids, mask, pixels = input_ids[rows, :length], attention_mask[rows, :length], pixel_values[rows]
+            zeros = np.zeros_like(ids)
+            if not bucketed:
+                full = self._run(np.concatenate([input_ids[rows]] * 2), np.concatenate([attention_mask[rows]] * 2),
+                                 np.concatenate([zero_pixel_values(count), pixels]))
+                logits["text"][rows], logits["joint"][rows] = full[:count], full[count:]
+                logits["image"][rows] = self._run(zeros, zeros, pixels)
+                continue
+            out = self._run(np.concatenate([ids, zeros, ids]), np.concatenate([mask, zeros, mask]),
+                            np.concatenate([zero_pixel_values(count), pixels, pixels]))
+            text, image, joint = out[:count], out[count:2 * count], out[2 * count:]
+            if length < width and near_boundary(np.concatenate([text, joint]), self.recheck_margin).any():
+                full = self._run(np.concatenate([input_ids[rows]] * 2), np.concatenate([attention_mask[rows]] * 2),
+                                 np.concatenate([zero_pixel_values(count), pixels]))
+                text, joint = full[:count], full[count:]
+            logits["text"][rows], logits["image"][rows], logits["joint"][rows] = text, image, joint
+        return logits
+
+
+class TowerClassifier:
+    """Runs the text and vision encoders as separate graphs plus the numpy fc head."""
+
+    has_embeddings = True
+
+    def __init__(self, text_session, image_session, head, text_buckets=DEFAULT_TEXT_BUCKETS,
+                 recheck_margin=BUCKET_RECHECK_MARGIN):
+        self.text_session = text_session
+        self.image_session = image_session
+        self.text_buckets = text_buckets
+        self.recheck_margin = recheck_margin
+        self.weight = np.asarray(head["weight"], dtype=np.float32)
+        self.bias = np.asarray(head["bias"], dtype=np.float32)
+        # zero_text_embeds[n - 1] is the embedding of an all-zero text of n tokens
+        self.zero_text_embeds = np.asarray(head["zero_text_embeds"], dtype=np.float32)
+        self.zero_image_embeds = np.asarray(head["zero_image_embeds"], dtype=np.float32)
+
+        # CLIPClassifier concatenates [image_embeds, text_embeds] before fc, so the
+        # constant half of a single-modality row folds into the bias
+        image_weight, text_weight = self.weight[:, :EMBED_DIM], self.weight[:, EMBED_DIM:]
+        self.text_only_bias = self.bias + self.zero_image_embeds @ image_weight.T
+        if "image_only_bias" in head:
+            # Calibrated against train_quantized.onnx at export time
+            self.image_only_bias = np.asarray(head["image_only_bias"], dtype=np.float32)
+        else:
+            self.image_only_bias = self.bias + self.zero_text_embeds @ text_weight.T
+        self.image_weight = image_weight
+        self.text_weight = text_weight
+
+    def _encode_text(self, input_ids, attention_mask):
+        return self.text_session.run(["text_embeds"], {"input_ids": input_ids, "attention_mask": attention_mask})[0]
+
+    def text_embeds(self, input_ids, attention_mask):
+        # Rechecked against the text-only verdict, the one these embeddings are cached for
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        text_embeds = run_bucketed(self._encode_text, input_ids, attention_mask, buckets=self.text_buckets)
+        if needs_recheck(self.text_logits_from_embeds(text_embeds), attention_mask, self.text_buckets, self.recheck_margin):
+            return self._encode_text(input_ids, attention_mask)
+        return text_embeds
+
+    def image_embeds(self, pixel_values):
+        return self.image_session.run(["image_embeds"], {
+            "pixel_values": np.asarray(pixel_values, dtype=np.float32),
+        })[0]
+
+    def head(self, image_embeds, text_embeds):
+        return image_embeds @ self.image_weight.T + text_embeds @ self.text_weight.T + self.bias
+
+    def text_logits_from_embeds(self, text_embeds):
+        return text_embeds @ self.text_weight.T + self.text_only_bias
+
+    def image_logits_from_embeds(self, image_embeds, seq_len=MAX_TEXT_LENGTH):
+        # seq_len may also be an array with one zero-text length per row
+        return image_embeds @ self.image_weight.T + self.image_only_bias[np.asarray(seq_len) - 1]
+
+    def text_logits(self, input_ids, attention_mask):
+        return self.text_logits_from_embeds(self.text_embeds(input_ids, attention_mask))
+
+    def image_logits(self, pixel_values, seq_len=MAX_TEXT_LENGTH):
+        return self.image_logits_from_embeds(self.image_embeds(pixel_values), seq_len)
+
+    def joint_logits_from_embeds(self, image_embeds, text_embeds, input_ids, attention_mask):
+        """Joint logits from bucketed text embeddings, re-encoding the text at full
+        length when a joint verdict is within the recheck margin."""
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        logits = self.head(image_embeds, text_embeds)
+        if needs_recheck(logits, attention_mask, self.text_buckets, self.recheck_margin):
+            return self.head(image_embeds, self._encode_text(np.asarray(input_ids, dtype=np.int64), attention_mask))
+        return logits
+
+    def joint_logits(self, input_ids, attention_mask, pixel_values):
+        return self.joint_logits_from_embeds(self.image_embeds(pixel_values), self.text_embeds(input_ids, attention_mask),
+                                             input_ids, attention_mask)
+
+    def multi_view_logits(self, input_ids, attention_mask, pixel_values):
+        """``{view: logits}`` for ``VIEWS``: one pass per tower, all views from the same embeddings."""
+        return multi_view_from_embeds(self, self.image_embeds(pixel_values), self.text_embeds(input_ids, attention_mask),
+                                      input_ids, attention_mask)
+
+
+def multi_view_from_embeds(classifier, image_embeds, text_embeds, input_ids, attention_mask):
+    """All ``VIEWS`` from tower embeddings; ``classifier`` provides the head."""
+    return {
+        "text": classifier.text_logits_from_embeds(text_embeds),
+        "image": classifier.image_logits_from_embeds(image_embeds, np.asarray(attention_mask).sum(axis=1)),
+        "joint": classifier.joint_logits_from_embeds(image_embeds, text_embeds, input_ids, attention_mask),
+    }
+
+
+def zero_embeddings(model_dir):
+    # Computed with the exported towers so the constants carry the same
+    # quantization error as a live pass. The zeroed text keeps the token length
+    # of the scanned text and a fully masked sequence is not length-invariant
+    # under every attention implementation, so store one embedding per length.
+    text_session = create_session(os.path.join(model_dir, TEXT_TOWER_FILE))
+    image_session = create_session(os.path.join(model_dir, IMAGE_TOWER_FILE))
+    zero_text = []
+    for length in range(1, MAX_TEXT_LENGTH + 1):
+        zeros = np.zeros((1, length), dtype=np.int64)
+        zero_text.append(text_session.run(["text_embeds"], {"input_ids": zeros, "attention_mask": zeros})[0][0])
+    zero_image = image_session.run(["image_embeds"], {"pixel_values": zero_pixel_values(1)})[0][0]
+    return np.stack(zero_text).astype(np.float32), zero_image.astype(np.float32)
+
+
+def model_fingerprint(model_dir):
+    """Short id of the model files in ``model_dir``; changes whenever one is replaced."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(model_dir)):
+        if name.endswith((".onnx", ".npz", ".data")):
+            stat = os.stat(os.path.join(model_dir, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+
+def has_towers(model_dir):
+    return all(os.path.exists(os.path.join(model_dir, name))
+               for name in (TEXT_TOWER_FILE, IMAGE_TOWER_FILE, HEAD_FILE))
+
+
+def load_classifier(model_dir, providers=None, text_buckets=None, threads=None):
+    """Load the split towers when they were exported, else the original graph.
+
+    ``text_buckets`` defaults to ``SCANNER_TEXT_BUCKETS``, then no bucketing.
+    ``threads`` caps the intra-op threads of the towers as a ``(text, image)``
+    pair, see ``tower_threads``.
+    """
+    if text_buckets is None:
+        text_buckets = text_buckets_from_env()
+    if has_towers(model_dir):
+        text_threads, image_threads = threads or (None, None)
+        with np.load(os.path.join(model_dir, HEAD_FILE)) as head:
+            return TowerClassifier(
+                create_session(os.path.join(model_dir, TEXT_TOWER_FILE), providers, text_threads),
+                create_session(os.path.join(model_dir, IMAGE_TOWER_FILE), providers, image_threads),
+                dict(head),
+                text_buckets,
+            )
+
+    onnx_path = os.path.join(model_dir, FULL_MODEL_FILE)
+    if not os.path.exists(onnx_path):
+        raise FileNotFoundError(f"ONNX model not found at: {onnx_path}")
+    return FullGraphClassifier(create_session(onnx_path, providers), text_buckets)
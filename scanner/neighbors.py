@@ -0,0 +1,463 @@
+"""Closest already-labelled posts by CLIP embedding, for re-posted images and edited headlines.
+
+    python -m scanner.neighbors --data dataset.csv --image-root /data --base-dir .
+    python -m scanner.neighbors --data newly_labelled.csv --image-root /data --base-dir . --append
+
+Builds (or extends, with ``--append``) an index of the tower embeddings of
+every labelled row: one table of text vectors and one of image vectors, each a
+memory-mapped matrix of int8 (or float16) rows. int8 rows carry their own
+scale, so a 512-d vector costs 512 bytes plus 17 of bookkeeping.
+
+Search is cosine top-k over an inverted file: the rows are clustered into
+about ``2 * sqrt(n)`` cells by spherical k-means, and a query only scores the
+rows of its ``probes`` closest cells. A re-post sits next to its original, so
+it lands in the same cell as long as one of the probed cells holds it; the
+exact top-k of unrelated queries can miss a few rows (``benchmarks.neighbors``
+measures the recall). Tables smaller than ``MIN_TRAIN_ROWS`` are searched
+exactly.
+
+Appends go to the end of the files and are published by rewriting
+``index.json`` last, so readers never see a partial append and a running
+service picks new rows up on its next search. New rows join the existing
+cells; ``--retrain`` re-clusters a table that has grown well past the size it
+was clustered at. The index only works with the split towers, whose
+embeddings it stores, and is tied to them: re-exporting the towers makes
+``load_index`` ignore it until it is rebuilt.
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from scanner.model import EMBED_DIM, IMAGE_TOWER_FILE, LABELS, TEXT_TOWER_FILE, has_towers
+from scanner.tuning import file_fingerprint
+
+INDEX_DIR = "index"
+HEADER_FILE = "index.json"
+ITEMS_FILE = "items.jsonl"
+KINDS = ("text", "image")
+DTYPES = ("int8", "float16")
+DEFAULT_K = 5
+DEFAULT_PROBES = 8
+# Below this many rows a table is scanned exactly
+MIN_TRAIN_ROWS = 4096
+KMEANS_ITERATIONS = 10
+TRAIN_ROWS_PER_CELL = 32
+CHUNK_ROWS = 65536
+# Per vector: int8 scale (1.0 for float16), label, k-means cell, offset of its item in items.jsonl
+ROW_DTYPE = np.dtype([("scale", "<f4"), ("label", "i1"), ("cell", "<i4"), ("offset", "<i8")])
+# Kept with every neighbour so a match can be shown without the dataset
+ITEM_TEXT_CHARS = 280
+
+
+def tower_fingerprints(model_dir):
+    return {"text": file_fingerprint(os.path.join(model_dir, TEXT_TOWER_FILE)),
+            "image": file_fingerprint(os.path.join(model_dir, IMAGE_TOWER_FILE))}
+
+
+def default_cells(count):
+    # A power of two near 2 * sqrt(n): cells of a few hundred rows at a million vectors
+    return 2 ** max(1, round(math.log2(2 * math.sqrt(count))))
+
+
+def unit_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors, dtype):
+    """``(stored rows, per-row scales)`` of unit-normalized ``vectors``."""
+    vectors = unit_rows(vectors)
+    if dtype == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def spherical_kmeans(vectors, cells, iterations=KMEANS_ITERATIONS, seed=0):
+    """Unit centroids of ``cells`` clusters of unit ``vectors``, by cosine."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), cells, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = ~sums.any(axis=1)
+        # Reseed empty cells from random rows instead of leaving them dead
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = unit_rows(sums)
+    return centroids
+
+
+class _Table:
+    """One kind of vector as published by the header: stored rows, their metadata and cells."""
+
+    def __init__(self, directory, kind, header):
+        self.kind = kind
+        self.count = header["tables"][kind]["count"]
+        self.dtype = np.dtype(header["dtype"])
+        dim = header["dim"]
+        if self.count:
+            # Files may run past count after an interrupted append; only count rows are published
+            self.vectors = np.memmap(os.path.join(directory, f"{kind}.vectors"), dtype=self.dtype, mode="r",
+                                     shape=(self.count, dim))
+            self.rows = np.fromfile(os.path.join(directory, f"{kind}.rows"), dtype=ROW_DTYPE, count=self.count)
+        else:
+            self.vectors = np.empty((0, dim), dtype=self.dtype)
+            self.rows = np.empty(0, dtype=ROW_DTYPE)
+        self.scales = np.ascontiguousarray(self.rows["scale"])
+        self.cells = np.ascontiguousarray(self.rows["cell"])
+        self.centroids = None
+        centroids_path = os.path.join(directory, f"{kind}.centroids.npy")
+        if header["tables"][kind].get("cells") and os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            # Rows of each cell, in storage order
+            self.order = np.argsort(self.cells, kind="stable")
+            self.offsets = np.searchsorted(self.cells[self.order], np.arange(len(self.centroids) + 1))
+
+    def dequantized(self, rows):
+        return self.vectors[rows].astype(np.float32) * self.scales[rows, None]
+
+    def assign(self, vectors):
+        if self.centroids is None:
+            return np.full(len(vectors), -1, dtype=np.int32)
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _scores(self, rows, queries):
+        # rows x queries
+        return (self.vectors[rows].astype(np.float32) @ queries.T) * self.scales[rows, None]
+
+    def search(self, queries, k, probes):
+        if self.centroids is None:
+            best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+            best_scores = np.empty((len(queries), 0), dtype=np.float32)
+            for start in range(0, self.count, CHUNK_ROWS):
+                rows = np.arange(start, min(start + CHUNK_ROWS, self.count))
+                rows = np.concatenate([best_rows, np.broadcast_to(rows, (len(queries), len(rows)))], axis=1)
+                scores = np.concatenate([best_scores, self._scores(slice(start, start + CHUNK_ROWS), queries).T], axis=1)
+                best_rows, best_scores = _top_k(rows, scores, k)
+            return best_rows, best_scores
+
+        probes = min(probes, len(self.centroids))
+        probed = np.argpartition(-(queries @ self.centroids.T), probes - 1, axis=1)[:, :probes]
+        candidates = [([], []) for _ in queries]
+        for cell in np.unique(probed):
+            # Queries of a batch that probe the same cell share its gather and conversion
+            asking = np.flatnonzero((probed == cell).any(axis=1))
+            rows = self.order[self.offsets[cell]:self.offsets[cell + 1]]
+            scores = self._scores(rows, queries[asking])
+            for column, query in enumerate(asking):
+                candidates[query][0].append(rows)
+                candidates[query][1].append(scores[:, column])
+        best = [_top_k(np.concatenate(rows)[None], np.concatenate(scores)[None], k) for rows, scores in candidates]
+        return np.concatenate([rows for rows, _ in best]), np.concatenate([scores for _, scores in best])
+
+
+def _top_k(rows, scores, k):
+    """Best ``k`` per query as ``(rows, scores)``, highest first; -1 rows pad what is missing."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        rows, scores = np.take_along_axis(rows, part, axis=1), np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    rows, scores = np.take_along_axis(rows, order, axis=1), np.take_along_axis(scores, order, axis=1)
+    rows = np.where(np.isfinite(scores), rows, -1)
+    if rows.shape[1] < k:
+        pad = k - rows.shape[1]
+        rows = np.pad(rows, ((0, 0), (0, pad)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+    return rows, scores
+
+
+class NeighborIndex:
+    """Labelled text and image embeddings under ``directory``, searchable by cosine.
+
+    Safe to search from several threads; appends and training in one process
+    at a time. Other processes' appends show up on the next search.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._searches = 0
+        self._mtime = None
+        self._reload()
+
+    @classmethod
+    def create(cls, directory, dtype="int8", dim=EMBED_DIM, models=None):
+        """An empty index in ``directory``, replacing any index already there."""
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of: {', '.join(DTYPES)}")
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        header = {"dim": dim, "dtype": dtype, "items_bytes": 0,
+                  "tables": {kind: {"count": 0, "cells": 0, "model": (models or {}).get(kind)} for kind in KINDS}}
+        _write_header(directory, header)
+        open(os.path.join(directory, ITEMS_FILE), "wb").close()
+        for kind in KINDS:
+            for suffix in ("vectors", "rows"):
+                open(os.path.join(directory, f"{kind}.{suffix}"), "wb").close()
+        return cls(directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _reload(self):
+        self._mtime = os.stat(self._path(HEADER_FILE)).st_mtime_ns
+        with open(self._path(HEADER_FILE)) as f:
+            header = json.load(f)
+        tables = {kind: _Table(self.directory, kind, header) for kind in KINDS}
+        self.header, self.tables = header, tables
+
+    def refresh(self):
+        """Pick up rows another process has appended since the last look."""
+        mtime = os.stat(self._path(HEADER_FILE)).st_mtime_ns
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._reload()
+
+    @property
+    def models(self):
+        return {kind: self.header["tables"][kind]["model"] for kind in KINDS}
+
+    def __len__(self):
+        return sum(table.count for table in self.tables.values())
+
+    def append(self, items, labels, embeddings, train=True):
+        """Add labelled ``items`` (JSON-serializable dicts) and their ``embeddings``.
+
+        ``embeddings`` maps a kind to ``(positions, vectors)``: the positions in
+        ``items`` that have a vector of that kind, and those vectors. A table
+        without cells is clustered once it reaches ``MIN_TRAIN_ROWS``, unless
+        ``train`` is false.
+        """
+        with self._lock:
+            header = copy.deepcopy(self.header)
+            with open(self._path(ITEMS_FILE), "r+b") as f:
+                # Drop anything an interrupted append left after the published end
+                f.truncate(header["items_bytes"])
+                f.seek(header["items_bytes"])
+                offsets = []
+                for item in items:
+                    offsets.append(f.tell())
+                    f.write(json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+                header["items_bytes"] = f.tell()
+            offsets = np.array(offsets, dtype=np.int64)
+            labels = np.asarray(labels, dtype=np.int8)
+
+            for kind, (positions, vectors) in embeddings.items():
+                positions = np.asarray(positions, dtype=np.int64)
+                if not len(positions):
+                    continue
+                stored, scales = quantize(vectors, header["dtype"])
+                rows = np.zeros(len(positions), dtype=ROW_DTYPE)
+                rows["scale"], rows["label"], rows["offset"] = scales, labels[positions], offsets[positions]
+                rows["cell"] = self.tables[kind].assign(stored.astype(np.float32) * scales[:, None])
+                count = header["tables"][kind]["count"]
+                for suffix, data in (("vectors", stored), ("rows", rows)):
+                    with open(self._path(f"{kind}.{suffix}"), "r+b") as f:
+                        f.truncate(count * (data.nbytes // len(data)))
+                        f.seek(0, os.SEEK_END)
+                        f.write(data.tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+                header["tables"][kind]["count"] = count + len(positions)
+
+            _write_header(self.directory, header)
+            self._reload()
+        if train:
+            for kind in KINDS:
+                if not self.header["tables"][kind]["cells"] and self.tables[kind].count >= MIN_TRAIN_ROWS:
+                    self.train(kind)
+
+    def train(self, kind, cells=None, seed=0):
+        """Cluster ``kind``'s rows into ``cells`` cells (``default_cells`` when ``None``)."""
+        with self._lock:
+            table = self.tables[kind]
+            if table.count < MIN_TRAIN_ROWS:
+                return 0
+            cells = min(cells or default_cells(table.count), table.count)
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(table.count, min(table.count, cells * TRAIN_ROWS_PER_CELL), replace=False))
+            centroids = spherical_kmeans(unit_rows(table.dequantized(sample)), cells, seed=seed).astype(np.float32)
+
+            rows = table.rows.copy()
+            for start in range(0, table.count, CHUNK_ROWS):
+                chunk = slice(start, start + CHUNK_ROWS)
+                rows["cell"][chunk] = np.argmax(table.dequantized(chunk) @ centroids.T, axis=1)
+            # The new cells and centroids replace the old ones together, then the header publishes them
+            np.save(self._path(f"{kind}.centroids.tmp.npy"), centroids)
+            rows.tofile(self._path(f"{kind}.rows.tmp"))
+            os.replace(self._path(f"{kind}.centroids.tmp.npy"), self._path(f"{kind}.centroids.npy"))
+            os.replace(self._path(f"{kind}.rows.tmp"), self._path(f"{kind}.rows"))
+            header = copy.deepcopy(self.header)
+            header["tables"][kind]["cells"] = cells
+            _write_header(self.directory, header)
+            self._reload()
+            return cells
+
+    def search(self, kind, queries, k=DEFAULT_K, probes=DEFAULT_PROBES):
+        """``(rows, similarities)``, each ``(len(queries), k)`` with the closest first;
+        rows of -1 pad queries with fewer than ``k`` candidates."""
+        return self._search(kind, queries, k, probes)[1:]
+
+    def _search(self, kind, queries, k, probes):
+        self.refresh()
+        # The table searched, in case another append replaces it meanwhile
+        table = self.tables[kind]
+        queries = unit_rows(queries)
+        with self._lock:
+            self._searches += len(queries)
+        if not table.count:
+            return table, np.full((len(queries), k), -1, dtype=np.int64), np.full((len(queries), k), -np.inf, dtype=np.float32)
+        return (table, *table.search(queries, k, probes))
+
+    def neighbors(self, kind, queries, k=DEFAULT_K, probes=DEFAULT_PROBES):
+        """Per query, up to ``k`` dicts of ``label``, ``similarity`` and the stored item."""
+        table, rows, scores = self._search(kind, queries, k, probes)
+        results = []
+        with open(self._path(ITEMS_FILE), "rb") as f:
+            for query_rows, query_scores in zip(rows, scores):
+                matches = []
+                for row, score in zip(query_rows, query_scores):
+                    if row < 0:
+                        break
+                    f.seek(int(table.rows["offset"][row]))
+                    item = json.loads(f.readline())
+                    # int8 rounding can put an exact match a hair above 1
+                    matches.append({"label": LABELS[table.rows["label"][row]], "similarity": min(float(score), 1.0), **item})
+                results.append(matches)
+        return results
+
+    def stats(self):
+        with self._lock:
+            searches = self._searches
+        return {"searches": searches, "dtype": self.header["dtype"],
+                **{kind: {"vectors": table.count, "cells": self.header["tables"][kind]["cells"]}
+                   for kind, table in self.tables.items()}}
+
+
+def _write_header(directory, header):
+    tmp_path = os.path.join(directory, HEADER_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(header, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(directory, HEADER_FILE))
+
+
+def index_dir(base_dir):
+    return os.environ.get("SCANNER_INDEX_DIR") or os.path.join(base_dir, INDEX_DIR)
+
+
+def load_index(base_dir):
+    """The index under ``SCANNER_INDEX_DIR`` (default ``<base_dir>/index``), or ``None`` when
+    there is none, it was built with other towers, or ``SCANNER_INDEX=0``."""
+    directory = index_dir(base_dir)
+    if os.environ.get("SCANNER_INDEX") == "0" or not os.path.exists(os.path.join(directory, HEADER_FILE)):
+        return None
+    index = NeighborIndex(directory)
+    model_dir = os.path.join(base_dir, "clip_model")
+    if not has_towers(model_dir):
+        print(f"Ignoring {directory}: looking posts up needs the split towers", file=sys.stderr)
+        return None
+    if index.models != tower_fingerprints(model_dir):
+        print(f"Ignoring {directory}: built with other towers; rebuild it with python -m scanner.neighbors",
+              file=sys.stderr)
+        return None
+    return index
+
+
+def embed_rows(rows, classifier, processor, pool, image_root=None):
+    """``{kind: (positions, embeddings)}`` of the rows with a text and with a readable image."""
+    from scanner.bulk import load_pixels
+    from scanner.pipeline import encode_texts
+
+    embeddings = {}
+    positions = [i for i, row in enumerate(rows) if row["text"].strip()]
+    if positions:
+        input_ids, attention_mask = encode_texts([rows[i]["text"] for i in positions], processor)
+        embeddings["text"] = (positions, classifier.text_embeds(input_ids, attention_mask))
+
+    def pixels_or_none(path):
+        if image_root and not os.path.isabs(path):
+            path = os.path.join(image_root, path)
+        try:
+            return load_pixels(path)
+        except (OSError, ValueError):
+            # Unlike training, no black stand-in: it would match every other missing image
+            return None
+
+    paths = [(i, row["image_path"]) for i, row in enumerate(rows) if row.get("image_path")]
+    pixels = list(pool.map(pixels_or_none, [path for _, path in paths]))
+    positions = [i for (i, _), values in zip(paths, pixels) if values is not None]
+    if positions:
+        embeddings["image"] = (positions, classifier.image_embeds(np.stack([values for values in pixels if values is not None])))
+    return embeddings
+
+
+def main():
+    from scanner.bulk import chunked
+    from scanner.pipeline import load_model_and_processor
+    from scanner.quantize import read_dataset
+
+    parser = argparse.ArgumentParser(description="Index the embeddings of labelled posts for nearest-neighbour lookups")
+    parser.add_argument("--data", required=True, help="labelled rows as CSV with text, label and image_path columns")
+    parser.add_argument("--image-root", help="prefix for relative image paths")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--index-dir", help="where the index lives (default: SCANNER_INDEX_DIR, else <base-dir>/index)")
+    parser.add_argument("--append", action="store_true", help="add the rows to the existing index instead of rebuilding it")
+    parser.add_argument("--retrain", action="store_true", help="re-cluster every table after appending")
+    parser.add_argument("--dtype", choices=DTYPES, default="int8", help="storage of a new index")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    directory = args.index_dir or index_dir(args.base_dir)
+    classifier, processor = load_model_and_processor(args.base_dir, max_batch_size=1, concurrent=False)
+    if not classifier.has_embeddings:
+        raise SystemExit("The index stores tower embeddings; export the towers first: python -m scanner.export_towers")
+    models = tower_fingerprints(os.path.join(args.base_dir, "clip_model"))
+    if args.append:
+        if not os.path.exists(os.path.join(directory, HEADER_FILE)):
+            raise SystemExit(f"No index at {directory} to append to")
+        index = NeighborIndex(directory)
+        if index.models != models:
+            raise SystemExit(f"{directory} was built with other towers; rebuild it without --append")
+    else:
+        index = NeighborIndex.create(directory, args.dtype, models=models)
+
+    rows = read_dataset(args.data)
+    done = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for chunk in chunked(rows, args.batch_size):
+            # A fresh index is clustered once, over all of its rows, below
+            index.append([{"source": os.path.basename(args.data), "row": done + i, "text": row["text"][:ITEM_TEXT_CHARS], "image_path": row.get("image_path")}
+                          for i, row in enumerate(chunk)],
+                         [row["label"] for row in chunk], embed_rows(chunk, classifier, processor, pool, args.image_root),
+                         train=args.append and not args.retrain)
+            done += len(chunk)
+            if done % (args.batch_size * 32) < args.batch_size:
+                print(f"{done} rows embedded", file=sys.stderr)
+    if args.retrain or not args.append:
+        for kind in KINDS:
+            cells = index.train(kind)
+            print(f"{kind}: {index.tables[kind].count} vectors in {cells or 'no'} cells"
+                  + ("" if cells else " (searched exactly)"), file=sys.stderr)
+    print(f"Index written to {directory}: {json.dumps(index.stats())}")
+
+
+if __name__ == "__main__":
+    main()
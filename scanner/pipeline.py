@@ -0,0 +1,533 @@
+"""Model loading and per-modality predictions shared by the app and the service."""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from scanner.batching import DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT_MS, BatchedClassifier
+from scanner.cache import EmbeddingCache, image_key, text_key
+from scanner.longtext import DEFAULT_AGGREGATION, aggregate_windows, check_aggregation, long_text_logits
+from scanner.frames import frame_settings, is_animated, keyframes
+from scanner.metrics import metrics
+from scanner.model import EMBED_DIM, LABELS, VIEWS, load_classifier, multi_view_from_embeds, to_verdicts, tower_threads
+from scanner.neighbors import DEFAULT_K
+from scanner.preprocess import open_image, preprocess_images
+from scanner.tokenizer import ClipTokenizer
+
+_pass_pool = None
+_pass_pool_lock = threading.Lock()
+
+
+def concurrent_passes():
+    """Whether the text and image passes of one post run at the same time: on two or
+    more cores, unless ``SCANNER_CONCURRENT_PASSES=0`` (``1`` forces it on)."""
+    value = os.environ.get("SCANNER_CONCURRENT_PASSES")
+    if value is not None:
+        return value != "0"
+    return (os.cpu_count() or 1) >= 2
+
+
+def _passes():
+    global _pass_pool
+    with _pass_pool_lock:
+        if _pass_pool is None:
+            _pass_pool = ThreadPoolExecutor(max_workers=max(2, os.cpu_count() or 1), thread_name_prefix="pass")
+    return _pass_pool
+
+
+def run_passes(passes, on_done=None):
+    """``{name: fn()}`` for ``passes`` given as ``{name: fn}``.
+
+    With ``concurrent_passes()`` they run at the same time on a shared pool
+    (onnxruntime releases the GIL), else one after the other. ``on_done(name,
+    result)`` is called on the calling thread as each one finishes.
+    """
+    results = {}
+    if len(passes) < 2 or not concurrent_passes():
+        for name, fn in passes.items():
+            results[name] = fn()
+            if on_done is not None:
+                on_done(name, results[name])
+        return results
+    futures = {_passes().submit(metrics.propagate(fn)): name for name, fn in passes.items()}
+    for future in as_completed(futures):
+        name = futures[future]
+        results[name] = future.result()
+        if on_done is not None:
+            on_done(name, results[name])
+    return results
+
+
+def load_model_and_processor(base_dir, max_batch_size=None, max_wait_ms=None, concurrent=None):
+    """Load the tokenizer from ``clip_processor/`` and the classifier under ``clip_model/``.
+
+    Only onnxruntime, NumPy, Pillow and ``tokenizers`` are needed: the
+    processor returned here is a ``ClipTokenizer`` (images go through
+    ``scanner.preprocess``), so neither torch nor transformers is imported.
+
+    Batching defaults come from ``SCANNER_MAX_BATCH_SIZE`` and
+    ``SCANNER_MAX_WAIT_MS``; a max batch size of 1 turns it off.
+
+    With ``concurrent`` (default ``concurrent_passes()``) the towers split the
+    intra-op threads between them (``tower_threads``), since a post runs both
+    at once. Offline jobs that run one modality at a time over large batches
+    pass ``False`` to give each tower every core.
+    """
+    processor = ClipTokenizer.from_dir(os.path.join(base_dir, "clip_processor"))
+    return load_model(os.path.join(base_dir, "clip_model"), max_batch_size, max_wait_ms, concurrent), processor
+
+
+def load_model(model_dir, max_batch_size=None, max_wait_ms=None, concurrent=None):
+    """The classifier in ``model_dir``, set up as ``load_model_and_processor`` sets up ``clip_model/``."""
+    if concurrent is None:
+        concurrent = concurrent_passes()
+    # Split text/image towers when exported, else the joint graph
+    classifier = load_classifier(model_dir, threads=tower_threads() if concurrent else None)
+
+    if max_batch_size is None:
+        max_batch_size = int(os.environ.get("SCANNER_MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE))
+    if max_wait_ms is None:
+        max_wait_ms = float(os.environ.get("SCANNER_MAX_WAIT_MS", DEFAULT_MAX_WAIT_MS))
+    if max_batch_size > 1:
+        classifier = BatchedClassifier(classifier, max_batch_size, max_wait_ms)
+    return classifier
+
+
+def encode_texts(texts, processor):
+    """Tokenize a list of texts the way ``predict_text_only`` does, in one call."""
+    return processor(texts)
+
+
+def preprocess_image(image):
+    """Pixel values of one RGB image, as ``predict_image_only`` feeds them."""
+    return preprocess_images([image])[0]
+
+
+def predict_text_only(text, classifier, processor):
+    with metrics.stage("tokenize"):
+        input_ids, attention_mask = encode_texts([text], processor)
+    # The classifier pairs the text with the normalized zero image for text-only
+    with metrics.stage("inference", modality="text"):
+        logits = classifier.text_logits(input_ids, attention_mask)
+    with metrics.stage("softmax", modality="text"):
+        return to_verdicts(logits)[0]
+
+
+def predict_long_text(text, classifier, processor, aggregate=DEFAULT_AGGREGATION):
+    """Like ``predict_text_only`` but over the whole text, in overlapping windows
+    combined by ``aggregate`` (see ``scanner.longtext``)."""
+    with metrics.stage("inference", modality="long_text"):
+        logits = long_text_logits([text], classifier, processor, aggregate)
+    with metrics.stage("softmax", modality="text"):
+        return to_verdicts(logits)[0]
+
+
+def predict_multi_view(text, image, classifier, processor):
+    """Text-only, image-only and joint ``(label, confidence)`` by view, from one batched call."""
+    with metrics.stage("tokenize"):
+        input_ids, attention_mask = encode_texts([text], processor)
+    with metrics.stage("preprocess"):
+        pixel_values = preprocess_images.buffered([image])
+    with metrics.stage("inference", modality="joint"):
+        logits = classifier.multi_view_logits(input_ids, attention_mask, pixel_values)
+    with metrics.stage("softmax", modality="joint"):
+        return {view: to_verdicts(logits[view])[0] for view in VIEWS}
+
+
+def predict_image_only(text, image, classifier, processor):
+    with metrics.stage("tokenize"):
+        _, attention_mask = encode_texts([text], processor)
+    with metrics.stage("preprocess"):
+        pixel_values = preprocess_images.buffered([image])
+    # The classifier pairs the image with zeroed text of the same token length
+    with metrics.stage("inference", modality="image"):
+        logits = classifier.image_logits(pixel_values, seq_len=int(attention_mask.sum()))
+    with metrics.stage("softmax", modality="image"):
+        return to_verdicts(logits)[0]
+
+
+def predict_images(text, images, classifier, processor, aggregate=DEFAULT_AGGREGATION):
+    """Image-only verdicts for all images of one post from a single batched call.
+
+    Returns the post-level ``(label, confidence)``, the images' probabilities
+    combined by ``aggregate`` as an article's windows are (see
+    ``scanner.longtext``), and the list of per-image ones.
+    """
+    check_aggregation(aggregate)
+    with metrics.stage("tokenize"):
+        _, attention_mask = encode_texts([text], processor)
+    with metrics.stage("preprocess"):
+        pixel_values = preprocess_images.buffered(images)
+    with metrics.stage("inference", modality="image"):
+        logits = classifier.image_logits(pixel_values, seq_len=int(attention_mask.sum()))
+    with metrics.stage("softmax", modality="image"):
+        return to_verdicts(aggregate_windows(logits, aggregate))[0], to_verdicts(logits)
+
+
+def scan(text, image, classifier, processor):
+    """Run both single-modality predictions, in the shape the app keeps in session state."""
+    verdicts = run_passes({"text": lambda: predict_text_only(text, classifier, processor),
+                           "image": lambda: predict_image_only(text, image, classifier, processor)})
+    (text_pred, text_conf), (img_pred, img_conf) = verdicts["text"], verdicts["image"]
+    return {
+        "text": {"label": text_pred, "conf": float(text_conf)},
+        "image": {"label": img_pred, "conf": float(img_conf)},
+    }
+
+
+def decode_image(image_bytes):
+    """Upload bytes to an RGB image, decoded only as large as preprocessing needs."""
+    return open_image(io.BytesIO(image_bytes))
+
+
+def _text_vector(text, input_ids, attention_mask, classifier, cache):
+    # Embeddings for the towers, logits for the joint graph
+    key = f"embeds:{text_key(text)}" if classifier.has_embeddings else f"logits:{text_key(text)}"
+    with metrics.stage("cache_lookup", modality="text"):
+        cached = cache.get("text", key) if cache is not None else None
+    if cached is None:
+        with metrics.stage("inference", modality="text"):
+            if classifier.has_embeddings:
+                cached = classifier.text_embeds(input_ids, attention_mask)[0]
+            else:
+                cached = classifier.text_logits(input_ids, attention_mask)[0]
+        if cache is not None:
+            cache.put("text", key, cached)
+    return cached
+
+
+def _text_logits(text, input_ids, attention_mask, classifier, cache):
+    cached = _text_vector(text, input_ids, attention_mask, classifier, cache)
+    if classifier.has_embeddings:
+        return classifier.text_logits_from_embeds(cached[None])
+    return cached[None]
+
+
+def _long_text_logits(text, aggregate, classifier, processor, cache):
+    key = f"long:{aggregate}:{text_key(text)}"
+    with metrics.stage("cache_lookup", modality="long_text"):
+        cached = cache.get("text", key) if cache is not None else None
+    if cached is None:
+        with metrics.stage("inference", modality="long_text"):
+            cached = long_text_logits([text], classifier, processor, aggregate)[0]
+        if cache is not None:
+            cache.put("text", key, cached)
+    return cached[None]
+
+
+def _image_keys(images):
+    """Per image, its cache key and whether it is an animation or clip. Keyframes
+    are keyed with the sampling settings that picked them."""
+    settings = ":".join(str(value) for value in frame_settings())
+    keys = []
+    for image_bytes in images:
+        animated = is_animated(image_bytes)
+        keys.append((f"{image_key(image_bytes)}:frames:{settings}" if animated else image_key(image_bytes), animated))
+    return keys
+
+
+def _pixel_values(images, animated):
+    """Pixel values of every still and every keyframe, in order, and per image
+    the keyframe times (None for a still)."""
+    crops, times = [], []
+    with metrics.stage("decode"):
+        for image_bytes, moving in zip(images, animated):
+            if moving:
+                frame_times, frame_crops = keyframes(image_bytes)
+                crops.extend(frame_crops)
+                times.append(frame_times)
+            else:
+                crops.append(decode_image(image_bytes))
+                times.append(None)
+    with metrics.stage("preprocess"):
+        return preprocess_images.buffered(crops), times
+
+
+def _counts(blocks):
+    return [len(block) for block in blocks]
+
+
+def _frame_counts(times):
+    return [1 if frame_times is None else len(frame_times) for frame_times in times]
+
+
+def _split(rows, counts):
+    # Rows back into one array per image
+    bounds = np.cumsum([0] + counts)
+    return [rows[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _cached_times(cache, key):
+    times = cache.get("image", f"times:{key}") if cache is not None else None
+    return None if times is None else [round(float(time), 3) for time in times]
+
+
+def _image_vectors(images, seq_len, classifier, cache):
+    """Per image, its rows of tower embeddings or joint-graph logits (one for a
+    still, one per keyframe of an animation or clip) and its keyframe times
+    (None for a still). Images not cached yet are decoded, preprocessed and run
+    together as one batch."""
+    width = EMBED_DIM if classifier.has_embeddings else len(LABELS)
+    image_keys = _image_keys(images)
+    # Joint-graph logits depend on the zero-text length, tower embeddings do not
+    if classifier.has_embeddings:
+        keys = [f"embeds:{key}" for key, _ in image_keys]
+    else:
+        keys = [f"logits:{key}:{seq_len}" for key, _ in image_keys]
+    blocks, times = [None] * len(images), [None] * len(images)
+    with metrics.stage("cache_lookup", modality="image"):
+        for i, (key, animated) in enumerate(image_keys):
+            cached = cache.get("image", keys[i]) if cache is not None else None
+            if animated and cached is not None:
+                times[i] = _cached_times(cache, key)
+                cached = None if times[i] is None else cached
+            if cached is not None:
+                blocks[i] = cached.reshape(-1, width)
+    missing = [i for i, block in enumerate(blocks) if block is None]
+    if missing:
+        # Only decode the images that have not been seen before
+        pixel_values, missing_times = _pixel_values([images[i] for i in missing], [image_keys[i][1] for i in missing])
+        with metrics.stage("inference", modality="image"):
+            if classifier.has_embeddings:
+                computed = classifier.image_embeds(pixel_values)
+            else:
+                computed = classifier.image_logits(pixel_values, seq_len)
+        for i, block, frame_times in zip(missing, _split(computed, _frame_counts(missing_times)), missing_times):
+            blocks[i], times[i] = block, frame_times
+            if cache is not None:
+                cache.put("image", keys[i], block)
+                if frame_times is not None:
+                    cache.put("image", f"times:{image_keys[i][0]}", frame_times)
+    return blocks, times
+
+
+def _image_logits(images, seq_len, classifier, cache):
+    """Per image, its logits rows; and the keyframe times, see ``_image_vectors``."""
+    blocks, times = _image_vectors(images, seq_len, classifier, cache)
+    if classifier.has_embeddings:
+        return _split(classifier.image_logits_from_embeds(np.concatenate(blocks), seq_len), _counts(blocks)), times
+    return blocks, times
+
+
+def _multi_view_logits(text, images, input_ids, attention_mask, classifier, cache, on_logits=None):
+    """``({view: logits}, times)``: the text logits, and for the image and joint
+    views one array of rows per image (see ``_image_vectors``). With the towers,
+    ``on_logits(view, logits, times)`` gets the text and image views as soon as
+    their pass is done."""
+    seq_len = int(attention_mask.sum())
+    if classifier.has_embeddings:
+        def single_view(kind, vectors):
+            if kind == "text":
+                on_logits("text", classifier.text_logits_from_embeds(vectors[None]), None)
+            else:
+                blocks, times = vectors
+                on_logits("image", _split(classifier.image_logits_from_embeds(np.concatenate(blocks), seq_len), _counts(blocks)),
+                          times)
+
+        # Every view comes from the (cached) embeddings, the two towers side by side
+        embeds = run_passes({"text": lambda: _text_vector(text, input_ids, attention_mask, classifier, cache),
+                             "image": lambda: _image_vectors(images, seq_len, classifier, cache)},
+                            single_view if on_logits is not None else None)
+        blocks, times = embeds["image"]
+        image_embeds = np.concatenate(blocks)
+        count = len(image_embeds)
+        with metrics.stage("inference", modality="joint"):
+            logits = multi_view_from_embeds(classifier, image_embeds, np.repeat(embeds["text"][None], count, axis=0),
+                                            np.repeat(input_ids, count, axis=0), np.repeat(attention_mask, count, axis=0))
+        return {"text": logits["text"][:1], "image": _split(logits["image"], _counts(blocks)),
+                "joint": _split(logits["joint"], _counts(blocks))}, times
+
+    width = len(LABELS)
+    image_keys = _image_keys(images)
+    text_cache_key = f"logits:{text_key(text)}"
+    view_keys = {"image": [f"logits:{key}:{seq_len}" for key, _ in image_keys],
+                 "joint": [f"joint:{text_key(text)}:{key}" for key, _ in image_keys]}
+    blocks = {view: [None] * len(images) for view in view_keys}
+    times = [None] * len(images)
+    with metrics.stage("cache_lookup", modality="joint"):
+        text_logits = cache.get("text", text_cache_key) if cache is not None else None
+        for i, (key, animated) in enumerate(image_keys):
+            if animated:
+                times[i] = _cached_times(cache, key)
+                if times[i] is None:
+                    continue
+            for view, keys in view_keys.items():
+                cached = cache.get("image", keys[i]) if cache is not None else None
+                blocks[view][i] = None if cached is None else cached.reshape(-1, width)
+    rows = [i for i in range(len(images)) if blocks["image"][i] is None or blocks["joint"][i] is None]
+    if text_logits is None and not rows:
+        rows = [0]
+    if rows:
+        # One run of the joint graph yields all three views of every image and keyframe
+        pixel_values, row_times = _pixel_values([images[i] for i in rows], [image_keys[i][1] for i in rows])
+        count = len(pixel_values)
+        with metrics.stage("inference", modality="joint"):
+            logits = classifier.multi_view_logits(np.repeat(input_ids, count, axis=0),
+                                                  np.repeat(attention_mask, count, axis=0), pixel_values)
+        if text_logits is None:
+            text_logits = logits["text"][0]
+            if cache is not None:
+                cache.put("text", text_cache_key, text_logits)
+        for view, keys in view_keys.items():
+            for i, block in zip(rows, _split(logits[view], _frame_counts(row_times))):
+                if blocks[view][i] is None:
+                    blocks[view][i] = block
+                    if cache is not None:
+                        cache.put("image", keys[i], block)
+        for i, frame_times in zip(rows, row_times):
+            times[i] = frame_times
+            if cache is not None and frame_times is not None:
+                cache.put("image", f"times:{image_keys[i][0]}", frame_times)
+    return {"text": text_logits[None], **blocks}, times
+
+
+def _post_logits(view, blocks, times, per_image, aggregate):
+    """One row of ``view`` logits for the whole post from each image's rows,
+    recording per-keyframe and per-image verdicts in ``per_image`` on the way."""
+    image_logits = []
+    for verdicts, block, frame_times in zip(per_image, blocks, times):
+        if frame_times is not None:
+            frames = verdicts.setdefault("frames", [{"time": time} for time in frame_times])
+            for frame, (label, conf) in zip(frames, to_verdicts(block)):
+                frame[view] = {"label": label, "conf": float(conf)}
+            block = aggregate_windows(block, aggregate)
+        image_logits.append(block)
+    image_logits = np.concatenate(image_logits)
+    if len(image_logits) > 1:
+        for verdicts, (label, conf) in zip(per_image, to_verdicts(image_logits)):
+            verdicts[view] = {"label": label, "conf": float(conf)}
+        image_logits = aggregate_windows(image_logits, aggregate)
+    return image_logits
+
+
+def _merge_matches(matches, owners, k=DEFAULT_K):
+    # The closest labelled posts over all images of a post, each tagged with the image it matched
+    merged = {}
+    for owner, image_matches in zip(owners, matches):
+        for match in image_matches:
+            key = (match.get("source"), match.get("row"))
+            if key not in merged or match["similarity"] > merged[key]["similarity"]:
+                merged[key] = dict(match, post_image=int(owner))
+    return sorted(merged.values(), key=lambda match: -match["similarity"])[:k]
+
+
+def _neighbors(text, images, input_ids, attention_mask, classifier, cache, index):
+    # Reuses the embeddings the verdicts came from through ``cache``. The index holds
+    # first-77-token text embeddings, so a long-text scan without an image runs the text
+    # tower once more here; its verdict came from the windows
+    neighbors = {}
+    if text:
+        vector = _text_vector(text, input_ids, attention_mask, classifier, cache)
+        with metrics.stage("neighbors", modality="text"):
+            neighbors["text"] = index.neighbors("text", vector[None])[0]
+    if images:
+        blocks, _ = _image_vectors(images, int(attention_mask.sum()), classifier, cache)
+        with metrics.stage("neighbors", modality="image"):
+            matches = index.neighbors("image", np.concatenate(blocks))
+        owners = np.repeat(np.arange(len(blocks)), _counts(blocks))
+        neighbors["image"] = matches[0] if len(matches) == 1 else _merge_matches(matches, owners)
+    return neighbors
+
+
+def scan_post(text, image_bytes, classifier, processor, cache=None, long_text=None, cascade=None, index=None,
+              on_verdict=None, image_aggregate=DEFAULT_AGGREGATION):
+    """Scan raw upload bytes; either input may be missing.
+
+    Gives the same verdicts as ``predict_text_only`` / ``predict_image_only``,
+    looking each modality up in ``cache`` (an ``EmbeddingCache``) first. With
+    both inputs there is also the ``joint`` verdict, as ``predict_multi_view``
+    gives it. With ``long_text`` set to an aggregation the text verdict covers
+    the whole text, as ``predict_long_text`` does.
+
+    ``image_bytes`` may also be a list of uploads. Their uncached images run
+    as one batch, and the image and joint verdicts are for the whole post,
+    the images' probabilities combined by ``image_aggregate``, as
+    ``predict_images`` does. ``"images"`` then holds each image's own
+    ``image`` and ``joint`` verdicts, in upload order.
+
+    Animated GIFs and video clips are scanned by their keyframes (see
+    ``scanner.frames``), which join the same batch. Their verdicts are
+    combined into the upload's by ``image_aggregate`` too, and ``"frames"``
+    lists the ``time`` and verdicts of each keyframe: at the top level for a
+    single upload, in its ``"images"`` entry otherwise.
+
+    A ``cascade`` (``scanner.cascade.TextCascade``) scores posts without an
+    image first; the text verdict then carries ``"stage"``: ``"cascade"`` when
+    it settled the post, ``"clip"`` when it was left to CLIP.
+
+    With an ``index`` (``scanner.neighbors.NeighborIndex``) and the split
+    towers, ``"neighbors"`` lists the closest already-labelled posts by
+    ``"text"`` and ``"image"``, each with its ``label`` and ``similarity``.
+    Texts the cascade settled have no text embedding and are not looked up;
+    a long text is looked up by its first window. The image matches of a
+    post with several images are the closest over all of them, each with the
+    ``post_image`` it matched.
+
+    With the towers, the text and image passes of a post run at the same time
+    (see ``run_passes``). ``on_verdict(view, verdict)`` is called on the
+    calling thread as each verdict is settled, so a UI can show it before the
+    slower pass is done.
+    """
+    if long_text is not None:
+        check_aggregation(long_text)
+    check_aggregation(image_aggregate)
+    images = [image_bytes] if isinstance(image_bytes, (bytes, bytearray)) else list(image_bytes or ())
+    if index is not None and not classifier.has_embeddings:
+        index = None
+    if index is not None and cache is None:
+        # Holds this scan's embeddings until the index lookup
+        cache = EmbeddingCache()
+    with metrics.stage("scan"):
+        with metrics.stage("tokenize"):
+            input_ids, attention_mask = encode_texts([text or ""], processor)
+        result = {}
+        per_image = [{} for _ in images]
+
+        def settle(view, view_logits, times=None):
+            with metrics.stage("softmax", modality=view):
+                if view != "text":
+                    view_logits = _post_logits(view, view_logits, times, per_image, image_aggregate)
+                label, conf = to_verdicts(view_logits)[0]
+            result[view] = {"label": label, "conf": float(conf)}
+            if on_verdict is not None:
+                on_verdict(view, result[view])
+
+        def settle_early(view, view_logits, times):
+            # A long-text verdict replaces the first window's, so that one waits
+            if view != "text" or long_text is None:
+                settle(view, view_logits, times)
+
+        logits, times = {}, None
+        stage = None
+        if text and not images and cascade is not None:
+            # With an image the text view comes out of the same CLIP run anyway
+            with metrics.stage("cascade"):
+                first_stage, settled = cascade.route([text])
+            stage = "cascade" if settled[0] else "clip"
+            if settled[0]:
+                logits["text"] = first_stage
+        if text and images:
+            logits, times = _multi_view_logits(text, images, input_ids, attention_mask, classifier, cache, settle_early)
+        if text and long_text is not None and stage != "cascade":
+            logits["text"] = _long_text_logits(text, long_text, classifier, processor, cache)
+        elif text and "text" not in logits:
+            logits["text"] = _text_logits(text, input_ids, attention_mask, classifier, cache)
+        if images and "image" not in logits:
+            logits["image"], times = _image_logits(images, int(attention_mask.sum()), classifier, cache)
+
+        for view in VIEWS:
+            if view in logits and view not in result:
+                settle(view, logits[view], times)
+        result = {view: result[view] for view in VIEWS if view in result}
+        if len(images) > 1:
+            result["images"] = per_image
+        elif images and "frames" in per_image[0]:
+            result["frames"] = per_image[0]["frames"]
+        if stage is not None:
+            result["text"]["stage"] = stage
+        if index is not None:
+            result["neighbors"] = _neighbors(text if stage != "cascade" else None, images, input_ids,
+                                             attention_mask, classifier, cache, index)
+    return result
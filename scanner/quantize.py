@@ -0,0 +1,395 @@
+"""Static INT8 (QDQ) quantization with a calibration set, and a report against fp32 and dynamic INT8.
+
+    python -m scanner.quantize --fp32-dir export/ --data dataset.csv --image-root /data --out-dir quantized/
+
+``--fp32-dir`` holds the unquantized export: the joint graph
+(``clip_classifier.onnx``, as notebooks/quantized_onnx.ipynb writes it before
+``quantize_dynamic``) or fp32 towers with ``head.npz`` (``python -m
+scanner.export_towers --no-quantize``). ``--data`` is the training dataframe
+saved as CSV with ``text``, ``label`` and ``image_path`` columns. It is split
+exactly like the training notebook (70/15/15, ``random_state=42``):
+calibration rows come from the train split and the report is computed on the
+test split.
+
+For the joint graph, calibration covers the three input shapes the app sends:
+text with a zero image, an image with zeroed text, and both. Quantization can
+skip whole towers (``--exclude-tower``), operator types
+(``--exclude-op-type``) or nodes matching a regex (``--exclude-node``);
+skipped parts stay fp32.
+
+``dynamic/`` (``quantize_dynamic`` with QUInt8, like the notebook) and
+``static/`` are written under ``--out-dir``, each usable as ``clip_model/``,
+with ``report.json`` and ``report.md`` comparing size, latency, throughput,
+test accuracy per view and verdict agreement with fp32. The run fails when the
+static model loses more than ``--max-accuracy-drop`` accuracy on any view, or
+its verdicts match fp32 on fewer than ``--min-agreement`` of the test rows.
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import onnx
+from onnxruntime.quantization import (
+    CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_dynamic, quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from PIL import Image
+
+from scanner.model import (
+    FULL_MODEL_FILE, HEAD_FILE, IMAGE_SIZE, IMAGE_TOWER_FILE, TEXT_TOWER_FILE, FullGraphClassifier,
+    VIEWS, TowerClassifier, create_session, has_towers, softmax, zero_embeddings, zero_pixel_values,
+)
+from scanner.preprocess import open_image, preprocess_images
+from scanner.tokenizer import ClipTokenizer
+
+FP32_MODEL_FILE = "clip_classifier.onnx"
+
+# Node name prefixes torch.onnx.export gives each encoder of CLIPClassifier
+TOWER_NODE_PREFIXES = {
+    "text": ("/clip/text_model/", "/clip/text_projection"),
+    "image": ("/clip/vision_model/", "/clip/visual_projection"),
+}
+TOWER_FILES = {"text": TEXT_TOWER_FILE, "image": IMAGE_TOWER_FILE}
+
+QUANT_TYPES = {"int8": QuantType.QInt8, "uint8": QuantType.QUInt8}
+CALIBRATION_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "entropy": CalibrationMethod.Entropy,
+    "percentile": CalibrationMethod.Percentile,
+}
+
+
+def read_dataset(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return [{"text": row.get("text") or "", "label": int(float(row["label"])), "image_path": row.get("image_path")}
+                for row in csv.DictReader(f)]
+
+
+def _train_test_split(indices, test_size, seed):
+    # sklearn's train_test_split: one permutation, the first ceil(n * test_size) are the test rows
+    n_test = math.ceil(test_size * len(indices))
+    permutation = np.random.RandomState(seed).permutation(len(indices))
+    return [indices[i] for i in permutation[n_test:]], [indices[i] for i in permutation[:n_test]]
+
+
+def notebook_split(count, seed=42):
+    """Train/val/test row indices as the training notebook draws them."""
+    train, temp = _train_test_split(list(range(count)), 0.3, seed)
+    val, test = _train_test_split(temp, 0.5, seed)
+    return train, val, test
+
+
+def load_image(path, image_root):
+    if image_root and not os.path.isabs(path):
+        path = os.path.join(image_root, path)
+    try:
+        return open_image(path)
+    except (OSError, ValueError):
+        # The training dataset substitutes a black image for unreadable files
+        return Image.new("RGB", (IMAGE_SIZE, IMAGE_SIZE))
+
+
+def load_batch(rows, tokenizer, image_root):
+    input_ids, attention_mask = tokenizer([row["text"] for row in rows])
+    pixel_values = preprocess_images([load_image(row["image_path"], image_root) for row in rows])
+    labels = np.array([row["label"] for row in rows], dtype=np.int64)
+    return input_ids, attention_mask, pixel_values, labels
+
+
+def batches(rows, tokenizer, image_root, batch_size):
+    for start in range(0, len(rows), batch_size):
+        yield load_batch(rows[start:start + batch_size], tokenizer, image_root)
+
+
+def calibration_feeds(input_names, rows, tokenizer, image_root, batch_size):
+    for input_ids, attention_mask, pixel_values, _ in batches(rows, tokenizer, image_root, batch_size):
+        if input_names == {"pixel_values"}:
+            yield {"pixel_values": pixel_values}
+        elif "pixel_values" not in input_names:
+            yield {"input_ids": input_ids, "attention_mask": attention_mask}
+        else:
+            # The joint graph sees both inputs, text with a zero image, and an
+            # image with zeroed text as long as the scanned text
+            yield {"input_ids": input_ids, "attention_mask": attention_mask, "pixel_values": pixel_values}
+            yield {"input_ids": input_ids, "attention_mask": attention_mask,
+                   "pixel_values": zero_pixel_values(len(input_ids))}
+            seq_lens = attention_mask.sum(axis=1)
+            for length in np.unique(seq_lens):
+                rows_with_length = seq_lens == length
+                zeros = np.zeros((int(rows_with_length.sum()), int(length)), dtype=np.int64)
+                yield {"input_ids": zeros, "attention_mask": zeros, "pixel_values": pixel_values[rows_with_length]}
+
+
+class CalibrationReader(CalibrationDataReader):
+    def __init__(self, feeds):
+        self.feeds = iter(feeds)
+
+    def get_next(self):
+        return next(self.feeds, None)
+
+
+def excluded_nodes(model_path, towers, op_types, patterns):
+    prefixes = tuple(prefix for tower in towers for prefix in TOWER_NODE_PREFIXES[tower])
+    regexes = [re.compile(pattern) for pattern in patterns]
+    return [node.name for node in onnx.load(model_path, load_external_data=False).graph.node
+            if (prefixes and node.name.startswith(prefixes)) or node.op_type in op_types
+            or any(regex.search(node.name) for regex in regexes)]
+
+
+def quantize_graph_static(source, target, reader, args, towers=()):
+    with tempfile.TemporaryDirectory() as tmp:
+        prepared = os.path.join(tmp, "prepared.onnx")
+        # Shape inference and graph cleanup help the quantizer place QDQ pairs;
+        # symbolic inference does not get through every exported graph
+        for skip_symbolic_shape in (False, True):
+            try:
+                quant_pre_process(source, prepared, skip_symbolic_shape=skip_symbolic_shape)
+                break
+            except Exception as e:
+                print(f"Pre-processing {os.path.basename(source)} failed ({e})", file=sys.stderr)
+        else:
+            prepared = source
+        nodes_to_exclude = excluded_nodes(prepared, towers, args.exclude_op_type, args.exclude_node)
+        extra_options = {}
+        if args.method == "minmax":
+            # Bounds memory: ranges are folded in every 64 calibration batches
+            extra_options["CalibMaxIntermediateOutputs"] = 64
+        try:
+            quantize_static(
+                prepared,
+                target,
+                reader,
+                quant_format=QuantFormat.QDQ,
+                per_channel=args.per_channel,
+                activation_type=QUANT_TYPES[args.activation_type],
+                weight_type=QUANT_TYPES[args.weight_type],
+                nodes_to_exclude=nodes_to_exclude,
+                calibrate_method=CALIBRATION_METHODS[args.method],
+                extra_options=extra_options,
+            )
+        except ValueError as e:
+            # Histogram methods cannot bin the -inf entries of the text encoder's attention masks
+            raise SystemExit(f"{args.method} calibration of {os.path.basename(source)} failed ({e}); "
+                             "try --method minmax")
+    return len(nodes_to_exclude)
+
+
+def write_head(fp32_dir, out_dir):
+    # fc weights are not quantized; the zero-input embeddings must come from
+    # the quantized towers they stand in for
+    with np.load(os.path.join(fp32_dir, HEAD_FILE)) as head:
+        weight, bias = head["weight"], head["bias"]
+    zero_text, zero_image = zero_embeddings(out_dir)
+    np.savez(os.path.join(out_dir, HEAD_FILE), weight=weight, bias=bias,
+             zero_text_embeds=zero_text, zero_image_embeds=zero_image)
+
+
+def build_dynamic(fp32_dir, out_dir, towers):
+    os.makedirs(out_dir, exist_ok=True)
+    pairs = [(name, name) for name in TOWER_FILES.values()] if towers else [(FP32_MODEL_FILE, FULL_MODEL_FILE)]
+    for source, target in pairs:
+        quantize_dynamic(os.path.join(fp32_dir, source), os.path.join(out_dir, target), weight_type=QuantType.QUInt8)
+    if towers:
+        write_head(fp32_dir, out_dir)
+
+
+def build_static(fp32_dir, out_dir, towers, calibration_rows, tokenizer, args):
+    os.makedirs(out_dir, exist_ok=True)
+    if not towers:
+        source = os.path.join(fp32_dir, FP32_MODEL_FILE)
+        feeds = calibration_feeds({"input_ids", "attention_mask", "pixel_values"}, calibration_rows, tokenizer,
+                                  args.image_root, args.calibration_batch_size)
+        skipped = quantize_graph_static(source, os.path.join(out_dir, FULL_MODEL_FILE), CalibrationReader(feeds),
+                                        args, args.exclude_tower)
+        print(f"{FULL_MODEL_FILE}: {skipped} nodes left in fp32", file=sys.stderr)
+        return
+
+    for tower, name in TOWER_FILES.items():
+        source = os.path.join(fp32_dir, name)
+        if tower in args.exclude_tower:
+            shutil.copyfile(source, os.path.join(out_dir, name))
+            print(f"{name}: excluded, kept in fp32", file=sys.stderr)
+            continue
+        input_names = {"pixel_values"} if tower == "image" else {"input_ids", "attention_mask"}
+        feeds = calibration_feeds(input_names, calibration_rows, tokenizer, args.image_root, args.calibration_batch_size)
+        skipped = quantize_graph_static(source, os.path.join(out_dir, name), CalibrationReader(feeds), args)
+        print(f"{name}: {skipped} nodes left in fp32", file=sys.stderr)
+    write_head(fp32_dir, out_dir)
+
+
+def load_variant(model_dir, towers, fp32=False):
+    if towers:
+        with np.load(os.path.join(model_dir, HEAD_FILE)) as head:
+            return TowerClassifier(create_session(os.path.join(model_dir, TEXT_TOWER_FILE)),
+                                   create_session(os.path.join(model_dir, IMAGE_TOWER_FILE)), dict(head))
+    return FullGraphClassifier(create_session(os.path.join(model_dir, FP32_MODEL_FILE if fp32 else FULL_MODEL_FILE)))
+
+
+def model_size_mb(model_dir, towers, fp32=False):
+    names = list(TOWER_FILES.values()) if towers else [FP32_MODEL_FILE if fp32 else FULL_MODEL_FILE]
+    return sum(os.path.getsize(os.path.join(model_dir, name)) for name in names) / (1024 * 1024)
+
+
+def view_logits(classifier, input_ids, attention_mask, pixel_values):
+    return {
+        "text": classifier.text_logits(input_ids, attention_mask),
+        "image": classifier.image_logits(pixel_values, attention_mask.sum(axis=1)),
+        "joint": classifier.joint_logits(input_ids, attention_mask, pixel_values),
+    }
+
+
+def evaluate(variants, rows, tokenizer, args):
+    probs = {name: {view: [] for view in VIEWS} for name in variants}
+    labels = []
+    for input_ids, attention_mask, pixel_values, batch_labels in batches(rows, tokenizer, args.image_root, args.batch_size):
+        labels.append(batch_labels)
+        for name, classifier in variants.items():
+            for view, logits in view_logits(classifier, input_ids, attention_mask, pixel_values).items():
+                probs[name][view].append(softmax(logits))
+    labels = np.concatenate(labels)
+    probs = {name: {view: np.concatenate(chunks) for view, chunks in views.items()} for name, views in probs.items()}
+
+    metrics = {}
+    for name, views in probs.items():
+        metrics[name] = {}
+        for view, view_probs in views.items():
+            reference = probs["fp32"][view]
+            metrics[name][view] = {
+                "accuracy": float((view_probs.argmax(axis=1) == labels).mean()),
+                "agreement_with_fp32": float((view_probs.argmax(axis=1) == reference.argmax(axis=1)).mean()),
+                "max_prob_diff_vs_fp32": float(np.abs(view_probs - reference).max()),
+            }
+    return metrics
+
+
+def benchmark(classifier, input_ids, attention_mask, pixel_values, batch_size):
+    seq_lens = attention_mask.sum(axis=1)
+    # One post at a time, a text pass and an image pass, as scan_post runs them
+    classifier.text_logits(input_ids[:1], attention_mask[:1])
+    classifier.image_logits(pixel_values[:1], seq_lens[:1])
+    timings = []
+    for i in range(len(input_ids)):
+        start = time.perf_counter()
+        classifier.text_logits(input_ids[i:i + 1], attention_mask[i:i + 1])
+        classifier.image_logits(pixel_values[i:i + 1], seq_lens[i:i + 1])
+        timings.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for offset in range(0, len(input_ids), batch_size):
+        rows = slice(offset, offset + batch_size)
+        classifier.text_logits(input_ids[rows], attention_mask[rows])
+        classifier.image_logits(pixel_values[rows], seq_lens[rows])
+    elapsed = time.perf_counter() - start
+    return {"latency_p50_ms": statistics.median(timings), "throughput_posts_per_s": len(input_ids) / elapsed}
+
+
+def write_report(out_dir, report):
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    lines = [
+        "| model | size (MB) | latency p50 (ms) | throughput (posts/s) | "
+        + " | ".join(f"{view} acc | {view} agree" for view in VIEWS) + " |",
+        "|---" * (4 + 2 * len(VIEWS)) + "|",
+    ]
+    for name, result in report["models"].items():
+        cells = [name, f"{result['size_mb']:.1f}", f"{result['latency_p50_ms']:.1f}", f"{result['throughput_posts_per_s']:.1f}"]
+        for view in VIEWS:
+            cells += [f"{result[view]['accuracy']:.4f}", f"{result[view]['agreement_with_fp32']:.4f}"]
+        lines.append("| " + " | ".join(cells) + " |")
+    table = "\n".join(lines)
+    with open(os.path.join(out_dir, "report.md"), "w") as f:
+        f.write(f"Test rows: {report['test_rows']}, calibration rows: {report['calibration_rows']}\n\n{table}\n")
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fp32-dir", required=True, help=f"{FP32_MODEL_FILE}, or fp32 towers with {HEAD_FILE}")
+    parser.add_argument("--data", required=True, help="training dataframe as CSV (text, label, image_path)")
+    parser.add_argument("--image-root", help="prefix for relative image paths")
+    parser.add_argument("--processor", default="clip_processor", help="directory with tokenizer.json")
+    parser.add_argument("--out-dir", default="quantized")
+    parser.add_argument("--calibration-size", type=int, default=256, help="train rows used for calibration")
+    parser.add_argument("--calibration-batch-size", type=int, default=8)
+    parser.add_argument("--method", choices=list(CALIBRATION_METHODS), default="minmax")
+    parser.add_argument("--per-channel", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--activation-type", choices=list(QUANT_TYPES), default="int8")
+    parser.add_argument("--weight-type", choices=list(QUANT_TYPES), default="int8")
+    parser.add_argument("--exclude-tower", action="append", choices=list(TOWER_FILES), default=[],
+                        help="leave a whole encoder in fp32 (repeatable)")
+    parser.add_argument("--exclude-op-type", action="append", default=[], help="e.g. Softmax (repeatable)")
+    parser.add_argument("--exclude-node", action="append", default=[], help="regex on node names (repeatable)")
+    parser.add_argument("--eval-limit", type=int, help="only evaluate the first N test rows")
+    parser.add_argument("--benchmark-rows", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01,
+                        help="fail when static INT8 loses more accuracy than this on any view")
+    parser.add_argument("--min-agreement", type=float, default=0.98,
+                        help="fail when static INT8 verdicts match fp32 on fewer test rows than this")
+    parser.add_argument("--seed", type=int, default=42, help="split seed of the training notebook")
+    args = parser.parse_args()
+
+    towers = has_towers(args.fp32_dir)
+    if not towers and not os.path.exists(os.path.join(args.fp32_dir, FP32_MODEL_FILE)):
+        raise SystemExit(f"Neither fp32 towers nor {FP32_MODEL_FILE} found in {args.fp32_dir}")
+    tokenizer = ClipTokenizer.from_dir(args.processor)
+    rows = read_dataset(args.data)
+    train, _, test = notebook_split(len(rows), args.seed)
+    rng = np.random.default_rng(args.seed)
+    calibration_rows = [rows[i] for i in rng.permutation(train)[:args.calibration_size]]
+    test_rows = [rows[i] for i in test[:args.eval_limit]]
+
+    dynamic_dir = os.path.join(args.out_dir, "dynamic")
+    static_dir = os.path.join(args.out_dir, "static")
+    print("Quantizing dynamically", file=sys.stderr)
+    build_dynamic(args.fp32_dir, dynamic_dir, towers)
+    print(f"Quantizing statically with {len(calibration_rows)} calibration rows", file=sys.stderr)
+    build_static(args.fp32_dir, static_dir, towers, calibration_rows, tokenizer, args)
+
+    variants = {
+        "fp32": load_variant(args.fp32_dir, towers, fp32=True),
+        "dynamic_int8": load_variant(dynamic_dir, towers),
+        "static_int8": load_variant(static_dir, towers),
+    }
+    sizes = {"fp32": model_size_mb(args.fp32_dir, towers, fp32=True),
+             "dynamic_int8": model_size_mb(dynamic_dir, towers), "static_int8": model_size_mb(static_dir, towers)}
+
+    print(f"Evaluating on {len(test_rows)} test rows", file=sys.stderr)
+    metrics = evaluate(variants, test_rows, tokenizer, args)
+    input_ids, attention_mask, pixel_values, _ = load_batch(test_rows[:args.benchmark_rows], tokenizer, args.image_root)
+    report = {
+        "layout": "towers" if towers else "joint",
+        "test_rows": len(test_rows),
+        "calibration_rows": len(calibration_rows),
+        "settings": {key: getattr(args, key) for key in (
+            "method", "per_channel", "activation_type", "weight_type", "exclude_tower", "exclude_op_type", "exclude_node")},
+        "models": {},
+    }
+    for name, classifier in variants.items():
+        report["models"][name] = {"size_mb": sizes[name], **benchmark(classifier, input_ids, attention_mask,
+                                                                      pixel_values, args.batch_size), **metrics[name]}
+
+    static = report["models"]["static_int8"]
+    drops = {view: report["models"]["fp32"][view]["accuracy"] - static[view]["accuracy"] for view in VIEWS}
+    report["static_accuracy_drop"] = drops
+    failures = [f"{view} accuracy {-drop:+.2%}" for view, drop in drops.items() if drop > args.max_accuracy_drop]
+    failures += [f"{view} agreement with fp32 {static[view]['agreement_with_fp32']:.2%}" for view in VIEWS
+                 if static[view]["agreement_with_fp32"] < args.min_agreement]
+    report["passed"] = not failures
+    print(write_report(args.out_dir, report))
+    if failures:
+        raise SystemExit("Static INT8 verdicts degraded: " + ", ".join(failures)
+                         + f". Try --exclude-tower / --exclude-op-type, or keep {dynamic_dir}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Several variants of the classifier side by side, routed by latency budget.
+
+    python -m scanner.registry --base-dir . --data dataset.csv --image-root /data \\
+        --add fp32=export/ --add static_int8=quantized/static
+
+``clip_model/`` is the ``default`` variant; more live under
+``clip_models/<name>/`` (or ``SCANNER_MODELS_DIR``), each laid out like
+``clip_model/`` with the joint graph or the split towers: an fp32 export, the
+``dynamic/`` and ``static/`` models ``scanner.quantize`` writes, or any cheaper
+export. The command above copies the ``--add`` directories in and measures
+every variant on the notebook's test split on this host, writing its
+``variant.json``: p50 latency of one post (a text pass and an image pass, one
+at a time, as ``scanner.quantize`` times them) and accuracy per view. The
+numbers are tied to the model files' fingerprint; a variant whose files
+changed since is treated as unmeasured until the command is run again.
+
+Routing: a request may carry a latency budget in milliseconds. A variant is
+expected to answer in its p50 latency times the number of micro-batches
+already queued on the host, ``1 + in_flight // max_batch_size``, counting
+every variant's requests since they share the cores. The router picks the
+most accurate variant (mean accuracy over the views) expected to fit the
+budget. When none fits because the host is saturated it picks the one
+expected to answer first: a slightly cheaper verdict beats a timeout. When
+no variant fits the budget even on an idle host (or none is measured) a
+cheaper one would not help, so the default serves it. Requests without a
+budget use ``SCANNER_LATENCY_BUDGET_MS`` when set, else the default variant.
+``SCANNER_MODEL_VARIANTS`` (comma-separated names) limits which variants are
+loaded; each loaded variant holds its own sessions in memory.
+"""
+import argparse
+import collections
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import threading
+
+from scanner.cache import EmbeddingCache
+from scanner.model import VIEWS, load_classifier, model_fingerprint, softmax
+from scanner.pipeline import load_model
+from scanner.tokenizer import ClipTokenizer
+
+DEFAULT_VARIANT = "default"
+MODELS_DIR = "clip_models"
+VARIANT_FILE = "variant.json"
+MODEL_EXTENSIONS = (".onnx", ".npz", ".data")
+
+
+def models_dir(base_dir):
+    return os.environ.get("SCANNER_MODELS_DIR") or os.path.join(base_dir, MODELS_DIR)
+
+
+def variant_dirs(base_dir):
+    """``{name: model_dir}`` of every variant, the default first."""
+    dirs = {DEFAULT_VARIANT: os.path.join(base_dir, "clip_model")}
+    root = models_dir(base_dir)
+    if os.path.isdir(root):
+        for name in sorted(os.listdir(root)):
+            if os.path.isdir(os.path.join(root, name)) and name != DEFAULT_VARIANT:
+                dirs[name] = os.path.join(root, name)
+    return dirs
+
+
+def read_measurements(model_dir):
+    """The ``variant.json`` of ``model_dir``, or ``{}`` when there is none or the model changed since."""
+    path = os.path.join(model_dir, VARIANT_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        measurements = json.load(f)
+    if measurements.get("fingerprint") != model_fingerprint(model_dir):
+        print(f"Ignoring {path}: the model changed since it was measured; run python -m scanner.registry",
+              file=sys.stderr)
+        return {}
+    return measurements
+
+
+class ModelVariant:
+    """One loaded classifier with what it was measured at."""
+
+    def __init__(self, name, model_dir, classifier, latency_ms=None, accuracy=None, cache=None):
+        self.name = name
+        self.model_dir = model_dir
+        self.classifier = classifier
+        self.latency_ms = latency_ms
+        self.accuracy = accuracy or {}
+        self.cache = cache
+        self.version = model_fingerprint(model_dir) if model_dir else None
+
+    @property
+    def score(self):
+        # Unmeasured variants rank below every measured one
+        return statistics.mean(self.accuracy.values()) if self.accuracy else -1.0
+
+
+class ModelRegistry:
+    """Loaded variants by name, and the router choosing one per request."""
+
+    def __init__(self, variants, default=DEFAULT_VARIANT, default_budget_ms=None):
+        if default not in variants:
+            raise ValueError(f"No {default!r} variant among: {', '.join(variants)}")
+        self.variants = variants
+        self.default = variants[default]
+        self.default_budget_ms = default_budget_ms
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def _expected_ms(self, variant):
+        if variant.latency_ms is None:
+            return float("inf")
+        capacity = getattr(variant.classifier, "max_batch_size", 1)
+        return variant.latency_ms * (1 + self._in_flight // capacity)
+
+    def _pick(self, budget_ms):
+        if budget_ms is None or len(self.variants) == 1:
+            return self.default
+        fitting = [variant for variant in self.variants.values() if self._expected_ms(variant) <= budget_ms]
+        if fitting:
+            return max(fitting, key=lambda variant: (variant.score, variant is self.default))
+        variants = self.variants.values()
+        # Out of reach even on an idle host
+        if not any(variant.latency_ms is not None and variant.latency_ms <= budget_ms for variant in variants):
+            return self.default
+        return min(self.variants.values(), key=lambda variant: (self._expected_ms(variant), -variant.score))
+
+    def route(self, budget_ms=None):
+        """The variant to serve a request with ``budget_ms``, counted in flight until ``release``."""
+        if budget_ms is None:
+            budget_ms = self.default_budget_ms
+        with self._lock:
+            variant = self._pick(budget_ms)
+            self._in_flight += 1
+            self._counters[variant.name] += 1
+            if variant is not self.default:
+                self._counters["rerouted"] += 1
+        return variant
+
+    def release(self, variant):
+        with self._lock:
+            self._in_flight -= 1
+
+    @contextlib.contextmanager
+    def serving(self, budget_ms=None):
+        variant = self.route(budget_ms)
+        try:
+            yield variant
+        finally:
+            self.release(variant)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            in_flight = self._in_flight
+        return {
+            "in_flight": in_flight,
+            "rerouted": counters.get("rerouted", 0),
+            "variants": {name: {"served": counters.get(name, 0), "latency_ms": variant.latency_ms,
+                                "accuracy": variant.accuracy or None}
+                         for name, variant in self.variants.items()},
+        }
+
+
+def load_registry(base_dir, max_batch_size=None, max_wait_ms=None, concurrent=None, cache=True):
+    """Load the tokenizer and every variant (see ``variant_dirs``) into a ``ModelRegistry``.
+
+    Variants other than the default get an in-memory cache of their own when
+    ``cache`` is true; the default one uses the cache the caller opens.
+    """
+    processor = ClipTokenizer.from_dir(os.path.join(base_dir, "clip_processor"))
+    wanted = os.environ.get("SCANNER_MODEL_VARIANTS")
+    wanted = {name.strip() for name in wanted.split(",")} | {DEFAULT_VARIANT} if wanted else None
+    variants = {}
+    for name, model_dir in variant_dirs(base_dir).items():
+        if wanted is not None and name not in wanted:
+            continue
+        measurements = read_measurements(model_dir)
+        variant_cache = None
+        if cache and name != DEFAULT_VARIANT:
+            variant_cache = EmbeddingCache(namespace=model_fingerprint(model_dir))
+        variants[name] = ModelVariant(name, model_dir, load_model(model_dir, max_batch_size, max_wait_ms, concurrent),
+                                      measurements.get("latency_ms"), measurements.get("accuracy"), variant_cache)
+    budget = os.environ.get("SCANNER_LATENCY_BUDGET_MS")
+    return ModelRegistry(variants, default_budget_ms=float(budget) if budget else None), processor
+
+
+def add_variant(base_dir, name, source_dir):
+    target = os.path.join(models_dir(base_dir), name)
+    os.makedirs(target, exist_ok=True)
+    for file_name in os.listdir(source_dir):
+        if file_name.endswith(MODEL_EXTENSIONS):
+            shutil.copy2(os.path.join(source_dir, file_name), os.path.join(target, file_name))
+    return target
+
+
+def measure(model_dir, rows, tokenizer, image_root, batch_size, latency_rows):
+    from scanner.quantize import batches, benchmark, load_batch, view_logits
+
+    classifier = load_classifier(model_dir)
+    correct = {view: 0 for view in VIEWS}
+    for input_ids, attention_mask, pixel_values, labels in batches(rows, tokenizer, image_root, batch_size):
+        for view, logits in view_logits(classifier, input_ids, attention_mask, pixel_values).items():
+            correct[view] += int((softmax(logits).argmax(axis=1) == labels).sum())
+    input_ids, attention_mask, pixel_values, _ = load_batch(rows[:latency_rows], tokenizer, image_root)
+    timing = benchmark(classifier, input_ids, attention_mask, pixel_values, batch_size)
+    return {
+        "latency_ms": round(timing["latency_p50_ms"], 3),
+        "throughput_posts_per_s": round(timing["throughput_posts_per_s"], 2),
+        "accuracy": {view: count / len(rows) for view, count in correct.items()},
+        "test_rows": len(rows),
+        "fingerprint": model_fingerprint(model_dir),
+    }
+
+
+def main():
+    from scanner.quantize import notebook_split, read_dataset
+
+    parser = argparse.ArgumentParser(description="Register classifier variants and measure their latency and accuracy")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/, clip_model/ and clip_models/")
+    parser.add_argument("--add", action="append", default=[], metavar="NAME=DIR",
+                        help="copy the model files in DIR into clip_models/NAME (repeatable)")
+    parser.add_argument("--data", required=True, help="training dataframe as CSV (text, label, image_path)")
+    parser.add_argument("--image-root", help="prefix for relative image paths")
+    parser.add_argument("--eval-limit", type=int, help="only evaluate the first N test rows")
+    parser.add_argument("--latency-rows", type=int, default=64, help="test rows timed one post at a time")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42, help="split seed of the training notebook")
+    args = parser.parse_args()
+
+    for spec in args.add:
+        name, _, source_dir = spec.partition("=")
+        if not name or not source_dir or name == DEFAULT_VARIANT:
+            parser.error(f"--add takes NAME=DIR with a name other than {DEFAULT_VARIANT!r}: {spec}")
+        print(f"Added {add_variant(args.base_dir, name, source_dir)}", file=sys.stderr)
+
+    tokenizer = ClipTokenizer.from_dir(os.path.join(args.base_dir, "clip_processor"))
+    rows = read_dataset(args.data)
+    _, _, test = notebook_split(len(rows), args.seed)
+    test_rows = [rows[i] for i in test[:args.eval_limit]]
+    print(f"{'variant':16} {'p50 ms':>8} {'posts/s':>8} " + " ".join(f"{view + ' acc':>9}" for view in VIEWS))
+    for name, model_dir in variant_dirs(args.base_dir).items():
+        measurements = measure(model_dir, test_rows, tokenizer, args.image_root, args.batch_size, args.latency_rows)
+        with open(os.path.join(model_dir, VARIANT_FILE), "w", encoding="utf-8") as f:
+            json.dump(measurements, f, indent=2)
+        print(f"{name:16} {measurements['latency_ms']:8.2f} {measurements['throughput_posts_per_s']:8.1f} "
+              + " ".join(f"{measurements['accuracy'][view]:9.2%}" for view in VIEWS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""Headless HTTP scanning service.
+
+    python -m scanner.service --port 8080
+
+Endpoints:
+
+* ``GET /health``
+* ``GET /stats`` - embedding cache and tokenizer memo hit/miss counters, the share of texts
+  the first-stage cascade settled without CLIP, the size of the
+  nearest-neighbour index, the posts each model variant served and the
+  prediction store's written and queued rows
+* ``GET /metrics`` - per-stage latency histograms in the Prometheus text format
+* ``POST /scan`` - multipart form with a ``text`` field and/or ``image``
+  files. Returns ``{"text": {"label", "conf"}, "image": {...}}`` for the
+  modalities that were sent, plus ``"joint"`` (text and image read
+  together) when both were. A post with several ``image`` files gets
+  post-level ``image`` and ``joint`` verdicts and one pair per image under
+  ``"images"``; an optional ``image_aggregate`` field (``mean``, ``max`` or
+  ``attention``) sets how they are combined. An animated GIF or a short
+  video clip is scanned by its keyframes, listed under ``"frames"``. With a trained cascade (``scanner.cascade``) the
+  text verdict of a post without an image also has ``"stage"``; with an index
+  (``scanner.neighbors``) ``"neighbors"`` lists the closest labelled posts. An optional ``long_text`` field (``mean``,
+  ``max`` or ``attention``) scores the whole text in sliding windows.
+  An optional ``latency_budget_ms`` lets the router serve the post with a
+  cheaper model variant when the host is busy (``scanner.registry``); with
+  more than one variant registered, ``"model"`` names the one used.
+* ``POST /explain`` - the same form with a ``text`` field and/or one still
+  ``image``, plus an optional ``grid`` (cells per side, default 7). Returns
+  the verdicts with per-token importances and image heatmaps
+  (``scanner.explain``).
+* ``POST /scan/bulk`` - newline-delimited JSON, one post per line:
+  ``{"id": ..., "text": ..., "image": "<base64 bytes>"}`` or
+  ``{"id": ..., "text": ..., "image_path": "..."}``, or ``"images"`` /
+  ``"image_paths"`` lists for several images, each optionally with
+  ``"long_text"``, ``"image_aggregate"`` and ``"latency_budget_ms"``. Verdicts stream back as
+  NDJSON in completion order, tagged with the line's ``index`` and ``id``.
+  At most ``--max-in-flight`` posts are held at once, so the request body is
+  never buffered whole. ``image_path`` is only accepted under ``--image-root``.
+
+Every verdict is also queued for the prediction store (``scanner.store``),
+whose background writer persists it without delaying the response.
+
+Everything runs in one asyncio process; decoding and inference run on a
+thread pool so the event loop only moves bytes. The app is built by
+``create_app`` from an already loaded classifier and processor, so it can be
+driven in-process with ``aiohttp.test_utils`` without any external service.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from PIL import Image, UnidentifiedImageError
+
+from scanner.cache import open_cache
+from scanner.cascade import load_cascade
+from scanner.explain import DEFAULT_GRID, MAX_GRID, explain
+from scanner.longtext import AGGREGATIONS, DEFAULT_AGGREGATION
+from scanner.metrics import metrics
+from scanner.neighbors import load_index
+from scanner.pipeline import decode_image, scan_post
+from scanner.registry import DEFAULT_VARIANT, ModelRegistry, ModelVariant, load_registry
+from scanner.store import open_store
+
+DEFAULT_MAX_IN_FLIGHT = 32
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_POST_IMAGES = 16
+# A multipart post may carry every image at full size, plus the text fields
+MAX_FORM_BYTES = MAX_POST_IMAGES * MAX_IMAGE_BYTES + 1024 * 1024
+# Base64 inflates images by a third; leave room for the text and the JSON keys
+MAX_LINE_BYTES = MAX_IMAGE_BYTES * 4 // 3 + 1024 * 1024
+
+CLASSIFIER = web.AppKey("classifier", object)
+PROCESSOR = web.AppKey("processor", object)
+EXECUTOR = web.AppKey("executor", ThreadPoolExecutor)
+IMAGE_ROOT = web.AppKey("image_root", object)
+MAX_IN_FLIGHT = web.AppKey("max_in_flight", int)
+CACHE = web.AppKey("cache", object)
+CASCADE = web.AppKey("cascade", object)
+NEIGHBORS = web.AppKey("neighbors", object)
+REGISTRY = web.AppKey("registry", ModelRegistry)
+STORE = web.AppKey("store", object)
+
+
+class BadInput(ValueError):
+    pass
+
+
+def scan_or_reject(text, image_bytes, classifier, processor, cache, long_text=None, cascade=None, index=None,
+                   image_aggregate=DEFAULT_AGGREGATION):
+    """Blocking scan of one post; runs on the executor."""
+    try:
+        return scan_post(text, image_bytes, classifier, processor, cache, long_text, cascade, index,
+                         image_aggregate=image_aggregate)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise BadInput(f"Cannot open image: {e}")
+
+
+def parse_budget(value):
+    if value is None or value == "":
+        return None
+    try:
+        budget_ms = float(value)
+    except (TypeError, ValueError):
+        budget_ms = 0
+    if not budget_ms > 0:
+        raise BadInput("latency_budget_ms must be a positive number of milliseconds")
+    return budget_ms
+
+
+def check_image_count(images):
+    if len(images) > MAX_POST_IMAGES:
+        raise BadInput(f"At most {MAX_POST_IMAGES} images per post")
+
+
+def read_uploads(form):
+    """The bytes of every ``image`` file in a multipart form, each at most ``MAX_IMAGE_BYTES``."""
+    images = []
+    for image in form.getall("image", []):
+        if not isinstance(image, web.FileField):
+            continue
+        data = image.file.read(MAX_IMAGE_BYTES + 1)
+        if len(data) > MAX_IMAGE_BYTES:
+            raise BadInput(f"Image larger than {MAX_IMAGE_BYTES} bytes: {image.filename}")
+        images.append(data)
+    return images
+
+
+async def run_scan(app, text, image_bytes, long_text=None, image_aggregate=None, budget_ms=None):
+    """Scan one post on the executor with the variant the router picks for ``budget_ms``;
+    ``image_bytes`` is one image, a list of them or None."""
+    if isinstance(image_bytes, list) and not image_bytes:
+        image_bytes = None
+    if not (text and text.strip()) and image_bytes is None:
+        raise BadInput("Send news text, an image or both.")
+    if long_text is not None and long_text not in AGGREGATIONS:
+        raise BadInput(f"long_text must be one of: {', '.join(AGGREGATIONS)}")
+    if image_aggregate is not None and image_aggregate not in AGGREGATIONS:
+        raise BadInput(f"image_aggregate must be one of: {', '.join(AGGREGATIONS)}")
+    if isinstance(image_bytes, list):
+        check_image_count(image_bytes)
+    budget_ms = parse_budget(budget_ms)
+    registry = app[REGISTRY]
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    with registry.serving(budget_ms) as variant:
+        # The cache and the index hold the default model's embeddings
+        default = variant is registry.default
+        result = await loop.run_in_executor(
+            app[EXECUTOR], scan_or_reject, text, image_bytes, variant.classifier, app[PROCESSOR],
+            app[CACHE] if default else variant.cache, long_text, app[CASCADE], app[NEIGHBORS] if default else None,
+            image_aggregate or DEFAULT_AGGREGATION)
+    if len(registry.variants) > 1:
+        result["model"] = variant.name
+    if app[STORE] is not None:
+        # The writer reads the result later, so it is not changed after this
+        app[STORE].record(result, text, image_bytes, variant.name, variant.version,
+                          (time.perf_counter() - start) * 1000, source="service")
+    return result
+
+
+def explain_or_reject(text, image_bytes, classifier, processor, grid):
+    """Blocking attribution of one post; runs on the executor."""
+    try:
+        image = decode_image(image_bytes) if image_bytes is not None else None
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise BadInput(f"Cannot open image: {e}")
+    return explain(text, image, classifier, processor, grid)
+
+
+def read_image_path(app, path):
+    root = app[IMAGE_ROOT]
+    if root is None:
+        raise BadInput("image_path is disabled; start the service with --image-root.")
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([full_path, root]) != root:
+        raise BadInput(f"image_path escapes the image root: {path}")
+    if os.path.getsize(full_path) > MAX_IMAGE_BYTES:
+        raise BadInput(f"Image larger than {MAX_IMAGE_BYTES} bytes: {path}")
+    with open(full_path, "rb") as f:
+        return f.read()
+
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+
+async def stats(request):
+    cache = request.app[CACHE]
+    cascade = request.app[CASCADE]
+    index = request.app[NEIGHBORS]
+    store = request.app[STORE]
+    return web.json_response({"cache": cache.stats() if cache is not None else None,
+                              "tokenizer": request.app[PROCESSOR].stats(),
+                              "cascade": cascade.stats() if cascade is not None else None,
+                              "neighbors": index.stats() if index is not None else None,
+                              "models": request.app[REGISTRY].stats(),
+                              "store": store.stats() if store is not None else None})
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=metrics.render_prometheus().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def scan_single(request):
+    form = await request.post()
+    text = form.get("text")
+    try:
+        images = read_uploads(form)
+        # A single upload keeps the single-image response
+        image_bytes = images[0] if len(images) == 1 else images
+        result = await run_scan(request.app, text, image_bytes, form.get("long_text") or None,
+                                form.get("image_aggregate") or None, form.get("latency_budget_ms"))
+    except BadInput as e:
+        raise web.HTTPBadRequest(text=json.dumps({"error": str(e)}), content_type="application/json")
+    return web.json_response(result)
+
+
+async def explain_single(request):
+    form = await request.post()
+    text = form.get("text")
+    try:
+        images = read_uploads(form)
+        if not (text and text.strip()) and not images:
+            raise BadInput("Send news text, an image or both.")
+        if len(images) > 1:
+            raise BadInput("Explain one image at a time")
+        try:
+            grid = int(form.get("grid") or DEFAULT_GRID)
+        except ValueError:
+            grid = 0
+        if not 1 <= grid <= MAX_GRID:
+            raise BadInput(f"grid must be a whole number from 1 to {MAX_GRID}")
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(request.app[EXECUTOR], explain_or_reject, text,
+                                            images[0] if images else None, request.app[CLASSIFIER],
+                                            request.app[PROCESSOR], grid)
+    except BadInput as e:
+        raise web.HTTPBadRequest(text=json.dumps({"error": str(e)}), content_type="application/json")
+    return web.json_response(result)
+
+
+async def iter_lines(content):
+    # StreamReader.readline caps lines at 128 KiB, far below a base64 photo
+    buffer = bytearray()
+    async for chunk in content.iter_chunked(64 * 1024):
+        buffer.extend(chunk)
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            yield line
+        if len(buffer) > MAX_LINE_BYTES:
+            raise BadInput(f"Line longer than {MAX_LINE_BYTES} bytes")
+    if buffer:
+        yield bytes(buffer)
+
+
+async def scan_bulk_line(app, index, line):
+    post_id = None
+    try:
+        post = json.loads(line)
+        post_id = post.get("id")
+        image_bytes = None
+        if post.get("image") is not None:
+            image_bytes = base64.b64decode(post["image"], validate=True)
+        elif post.get("image_path"):
+            image_bytes = await asyncio.get_running_loop().run_in_executor(
+                app[EXECUTOR], read_image_path, app, post["image_path"])
+        elif post.get("images"):
+            # Counted before anything is decoded or read
+            check_image_count(post["images"])
+            image_bytes = [base64.b64decode(image, validate=True) for image in post["images"]]
+        elif post.get("image_paths"):
+            check_image_count(post["image_paths"])
+            image_bytes = [await asyncio.get_running_loop().run_in_executor(app[EXECUTOR], read_image_path, app, path)
+                           for path in post["image_paths"]]
+        result = await run_scan(app, post.get("text"), image_bytes, post.get("long_text"), post.get("image_aggregate"),
+                                post.get("latency_budget_ms"))
+    except Exception as e:
+        # Reported on the line itself so one bad post does not end the stream
+        result = {"error": str(e)}
+    return {"index": index, "id": post_id, **result}
+
+
+async def scan_bulk(request):
+    app = request.app
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    in_flight = asyncio.Semaphore(app[MAX_IN_FLIGHT])
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def worker(index, line):
+        try:
+            result = await scan_bulk_line(app, index, line)
+            async with write_lock:
+                await response.write(json.dumps(result, ensure_ascii=False).encode("utf-8") + b"\n")
+        finally:
+            in_flight.release()
+
+    index = 0
+    try:
+        async for line in iter_lines(request.content):
+            if not line.strip():
+                continue
+            # Backpressure: stop reading the body while the pool is full
+            await in_flight.acquire()
+            task = asyncio.create_task(worker(index, line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+    except BadInput as e:
+        async with write_lock:
+            await response.write(json.dumps({"index": index, "error": str(e)}).encode("utf-8") + b"\n")
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    await response.write_eof()
+    return response
+
+
+def create_app(classifier, processor, image_root=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, executor=None, cache=None,
+               cascade=None, index=None, registry=None, store=None):
+    """``registry`` (``scanner.registry.ModelRegistry``) routes scans between model
+    variants; without one every scan uses ``classifier``. ``store``
+    (``scanner.store.PredictionStore``) records every verdict and is closed
+    with the app. An ``executor`` passed in is left running; the caller owns it."""
+    app = web.Application(client_max_size=MAX_FORM_BYTES)
+    if registry is None:
+        registry = ModelRegistry({DEFAULT_VARIANT: ModelVariant(DEFAULT_VARIANT, None, classifier)})
+    app[CLASSIFIER] = registry.default.classifier
+    app[REGISTRY] = registry
+    app[STORE] = store
+    app[PROCESSOR] = processor
+    app[CACHE] = cache
+    app[CASCADE] = cascade
+    app[NEIGHBORS] = index
+    app[IMAGE_ROOT] = os.path.realpath(image_root) if image_root else None
+    app[MAX_IN_FLIGHT] = max_in_flight
+    # One thread per in-flight scan keeps the micro-batcher fed
+    owns_executor = executor is None
+    app[EXECUTOR] = executor or ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="scan")
+
+    async def shutdown_executor(app):
+        if owns_executor:
+            app[EXECUTOR].shutdown(wait=False)
+        if app[STORE] is not None:
+            # Writes whatever is still queued
+            app[STORE].close()
+
+    app.on_cleanup.append(shutdown_executor)
+    app.router.add_get("/health", health)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/metrics", prometheus_metrics)
+    app.router.add_post("/scan", scan_single)
+    app.router.add_post("/scan/bulk", scan_bulk)
+    app.router.add_post("/explain", explain_single)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake news scanning HTTP service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_processor/ and clip_model/")
+    parser.add_argument("--image-root", help="allow bulk lines to reference images under this directory")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    args = parser.parse_args()
+
+    cache = open_cache(args.base_dir)
+    registry, processor = load_registry(args.base_dir, cache=cache is not None)
+    app = create_app(registry.default.classifier, processor, args.image_root, args.max_in_flight, cache=cache,
+                     cascade=load_cascade(args.base_dir), index=load_index(args.base_dir), registry=registry,
+                     store=open_store(args.base_dir))
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Durable history of every verdict, for audits and offline threshold tuning.
+
+    python -m scanner.store --since 2026-10-01 --until 2026-10-08 > week.jsonl
+    python -m scanner.store --text "Breaking news..." --image photo.jpg
+
+Every scan the app and the service answer becomes a row of a SQLite file in
+WAL mode at ``SCANNER_STORE_PATH`` (default ``<base_dir>/.cache/predictions.sqlite``):
+when it was made and by what (``source``), the content hashes of its text and
+images (the cache's keys, so a headline edited only in whitespace or case
+hashes the same), the label and confidence of each view, the model variant and
+the fingerprint of its files, the scan's latency and the full result as JSON.
+Rows are indexed by time and by text and image hash.
+
+``record`` never touches the disk: it hands the scan to a ``MicroBatcher``,
+whose thread hashes and writes everything queued within
+``SCANNER_STORE_FLUSH_MS`` (default 200) in one transaction, so persistence
+adds no latency to a scan. Rows still queued are written by ``close``; a
+crash loses at most the last flush window. Scans recorded after ``close``
+are dropped with a warning rather than failing the scan. ``SCANNER_STORE=0``
+turns the store off.
+"""
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from scanner.batching import MicroBatcher
+from scanner.cache import image_key, text_key
+from scanner.model import VIEWS
+
+DEFAULT_FLUSH_MS = 200.0
+DEFAULT_BATCH_SIZE = 512
+DEFAULT_QUERY_LIMIT = 1000
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS predictions ("
+    "id INTEGER PRIMARY KEY, created REAL NOT NULL, source TEXT, text_hash TEXT, "
+    + "".join(f"{view}_label TEXT, {view}_conf REAL, " for view in VIEWS)
+    + "model TEXT, model_version TEXT, latency_ms REAL, result TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS predictions_created ON predictions (created)",
+    "CREATE INDEX IF NOT EXISTS predictions_text_hash ON predictions (text_hash, created)",
+    "CREATE TABLE IF NOT EXISTS prediction_images ("
+    "prediction_id INTEGER NOT NULL REFERENCES predictions (id), position INTEGER NOT NULL, image_hash TEXT NOT NULL, "
+    "PRIMARY KEY (prediction_id, position))",
+    "CREATE INDEX IF NOT EXISTS prediction_images_hash ON prediction_images (image_hash)",
+]
+COLUMNS = (["created", "source", "text_hash"] + [f"{view}_{field}" for view in VIEWS for field in ("label", "conf")]
+           + ["model", "model_version", "latency_ms", "result"])
+INSERT = f"INSERT INTO predictions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class PredictionStore:
+    """Append-only SQLite history of scans, written in batches on a background thread."""
+
+    def __init__(self, path, flush_ms=DEFAULT_FLUSH_MS, batch_size=DEFAULT_BATCH_SIZE):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._db = _connect(path)
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._written = 0
+        self._failed = 0
+        self._dropped = 0
+        self._closed = False
+        self._writer = MicroBatcher(self._write, batch_size, flush_ms, "prediction-writer")
+
+    def record(self, result, text=None, image_bytes=None, model=None, model_version=None, latency_ms=None,
+               source=None):
+        """Queue one scan's ``result`` (as ``scan_post`` returns it) for writing.
+
+        ``image_bytes`` is one upload, a list of them or None; hashing is left
+        to the writer thread. Once the store is closed the scan is dropped
+        with a warning.
+        """
+        if isinstance(image_bytes, (bytes, bytearray)):
+            image_bytes = [image_bytes]
+        try:
+            self._writer.submit((time.time(), source, text, image_bytes or [], result, model, model_version, latency_ms))
+        except RuntimeError:
+            print("Prediction store is closed; verdict not persisted", file=sys.stderr)
+            with self._lock:
+                self._dropped += 1
+
+    @staticmethod
+    def _row(item):
+        created, source, text, images, result, model, model_version, latency_ms = item
+        verdicts = []
+        for view in VIEWS:
+            verdict = result.get(view) or {}
+            conf = verdict.get("conf")
+            verdicts += [verdict.get("label"), float(conf) if conf is not None else None]
+        return ((created, source, text_key(text) if text and text.strip() else None, *verdicts, model, model_version,
+                 latency_ms, json.dumps(result, ensure_ascii=False, default=float)),
+                [image_key(bytes(image)) for image in images])
+
+    def _write(self, items):
+        try:
+            rows = [self._row(item) for item in items if item is not None]
+            with self._db:
+                for row, image_hashes in rows:
+                    prediction_id = self._db.execute(INSERT, row).lastrowid
+                    self._db.executemany("INSERT INTO prediction_images VALUES (?, ?, ?)",
+                                         [(prediction_id, i, image_hash) for i, image_hash in enumerate(image_hashes)])
+            with self._lock:
+                self._written += len(rows)
+        except Exception as e:
+            # A full or locked disk must not take scans down with it
+            failed = sum(item is not None for item in items)
+            print(f"Could not persist {failed} predictions: {e}", file=sys.stderr)
+            with self._lock:
+                self._failed += failed
+        return [None] * len(items)
+
+    def flush(self):
+        """Block until everything recorded so far is written; a no-op once closed."""
+        try:
+            future = self._writer.submit(None)
+        except RuntimeError:
+            return
+        try:
+            future.result()
+        except RuntimeError:
+            pass
+
+    def query(self, since=None, until=None, text_hash=None, image_hash=None, source=None, limit=DEFAULT_QUERY_LIMIT):
+        """Stored scans, newest first, as dicts with ``image_hashes`` and the parsed ``result``.
+
+        ``since``/``until`` are Unix times (``until`` exclusive); every filter is optional.
+        """
+        clauses, params = [], []
+        for clause, value in (("created >= ?", since), ("created < ?", until), ("text_hash = ?", text_hash),
+                              ("source = ?", source),
+                              ("id IN (SELECT prediction_id FROM prediction_images WHERE image_hash = ?)", image_hash)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        sql = "SELECT * FROM predictions" + (" WHERE " + " AND ".join(clauses) if clauses else "")
+        sql += " ORDER BY created DESC, id DESC LIMIT ?"
+        # Its own connection: WAL lets it read while the writer commits
+        db = _connect(self.path)
+        try:
+            db.row_factory = sqlite3.Row
+            rows = [dict(row) for row in db.execute(sql, params + [limit])]
+            for row in rows:
+                row["result"] = json.loads(row["result"])
+                row["image_hashes"] = [image_hash for (image_hash,) in db.execute(
+                    "SELECT image_hash FROM prediction_images WHERE prediction_id = ? ORDER BY position", (row["id"],))]
+        finally:
+            db.close()
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {"written": self._written, "failed": self._failed, "dropped": self._dropped,
+                    "queued": self._writer.pending()}
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._writer.close()
+        self._db.close()
+
+
+def store_path(base_dir):
+    return os.environ.get("SCANNER_STORE_PATH") or os.path.join(base_dir, ".cache", "predictions.sqlite")
+
+
+def open_store(base_dir, path=None):
+    """The store configured by ``SCANNER_STORE_PATH`` / ``SCANNER_STORE_FLUSH_MS``, or
+    ``None`` when ``SCANNER_STORE=0``."""
+    if os.environ.get("SCANNER_STORE") == "0":
+        return None
+    return PredictionStore(path or store_path(base_dir),
+                           float(os.environ.get("SCANNER_STORE_FLUSH_MS", DEFAULT_FLUSH_MS)))
+
+
+def _timestamp(value):
+    # An ISO date or datetime (UTC unless it says otherwise) to Unix time
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the stored verdicts as JSON lines")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding .cache/predictions.sqlite")
+    parser.add_argument("--path", help="store file (default: SCANNER_STORE_PATH, else <base-dir>/.cache/predictions.sqlite)")
+    parser.add_argument("--since", help="ISO date or time, UTC unless given")
+    parser.add_argument("--until", help="ISO date or time, exclusive")
+    parser.add_argument("--text", help="only scans of this text")
+    parser.add_argument("--text-hash", help="only scans whose text has this hash")
+    parser.add_argument("--image", help="only scans with this image file")
+    parser.add_argument("--image-hash", help="only scans with an image of this hash")
+    parser.add_argument("--source", help="only scans from this source, e.g. service or app")
+    parser.add_argument("--limit", type=int, default=DEFAULT_QUERY_LIMIT)
+    args = parser.parse_args()
+
+    path = args.path or store_path(args.base_dir)
+    if not os.path.exists(path):
+        raise SystemExit(f"No store at {path}")
+    image_hash = args.image_hash
+    if args.image:
+        with open(args.image, "rb") as f:
+            image_hash = image_key(f.read())
+    store = PredictionStore(path)
+    try:
+        rows = store.query(_timestamp(args.since) if args.since else None, _timestamp(args.until) if args.until else None,
+                           text_key(args.text) if args.text else args.text_hash, image_hash, args.source, args.limit)
+    finally:
+        store.close()
+    for row in rows:
+        row["created"] = datetime.datetime.fromtimestamp(row["created"], datetime.timezone.utc).isoformat(timespec="milliseconds")
+        print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
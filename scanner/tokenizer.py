@@ -0,0 +1,158 @@
+"""CLIP tokenizer on the standalone ``tokenizers`` library.
+
+Reads ``tokenizer.json`` from ``clip_processor/`` and pads/truncates exactly
+like ``CLIPProcessor(..., padding="max_length", truncation=True,
+max_length=77)``, without importing transformers.
+
+Texts are NFC-normalized before anything else. Bangla has several code point
+sequences for the same letters (precomposed or nukta forms, vowel signs typed
+in two parts), and keyboards and scrapers disagree on them; the fast
+tokenizer's own normalizer does the same, so this changes no encoding, but it
+pins the behavior whatever ``tokenizer.json`` says and lets both spellings
+share one memo entry. The slow ``CLIPTokenizer`` is not a reference: it also
+drops zero-width joiners, which Bangla uses inside words, and the model was
+trained on the fast one (``tests/test_tokenizer.py`` checks parity with it).
+
+Encodings of recently seen texts are memoized in a bounded LRU of
+``SCANNER_TOKENIZER_MEMO`` entries (default 4096, ``0`` turns it off), and the
+texts that miss are encoded in one batched call.
+"""
+import collections
+import json
+import os
+import threading
+import unicodedata
+
+import numpy as np
+from tokenizers import Tokenizer
+
+from scanner.model import MAX_TEXT_LENGTH
+
+DEFAULT_PAD_TOKEN = "<|endoftext|>"
+# Window starts this many content tokens apart, so consecutive windows share 25
+DEFAULT_WINDOW_STRIDE = 50
+DEFAULT_MAX_WINDOWS = 32
+DEFAULT_MEMO_ENTRIES = 4096
+
+
+def _pad_token(processor_dir):
+    # tokenizer_config.json is written by every transformers version;
+    # special_tokens_map.json only by older ones
+    for name in ("tokenizer_config.json", "special_tokens_map.json"):
+        path = os.path.join(processor_dir, name)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                token = json.load(f).get("pad_token")
+            if isinstance(token, dict):
+                token = token.get("content")
+            if token:
+                return token
+    return DEFAULT_PAD_TOKEN
+
+
+class ClipTokenizer:
+    """Callable turning a list of texts into int64 ``(input_ids, attention_mask)``."""
+
+    def __init__(self, tokenizer, pad_token=DEFAULT_PAD_TOKEN, max_length=MAX_TEXT_LENGTH,
+                 memo_entries=DEFAULT_MEMO_ENTRIES):
+        pad_id = tokenizer.token_to_id(pad_token)
+        if pad_id is None:
+            raise ValueError(f"Pad token {pad_token!r} is not in the vocabulary")
+        tokenizer.enable_truncation(max_length)
+        tokenizer.enable_padding(length=max_length, pad_id=pad_id, pad_token=pad_token)
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.memo_entries = memo_entries
+        self._memo = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._untruncated = None
+
+    @classmethod
+    def from_dir(cls, processor_dir, max_length=MAX_TEXT_LENGTH, memo_entries=None):
+        path = os.path.join(processor_dir, "tokenizer.json")
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"Tokenizer not found at: {path} (save the processor with a fast tokenizer to create it)")
+        if memo_entries is None:
+            memo_entries = int(os.environ.get("SCANNER_TOKENIZER_MEMO", DEFAULT_MEMO_ENTRIES))
+        return cls(Tokenizer.from_file(path), _pad_token(processor_dir), max_length, memo_entries)
+
+    def encode_uncached(self, texts):
+        """``(input_ids, attention_mask)`` straight from the tokenizer, bypassing the memo."""
+        return self._encode([unicodedata.normalize("NFC", text) for text in texts])
+
+    def _encode(self, texts):
+        # Texts already NFC-normalized
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64).reshape(-1, self.max_length)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64).reshape(-1, self.max_length)
+        return input_ids, attention_mask
+
+    def __call__(self, texts):
+        texts = [unicodedata.normalize("NFC", text) for text in texts]
+        if not self.memo_entries:
+            return self._encode(texts)
+        input_ids = np.empty((len(texts), self.max_length), dtype=np.int64)
+        attention_mask = np.empty((len(texts), self.max_length), dtype=np.int64)
+        # Rows of each text not memoized yet; a text repeated within the batch is encoded once
+        missing = collections.defaultdict(list)
+        with self._lock:
+            for i, text in enumerate(texts):
+                row = self._memo.get(text)
+                if row is None:
+                    missing[text].append(i)
+                    continue
+                self._memo.move_to_end(text)
+                input_ids[i], attention_mask[i] = row
+            self._counters["hits"] += len(texts) - len(missing)
+            self._counters["misses"] += len(missing)
+        if missing:
+            ids, mask = self._encode(list(missing))
+            with self._lock:
+                for (text, rows), text_ids, text_mask in zip(missing.items(), ids, mask):
+                    input_ids[rows], attention_mask[rows] = text_ids, text_mask
+                    self._memo[text] = (text_ids, text_mask)
+                while len(self._memo) > self.memo_entries:
+                    self._memo.popitem(last=False)
+        return input_ids, attention_mask
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, memo_entries=len(self._memo))
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_rate"] = stats.get("hits", 0) / lookups if lookups else 0.0
+        return stats
+
+    def spans(self, text):
+        """``(start, end)`` character offsets into the NFC-normalized ``text`` of
+        each token ``self([text])`` gives; special and padding tokens get ``(0, 0)``."""
+        return self.tokenizer.encode(unicodedata.normalize("NFC", text)).offsets
+
+    def windows(self, text, stride=DEFAULT_WINDOW_STRIDE, max_windows=DEFAULT_MAX_WINDOWS):
+        """Overlapping windows over the whole of ``text`` as ``(input_ids, attention_mask)``.
+
+        Each window holds ``max_length - 2`` content tokens between the start
+        and end tokens, ``stride`` apart, and the last one ends with the text,
+        so every window is full and they all share one length. Longer texts are
+        covered by ``max_windows`` evenly spaced windows. A text that fits in
+        one window gives exactly ``self([text])``.
+        """
+        if self._untruncated is None:
+            untruncated = Tokenizer.from_str(self.tokenizer.to_str())
+            untruncated.no_truncation()
+            untruncated.no_padding()
+            self._untruncated = untruncated
+        encoding = self._untruncated.encode(unicodedata.normalize("NFC", text))
+        size = self.max_length - 2
+        content = [token for token, special in zip(encoding.ids, encoding.special_tokens_mask) if not special]
+        if len(content) <= size:
+            return self([text])
+
+        last = len(content) - size
+        starts = list(range(0, last, stride)) + [last]
+        if len(starts) > max_windows:
+            starts = np.linspace(0, last, max_windows).round().astype(int).tolist()
+        start_token, end_token = encoding.ids[0], encoding.ids[-1]
+        input_ids = np.array([[start_token] + content[start:start + size] + [end_token] for start in starts], dtype=np.int64)
+        return input_ids, np.ones_like(input_ids)
@@ -0,0 +1,262 @@
+"""Pick the fastest ONNX Runtime session settings for this host and persist them.
+
+    python -m scanner.tuning --base-dir .
+
+Every graph ``load_classifier`` would load is benchmarked over a grid of
+intra-op thread counts, graph optimization levels, sequential vs parallel
+execution and the CPU execution providers installed. The winner of each graph
+is written to ``clip_model/tuned/profile.json`` together with the graph as
+ONNX Runtime optimized it, so later starts skip the optimization passes.
+
+``create_session`` applies the profile automatically, but only while the
+source graph, the onnxruntime version and the host still match the ones it
+was tuned on; otherwise the default settings are used. Set
+``SCANNER_ORT_TUNING=0`` to ignore the profile.
+
+Graphs whose weights live in an external ``.data`` file (see
+``scanner.external_data``) are tuned and run without weight prepacking, and
+their optimized copies keep the weights external, so every process on a host
+maps the same read-only pages.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+TUNED_DIR = "tuned"
+PROFILE_FILE = "profile.json"
+EXTERNAL_DATA_SUFFIX = ".data"
+# Smaller initializers stay inside the graph file
+EXTERNAL_DATA_MIN_BYTES = 1024
+
+# Execution providers that run on the CPU, in order of preference on a tie
+CPU_PROVIDERS = ("CPUExecutionProvider", "DnnlExecutionProvider", "OpenVINOExecutionProvider", "XnnpackExecutionProvider")
+
+OPTIMIZATION_LEVELS = {
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+# What ``ort.InferenceSession`` does without options (0 threads = onnxruntime's own choice)
+DEFAULT_CONFIG = {"intra_op_num_threads": 0, "inter_op_num_threads": 0,
+                  "execution_mode": "sequential", "graph_optimization_level": "all"}
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return hashlib.sha256(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+
+def host_id():
+    # Optimized graphs may use kernels and layouts specific to the CPU they were made on
+    return f"{platform.machine()}/{platform.processor() or 'unknown'}/{os.cpu_count()}"
+
+
+def session_options(config, optimized_model_path=None):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = config["intra_op_num_threads"]
+    options.inter_op_num_threads = config["inter_op_num_threads"]
+    options.execution_mode = EXECUTION_MODES[config["execution_mode"]]
+    options.graph_optimization_level = OPTIMIZATION_LEVELS[config["graph_optimization_level"]]
+    if optimized_model_path:
+        options.optimized_model_filepath = optimized_model_path
+    return options
+
+
+def has_external_data(model_path):
+    return os.path.exists(model_path + EXTERNAL_DATA_SUFFIX)
+
+
+def share_weights(options, model_path):
+    """Disable prepacking for graphs with external weights, unless ``SCANNER_ORT_PREPACK=1``.
+
+    onnxruntime memory-maps external initializers read-only and runs on them
+    in place; prepacking would copy every weight matrix into private memory.
+    That mapping is how weights are shared, in place of ORT's shared
+    initializers (``SessionOptions.add_initializer``) or shared allocator:
+    those share OrtValues between the sessions of one process, while the
+    replicas are separate processes, which only the page cache spans. Four
+    replicas of a 200 MB random-weight fixture measured with
+    ``benchmarks.memory`` (onnxruntime 1.31): 1280 MB total PSS with inline
+    weights, 978 MB mapped with prepacking, 395 MB mapped without.
+    """
+    if has_external_data(model_path) and os.environ.get("SCANNER_ORT_PREPACK") != "1":
+        options.add_session_config_entry("session.disable_prepacking", "1")
+    return options
+
+
+def profile_path(model_path):
+    return os.path.join(os.path.dirname(model_path), TUNED_DIR, PROFILE_FILE)
+
+
+def tuned_session_args(model_path):
+    """``(path, SessionOptions, providers)`` from a still valid profile, else ``None``."""
+    if os.environ.get("SCANNER_ORT_TUNING", "1") == "0":
+        return None
+    path = profile_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    entry = profile.get("models", {}).get(os.path.basename(model_path))
+    if (entry is None or profile.get("ort_version") != ort.__version__ or profile.get("host") != host_id()
+            or entry["source_fingerprint"] != file_fingerprint(model_path)
+            or entry["provider"] not in ort.get_available_providers()):
+        return None
+
+    config = entry["config"]
+    options = session_options(config)
+    if entry.get("optimized_model"):
+        optimized_path = os.path.join(os.path.dirname(path), entry["optimized_model"])
+        if os.path.exists(optimized_path):
+            # Already optimized offline; running the passes again only costs startup time
+            model_path = optimized_path
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    providers = [entry["provider"]] + (["CPUExecutionProvider"] if entry["provider"] != "CPUExecutionProvider" else [])
+    return model_path, options, providers
+
+
+def sample_feeds(session, batch_size, seq_len):
+    # Leading dims are the batch; any other free dim is the token sequence
+    feeds = {}
+    for node in session.get_inputs():
+        shape = [batch_size if i == 0 else (dim if isinstance(dim, int) else seq_len)
+                 for i, dim in enumerate(node.shape)]
+        if node.type == "tensor(int64)":
+            feeds[node.name] = np.ones(shape, dtype=np.int64)
+        else:
+            feeds[node.name] = np.random.default_rng(0).standard_normal(shape).astype(np.float32)
+    return feeds
+
+
+def measure(model_path, provider, config, batch_size, seq_len, warmup, repeats):
+    providers = [provider] + (["CPUExecutionProvider"] if provider != "CPUExecutionProvider" else [])
+    start = time.perf_counter()
+    session = ort.InferenceSession(model_path, share_weights(session_options(config), model_path), providers=providers)
+    load_ms = (time.perf_counter() - start) * 1000
+    feeds = sample_feeds(session, batch_size, seq_len)
+    for _ in range(warmup):
+        session.run(None, feeds)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        session.run(None, feeds)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), load_ms
+
+
+def thread_counts(limit):
+    counts = {limit}
+    count = 1
+    while count < limit:
+        counts.add(count)
+        count *= 2
+    return sorted(counts)
+
+
+def candidate_configs(threads, levels, modes):
+    for intra, level, mode in itertools.product(threads, levels, modes):
+        # inter-op threads only matter when independent nodes run in parallel
+        for inter in ([1] if mode == "sequential" else sorted({2, max(2, intra)})):
+            yield {"intra_op_num_threads": intra, "inter_op_num_threads": inter,
+                   "execution_mode": mode, "graph_optimization_level": level}
+
+
+def tune_model(model_path, out_dir, providers, configs, batch_size, seq_len, warmup, repeats):
+    results = []
+    for provider in providers:
+        for config in configs:
+            try:
+                latency_ms, load_ms = measure(model_path, provider, config, batch_size, seq_len, warmup, repeats)
+            except Exception as e:
+                print(f"  {provider} {config}: failed ({e})", file=sys.stderr)
+                continue
+            results.append({"provider": provider, "config": config, "latency_ms": latency_ms, "load_ms": load_ms})
+            print(f"  {provider:26} {config['graph_optimization_level']:8} {config['execution_mode']:10} "
+                  f"intra={config['intra_op_num_threads']:<3} inter={config['inter_op_num_threads']:<3} "
+                  f"{latency_ms:8.2f} ms", file=sys.stderr)
+    if not results:
+        raise SystemExit(f"No configuration could run {model_path}")
+    best = min(results, key=lambda result: (result["latency_ms"], CPU_PROVIDERS.index(result["provider"])))
+
+    # Serialize the graph as the winning settings optimize it
+    name = os.path.basename(model_path)
+    optimized_name = f"{os.path.splitext(name)[0]}.{best['config']['graph_optimization_level']}.onnx"
+    optimized_path = os.path.join(out_dir, optimized_name)
+    options = share_weights(session_options(best["config"], optimized_path), model_path)
+    if has_external_data(model_path):
+        options.add_session_config_entry("session.optimized_model_external_initializers_file_name",
+                                         optimized_name + EXTERNAL_DATA_SUFFIX)
+        options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes",
+                                         str(EXTERNAL_DATA_MIN_BYTES))
+    try:
+        ort.InferenceSession(model_path, options, providers=[best["provider"]])
+    except Exception as e:
+        # Compiling providers cannot always write their graph back out
+        print(f"  could not save the optimized graph ({e}); only the settings are kept", file=sys.stderr)
+        optimized_name = None
+    return {
+        "source_fingerprint": file_fingerprint(model_path),
+        "provider": best["provider"],
+        "config": best["config"],
+        "latency_ms": best["latency_ms"],
+        "optimized_model": optimized_name,
+        "default_latency_ms": next((result["latency_ms"] for result in results if result["provider"] == "CPUExecutionProvider"
+                                   and result["config"] == DEFAULT_CONFIG), None),
+    }
+
+
+def main():
+    from scanner.model import FULL_MODEL_FILE, IMAGE_TOWER_FILE, MAX_TEXT_LENGTH, TEXT_TOWER_FILE, has_towers
+
+    parser = argparse.ArgumentParser(description="Benchmark ONNX Runtime session settings and keep the fastest")
+    parser.add_argument("--base-dir", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="directory holding clip_model/")
+    parser.add_argument("--threads", help="comma-separated intra-op thread counts (default: powers of two up to the core count)")
+    parser.add_argument("--levels", default=",".join(OPTIMIZATION_LEVELS), help="graph optimization levels to try")
+    parser.add_argument("--modes", default=",".join(EXECUTION_MODES), help="execution modes to try")
+    parser.add_argument("--batch-size", type=int, default=1, help="batch size to tune for")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    model_dir = os.path.join(args.base_dir, "clip_model")
+    names = [TEXT_TOWER_FILE, IMAGE_TOWER_FILE] if has_towers(model_dir) else [FULL_MODEL_FILE]
+    threads = [int(t) for t in args.threads.split(",")] if args.threads else thread_counts(os.cpu_count())
+    configs = list(candidate_configs(threads, args.levels.split(","), args.modes.split(",")))
+    if DEFAULT_CONFIG not in configs:
+        configs.append(dict(DEFAULT_CONFIG))
+    providers = [provider for provider in CPU_PROVIDERS if provider in ort.get_available_providers()]
+
+    out_dir = os.path.join(model_dir, TUNED_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    profile = {"ort_version": ort.__version__, "host": host_id(), "batch_size": args.batch_size, "models": {}}
+    for name in names:
+        print(f"{name}: {len(configs) * len(providers)} configurations", file=sys.stderr)
+        entry = tune_model(os.path.join(model_dir, name), out_dir, providers, configs,
+                           args.batch_size, MAX_TEXT_LENGTH, args.warmup, args.repeats)
+        profile["models"][name] = entry
+        default = entry["default_latency_ms"]
+        print(f"{name}: {entry['provider']} {entry['config']} {entry['latency_ms']:.2f} ms"
+              + (f" (defaults: {default:.2f} ms)" if default is not None else ""), file=sys.stderr)
+
+    with open(os.path.join(out_dir, PROFILE_FILE), "w") as f:
+        json.dump(profile, f, indent=2)
+    print(f"Profile written to {os.path.join(out_dir, PROFILE_FILE)}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,21 @@
 # app.py
 import streamlit as st
-import torch
-import numpy as np
-from transformers import CLIPProcessor
-from PIL import Image
-import onnxruntime as ort
+from PIL import Image, UnidentifiedImageError
+import html
 import os
+import time
+import unicodedata
+
+from scanner.cache import open_cache
+from scanner.explain import explain, heatmap_overlay
+from scanner.frames import VIDEO_EXTENSIONS, can_decode_video
+from scanner.longtext import DEFAULT_AGGREGATION
+from scanner.metrics import metrics, start_metrics_server
+from scanner.model import VIEWS, model_fingerprint
+from scanner.neighbors import load_index
+from scanner.pipeline import load_model_and_processor as load_pipeline
+from scanner.pipeline import decode_image, scan_post
+from scanner.store import open_store
 
 def inject_css():
     st.markdown("""
@@ -82,11 +92,11 @@ def inject_css():
             border: 1px solid;
             background: rgba(0, 0, 0, 0.3);
         }
-        .text-real, .image-real {
+        .text-real, .image-real, .joint-real {
             border-color: #4ade80;
             color: #4ade80;
         }
-        .text-fake, .image-fake {
+        .text-fake, .image-fake, .joint-fake {
             border-color: #ef4444;
             color: #ef4444;
         }
@@ -115,143 +125,216 @@ def inject_css():
 def load_model_and_processor():
     try:
         current_dir = os.path.dirname(__file__)
-        processor_path = os.path.join(current_dir, "clip_processor")
-        onnx_path = os.path.join(current_dir, "clip_model", "train_quantized.onnx")
-
-        processor = CLIPProcessor.from_pretrained(processor_path)
-
-        if not os.path.exists(onnx_path):
-            st.error(f"❌ ONNX model not found at: {onnx_path}")
-            st.info("Make sure 'clip_model/train_quantized.onnx' exists.")
-            return None, None, None
+        try:
+            classifier, processor = load_pipeline(current_dir)
+        except FileNotFoundError as e:
+            st.error(f"❌ {e}")
+            st.info("Make sure 'clip_model/train_quantized.onnx' and 'clip_processor/tokenizer.json' exist.")
+            return None, None
 
-        session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
-        return session, processor, "onnx"
+        return classifier, processor
     except Exception as e:
         st.error(f"Failed to load model or processor: {str(e)}")
-        return None, None, None
+        return None, None
+
+@st.cache_resource
+def load_cache():
+    # Shared by every session; re-posted headlines and images skip inference
+    return open_cache(os.path.dirname(__file__))
+
+@st.cache_resource
+def load_neighbor_index():
+    # Posts labelled before, matched against every scan
+    return load_index(os.path.dirname(__file__))
+
+@st.cache_resource
+def load_store():
+    # Every verdict outlives the session; written in the background
+    return open_store(os.path.dirname(__file__))
 
-def predict_text_only(text, image, session, processor, device):
-    inputs = processor(
-        text=[text],
-        images=image,
-        return_tensors="np",
-        padding="max_length",
-        truncation=True,
-        max_length=77
-    )
+@st.cache_resource
+def model_version():
+    return model_fingerprint(os.path.join(os.path.dirname(__file__), "clip_model"))
 
-    # Replace with zero image values for text-only
-    inputs['pixel_values'] = np.zeros((1, 3, 224, 224), dtype=np.float32)
-    mean = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32).reshape(1, 3, 1, 1)
-    std = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32).reshape(1, 3, 1, 1)
-    inputs['pixel_values'] = (inputs['pixel_values'] - mean) / std
+@st.cache_resource
+def start_metrics():
+    # Streamlit has no routes of its own, so Prometheus scrapes a side port
+    port = os.environ.get("SCANNER_METRICS_PORT")
+    if not port:
+        return None
+    return start_metrics_server(int(port), os.environ.get("SCANNER_METRICS_HOST", "127.0.0.1"))
 
-    onnx_inputs = {
-        "input_ids": np.array(inputs["input_ids"], dtype=np.int64),
-        "attention_mask": np.array(inputs["attention_mask"], dtype=np.int64),
-        "pixel_values": np.array(inputs["pixel_values"], dtype=np.float32)
-    }
+def debug_panel_enabled():
+    return os.environ.get("SCANNER_DEBUG_PANEL") == "1" or st.query_params.get("debug") == "1"
 
-    logits = session.run(["logits"], onnx_inputs)[0]
-    probs = torch.softmax(torch.from_numpy(logits[0]), dim=0).numpy()
-    pred = np.argmax(probs)
-    conf = probs[pred]
-    return "Real" if pred == 1 else "Fake", conf
+def render_debug_panel():
+    with st.expander("⏱️ Timing details"):
+        if 'scan_timings' in st.session_state:
+            st.markdown("**Last scan**")
+            st.table([{**row, "ms": round(row["ms"], 2)} for row in st.session_state.scan_timings])
+        st.markdown("**Recent scans** (milliseconds)")
+        st.table([{key: round(value, 2) if isinstance(value, float) else value for key, value in row.items()}
+                  for row in metrics.snapshot()])
 
-def predict_image_only(text, image, session, processor, device):
-    inputs = processor(
-        text=[text],
-        images=image,
-        return_tensors="np",
-        truncation=True,
-        max_length=77,
-        do_convert_rgb=True,
-        do_normalize=True,
-        image_mean=[0.48145466, 0.4578275, 0.40821073],
-        image_std=[0.26862954, 0.26130258, 0.27577711],
-        input_data_format="channels_last"
-    )
+CARD_TITLES = {"text": "Text Analysis", "image": "Image Analysis", "joint": "Joint Analysis"}
 
-    # Zero out text inputs for image-only
-    inputs['input_ids'].fill(0)
-    inputs['attention_mask'].fill(0)
+def render_card(slot, view, verdict):
+    icon = "🟢" if verdict['label'] == "Real" else "🔴"
+    css_class = f"{view}-real" if verdict['label'] == "Real" else f"{view}-fake"
+    slot.markdown(f"""
+    <div class="result-card {css_class}">
+        <div class="icon">{icon}</div>
+        <div><strong>{CARD_TITLES[view]}</strong></div>
+        <div>Prediction: <strong>{verdict['label']}</strong></div>
+        <div>Confidence: {verdict['conf']:.2%}</div>
+    </div>
+    """, unsafe_allow_html=True)
 
-    onnx_inputs = {
-        "input_ids": np.array(inputs["input_ids"], dtype=np.int64),
-        "attention_mask": np.array(inputs["attention_mask"], dtype=np.int64),
-        "pixel_values": np.array(inputs["pixel_values"], dtype=np.float32)
-    }
+def highlight_tokens(text, tokens, view):
+    # Red behind the words that argue for the verdict, blue behind those against it
+    scale = max([abs(token["importance"][view]) for token in tokens] + [1e-9])
+    parts, end = [], 0
+    for token in tokens:
+        parts.append(html.escape(text[end:token["start"]]))
+        weight = token["importance"][view] / scale
+        color = "239, 68, 68" if weight > 0 else "96, 165, 250"
+        parts.append(f"<span style='background: rgba({color}, {abs(weight):.2f}); border-radius: 4px' "
+                     f"title='{weight * scale:+.4f}'>{html.escape(text[token['start']:token['end']])}</span>")
+        end = token["end"]
+    parts.append(html.escape(text[end:]))
+    return "".join(parts)
 
-    logits = session.run(["logits"], onnx_inputs)[0]
-    probs = torch.softmax(torch.from_numpy(logits[0]), dim=0).numpy()
-    pred = np.argmax(probs)
-    conf = probs[pred]
-    return "Real" if pred == 1 else "Fake", conf
+def render_explanation(explanation):
+    with st.expander("🔍 What drove the verdict", expanded=True):
+        verdicts = explanation["verdicts"]
+        for view in ("text", "joint"):
+            if explanation["tokens"] and view in verdicts:
+                st.markdown(f"**Words behind the {CARD_TITLES[view].lower()}** ({verdicts[view]['label']})")
+                st.markdown(f"<div style='line-height: 1.8'>{highlight_tokens(explanation['text'], explanation['tokens'], view)}</div>",
+                            unsafe_allow_html=True)
+        overlays = explanation["overlays"]
+        if overlays:
+            columns = st.columns(len(overlays))
+            for column, (view, overlay) in zip(columns, overlays.items()):
+                column.image(overlay, caption=f"Regions behind the {CARD_TITLES[view].lower()} ({verdicts[view]['label']})",
+                             use_container_width=True)
+        st.caption("Red marks what argues for the verdict, blue what argues against it.")
 
 def main():
     inject_css()
     st.set_page_config(page_title="Multimodal BN-EN Fake News Scanner", layout="centered")
     st.markdown("<h1>Multimodal BN-EN Fake News Scanner</h1>", unsafe_allow_html=True)
-    st.markdown("<p class='subtitle'>Enter text and upload an image to analyze <strong>text-only</strong> and <strong>image-only</strong> predictions.</p>", unsafe_allow_html=True)
+    st.markdown("<p class='subtitle'>Enter text and upload the post's images to analyze <strong>text-only</strong>, <strong>image-only</strong> and <strong>joint</strong> predictions.</p>", unsafe_allow_html=True)
 
-    session, processor, device = load_model_and_processor()
-    if session is None:
+    classifier, processor = load_model_and_processor()
+    if classifier is None:
         st.stop()
+    start_metrics()
 
     text_input = st.text_area("Enter News Text", placeholder="Type a headline or article snippet...", height=180)
-    uploaded_image = st.file_uploader("Upload News Image", type=["jpg", "jpeg", "png"], help="Upload a related image")
+    # Clips only when PyAV can decode them
+    video_types = list(VIDEO_EXTENSIONS) if can_decode_video() else []
+    uploaded_images = st.file_uploader("Upload News Images", type=["jpg", "jpeg", "png", "gif", "webp"] + video_types,
+                                       accept_multiple_files=True,
+                                       help="Upload the images of the post; several are scanned together, and GIFs"
+                                            + (" and short clips" if video_types else "") + " by their keyframes")
+    long_text = st.checkbox("Scan the whole article", help="Longer texts are read in overlapping windows instead of only the first 77 tokens")
+    explain_verdict = st.checkbox("Explain the verdict", help="Highlight the words and image regions that drove the verdicts (first image only)")
 
-    if st.button("Analyze Multimodal Input"):
+    analyze = st.button("Analyze Multimodal Input")
+    # One slot per view, filled as soon as its pass finishes and again on reruns
+    cards = {view: st.empty() for view in VIEWS}
+
+    if analyze:
         if not text_input.strip():
             st.warning("Please enter news text.")
-        elif not uploaded_image:
+        elif not uploaded_images:
             st.warning("Please upload a news image.")
         else:
-            try:
-                image = Image.open(uploaded_image).convert("RGB")
-            except Exception as e:
-                st.error(f"Cannot open image: {e}")
-                return
-
-            with st.spinner("Running text-only and image-only analysis..."):
-                text_pred, text_conf = predict_text_only(text_input, image, session, processor, device)
-                img_pred, img_conf = predict_image_only(text_input, image, session, processor, device)
-                st.session_state.modality_results = {
-                    "text": {"label": text_pred, "conf": text_conf},
-                    "image": {"label": img_pred, "conf": img_conf}
-                }
+            with st.spinner("Running text-only, image-only and joint analysis..."):
+                try:
+                    image_bytes = [image.getvalue() for image in uploaded_images]
+                    start = time.perf_counter()
+                    with metrics.collect() as timings:
+                        st.session_state.modality_results = scan_post(
+                            text_input, image_bytes, classifier, processor, load_cache(),
+                            index=load_neighbor_index(),
+                            on_verdict=lambda view, verdict: render_card(cards[view], view, verdict),
+                            long_text=os.environ.get("SCANNER_LONG_TEXT_AGGREGATION", DEFAULT_AGGREGATION) if long_text else None,
+                            image_aggregate=os.environ.get("SCANNER_IMAGE_AGGREGATION", DEFAULT_AGGREGATION)
+                        )
+                    st.session_state.scan_timings = timings
+                    store = load_store()
+                    if store is not None:
+                        store.record(st.session_state.modality_results, text_input, image_bytes, "default",
+                                     model_version(), (time.perf_counter() - start) * 1000, source="app")
+                except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                    st.error(f"Cannot open image: {e}")
+                    return
+            st.session_state.pop('explanation', None)
+            if explain_verdict:
+                with st.spinner("Hiding each word and image region in turn..."):
+                    try:
+                        # The first upload as a still: a GIF's first frame; clips cannot be opened
+                        image = decode_image(uploaded_images[0].getvalue())
+                    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                        st.warning(f"Cannot explain this upload: {e}")
+                        image = None
+                    explanation = explain(text_input, image, classifier, processor)
+                    explanation["text"] = unicodedata.normalize("NFC", text_input)
+                    explanation["overlays"] = {view: heatmap_overlay(image, heatmap)
+                                               for view, heatmap in explanation["heatmaps"].items()}
+                    st.session_state.explanation = explanation
 
     if 'modality_results' in st.session_state:
         res = st.session_state.modality_results
 
-        text_icon = "🟢" if res['text']['label'] == "Real" else "🔴"
-        text_class = "text-real" if res['text']['label'] == "Real" else "text-fake"
-        st.markdown(f"""
-        <div class="result-card {text_class}">
-            <div class="icon">{text_icon}</div>
-            <div><strong>Text Analysis</strong></div>
-            <div>Prediction: <strong>{res['text']['label']}</strong></div>
-            <div>Confidence: {res['text']['conf']:.2%}</div>
-        </div>
-        """, unsafe_allow_html=True)
+        for view in VIEWS:
+            if view in res:
+                render_card(cards[view], view, res[view])
 
-        img_icon = "🟢" if res['image']['label'] == "Real" else "🔴"
-        img_class = "image-real" if res['image']['label'] == "Real" else "image-fake"
-        st.markdown(f"""
-        <div class="result-card {img_class}">
-            <div class="icon">{img_icon}</div>
-            <div><strong>Image Analysis</strong></div>
-            <div>Prediction: <strong>{res['image']['label']}</strong></div>
-            <div>Confidence: {res['image']['conf']:.2%}</div>
-        </div>
-        """, unsafe_allow_html=True)
+        if 'explanation' in st.session_state:
+            render_explanation(st.session_state.explanation)
 
-    if uploaded_image:
+        if res.get('frames'):
+            with st.expander("🎞️ Per-frame verdicts"):
+                st.table([{"time (s)": frame["time"], **{view: f"{frame[view]['label']} ({frame[view]['conf']:.2%})"
+                                                         for view in ("image", "joint") if view in frame}}
+                          for frame in res['frames']])
+
+        if res.get('images'):
+            with st.expander("🖼️ Per-image verdicts"):
+                rows = []
+                for uploaded, verdicts in zip(uploaded_images, res['images']):
+                    row = {"image": uploaded.name, "frames": len(verdicts.get('frames', [])) or None}
+                    for view in ("image", "joint"):
+                        if view in verdicts:
+                            row[view] = f"{verdicts[view]['label']} ({verdicts[view]['conf']:.2%})"
+                    rows.append(row)
+                st.table(rows)
+
+        if res.get('neighbors'):
+            with st.expander("🔎 Closest known posts"):
+                for kind, matches in res['neighbors'].items():
+                    st.markdown(f"**Similar {kind}**")
+                    st.table([{"label": match["label"], "similarity": round(match["similarity"], 3),
+                               "text": match.get("text"), "image": match.get("image_path")} for match in matches])
+
+    if uploaded_images:
         st.markdown("<div class='uploaded-image'>", unsafe_allow_html=True)
-        st.image(uploaded_image, use_container_width=True)
+        columns = st.columns(min(len(uploaded_images), 3))
+        for i, uploaded in enumerate(uploaded_images):
+            column = columns[i % len(columns)]
+            if uploaded.type.startswith("video/"):
+                column.video(uploaded)
+            else:
+                column.image(uploaded, caption=uploaded.name if len(uploaded_images) > 1 else None,
+                             use_container_width=True)
         st.markdown("</div>", unsafe_allow_html=True)
 
+    if debug_panel_enabled():
+        render_debug_panel()
+
     st.markdown("<div class='footer'>Made by Sadik Al Jarif</div>", unsafe_allow_html=True)
 
 if __name__ == "__main__":
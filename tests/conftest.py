@@ -0,0 +1,19 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def fixture_dir(tmp_path_factory):
+    """The tiny random-weight model of ``benchmarks.fixture``, both layouts."""
+    pytest.importorskip("onnx")
+    from benchmarks.fixture import build_fixture
+
+    return build_fixture(str(tmp_path_factory.mktemp("fixture")))
+
+
+@pytest.fixture(scope="session")
+def quantized_fixture_dir(tmp_path_factory):
+    """The same model, dynamically quantized like ``train_quantized.onnx``."""
+    pytest.importorskip("onnx")
+    from benchmarks.fixture import build_fixture
+
+    return build_fixture(str(tmp_path_factory.mktemp("fixture-quantized")), quantize=True)
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from scanner.batching import MicroBatcher
+
+
+def test_batches_concurrent_items_and_keeps_order():
+    batches = []
+
+    def run(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(run, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(6)]
+    assert [future.result(timeout=5) for future in futures] == [i * 10 for i in range(6)]
+    assert all(len(batch) <= 4 for batch in batches)
+    batcher.close()
+
+
+def test_items_with_different_keys_never_share_a_batch():
+    batches = []
+
+    def run(items):
+        batches.append(list(items))
+        return items
+
+    batcher = MicroBatcher(run, max_batch_size=8, max_wait_ms=50)
+    futures = [batcher.submit(i, key=i % 2) for i in range(6)]
+    for future in futures:
+        future.result(timeout=5)
+    batcher.close()
+    assert all(len({item % 2 for item in batch}) == 1 for batch in batches)
+
+
+def test_close_while_busy_rejects_new_items_and_resolves_queued_ones():
+    busy = threading.Event()
+    release = threading.Event()
+
+    def run(items):
+        busy.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(run, max_batch_size=1, max_wait_ms=0)
+    running = batcher.submit(1)
+    assert busy.wait(5)
+    queued = batcher.submit(2)
+    closer = threading.Thread(target=batcher.close)
+    closer.start()
+    while not batcher._closed:
+        pass
+    with pytest.raises(RuntimeError):
+        batcher.submit(3)
+    release.set()
+    closer.join(5)
+    assert not closer.is_alive()
+    assert running.result(timeout=5) == 1
+    assert queued.result(timeout=5) == 2
+    with pytest.raises(RuntimeError):
+        batcher.submit(4)
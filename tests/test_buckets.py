@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.inference import BANGLA_WORDS, WORDS
+from scanner.model import (FULL_MODEL_FILE, MAX_TEXT_LENGTH, TEXT_BUCKETS, FullGraphClassifier, bucket_widths,
+                           create_session, load_classifier, near_boundary, softmax)
+from scanner.tokenizer import ClipTokenizer
+
+LAYOUTS = ["full", "towers"]
+
+
+def texts(count=48, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(BANGLA_WORDS if i % 2 else WORDS, int(rng.integers(1, 40)))) for i in range(count)]
+
+
+def classifier(base_dir, layout, text_buckets, recheck_margin=None):
+    model_dir = os.path.join(base_dir, "clip_model")
+    if layout == "full":
+        model = FullGraphClassifier(create_session(os.path.join(model_dir, FULL_MODEL_FILE)), text_buckets)
+    else:
+        model = load_classifier(model_dir, text_buckets=text_buckets)
+    if recheck_margin is not None:
+        model.recheck_margin = recheck_margin
+    return model
+
+
+def encoded(base_dir):
+    input_ids, attention_mask = ClipTokenizer.from_dir(os.path.join(base_dir, "clip_processor"))(texts())
+    # Every bucket is used, or the comparison proves nothing
+    assert set(bucket_widths(attention_mask)) == set(TEXT_BUCKETS)
+    return input_ids, attention_mask
+
+
+def views(model, input_ids, attention_mask, pixel_values):
+    return {"text": model.text_logits(input_ids, attention_mask),
+            "joint": model.joint_logits(input_ids, attention_mask, pixel_values)}
+
+
+@pytest.fixture(scope="module")
+def pixel_values():
+    return np.random.default_rng(1).standard_normal((48, 3, 224, 224)).astype(np.float32)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_fp32_bucketed_logits_equal_full_length(fixture_dir, layout, pixel_values):
+    input_ids, attention_mask = encoded(fixture_dir)
+    bucketed = views(classifier(fixture_dir, layout, TEXT_BUCKETS, 0.0), input_ids, attention_mask, pixel_values)
+    full = views(classifier(fixture_dir, layout, (MAX_TEXT_LENGTH,)), input_ids, attention_mask, pixel_values)
+    for view in bucketed:
+        np.testing.assert_array_equal(bucketed[view], full[view])
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_quantized_bucketed_verdicts_equal_full_length(quantized_fixture_dir, layout, pixel_values):
+    input_ids, attention_mask = encoded(quantized_fixture_dir)
+    bucketed = views(classifier(quantized_fixture_dir, layout, TEXT_BUCKETS), input_ids, attention_mask, pixel_values)
+    full = views(classifier(quantized_fixture_dir, layout, (MAX_TEXT_LENGTH,)), input_ids, attention_mask, pixel_values)
+    for view in bucketed:
+        np.testing.assert_array_equal(bucketed[view].argmax(axis=1), full[view].argmax(axis=1))
+        np.testing.assert_allclose(softmax(bucketed[view]), softmax(full[view]), rtol=0, atol=0.02)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_quantized_recheck_reproduces_full_length(quantized_fixture_dir, layout, pixel_values):
+    # A margin every row falls within forces the full-length re-run
+    input_ids, attention_mask = encoded(quantized_fixture_dir)
+    rechecked = views(classifier(quantized_fixture_dir, layout, TEXT_BUCKETS, 1.0), input_ids, attention_mask,
+                      pixel_values)
+    full = views(classifier(quantized_fixture_dir, layout, (MAX_TEXT_LENGTH,)), input_ids, attention_mask, pixel_values)
+    for view in rechecked:
+        assert near_boundary(rechecked[view], 1.0).all()
+        np.testing.assert_array_equal(rechecked[view], full[view])
+
+
+class WidthSpy:
+    """A session wrapper recording the token width of every run that attends to text."""
+
+    def __init__(self, session):
+        self.session = session
+        self.widths = []
+
+    def run(self, outputs, feeds):
+        if feeds["attention_mask"].any():
+            self.widths.append(feeds["attention_mask"].shape[1])
+        return self.session.run(outputs, feeds)
+
+
+def test_quantized_graph_runs_every_text_at_full_length_by_default(quantized_fixture_dir, monkeypatch, pixel_values):
+    monkeypatch.delenv("SCANNER_TEXT_BUCKETS", raising=False)
+    input_ids, attention_mask = encoded(quantized_fixture_dir)
+    spy = WidthSpy(create_session(os.path.join(quantized_fixture_dir, "clip_model", FULL_MODEL_FILE)))
+    model = FullGraphClassifier(spy)
+    views(model, input_ids, attention_mask, pixel_values)
+    model.multi_view_logits(input_ids, attention_mask, pixel_values)
+    assert spy.widths and set(spy.widths) == {MAX_TEXT_LENGTH}
+    assert load_classifier(os.path.join(quantized_fixture_dir, "clip_model")).text_buckets == (MAX_TEXT_LENGTH,)
+
+
+def test_multi_view_logits_without_bucketing_equal_full_length_calls(quantized_fixture_dir, pixel_values):
+    input_ids, attention_mask = encoded(quantized_fixture_dir)
+    model = classifier(quantized_fixture_dir, "full", (MAX_TEXT_LENGTH,))
+    logits = model.multi_view_logits(input_ids[:8], attention_mask[:8], pixel_values[:8])
+    seq_len = attention_mask[:8].sum(axis=1)
+    for row in range(8):
+        one = (input_ids[row:row + 1], attention_mask[row:row + 1], pixel_values[row:row + 1])
+        np.testing.assert_array_equal(logits["text"][row].argmax(), model.text_logits(*one[:2])[0].argmax())
+        np.testing.assert_array_equal(logits["joint"][row].argmax(), model.joint_logits(*one)[0].argmax())
+        np.testing.assert_array_equal(logits["image"][row].argmax(),
+                                      model.image_logits(one[2], seq_len[row])[0].argmax())
@@ -0,0 +1,63 @@
+import json
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from scanner import bulk
+
+
+@pytest.fixture
+def rows_file(tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        Image.fromarray(rng.integers(0, 256, (60 + 20 * i, 90, 3), dtype=np.uint8)).save(tmp_path / f"{i}.png")
+    texts = ["Breaking news from Dhaka", "বাংলাদেশের রাস্তায় কোন যানজট নেই", "", "ভাইরাল ছবি 😱"]
+    path = tmp_path / "rows.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(11):
+            images = [f"{j}.png" for j in range(i % 3)] + (["missing.png"] if i == 7 else [])
+            f.write(json.dumps({"id": i, "text": texts[i % len(texts)], "image_path": images}, ensure_ascii=False) + "\n")
+    return path
+
+
+def run_bulk(monkeypatch, fixture_dir, rows_file, output):
+    monkeypatch.setattr(sys, "argv", ["scanner.bulk", str(rows_file), "--output", str(output),
+                                      "--image-root", str(rows_file.parent), "--base-dir", fixture_dir,
+                                      "--chunk-size", "4", "--batch-size", "3", "--workers", "2", "--no-cascade"])
+    bulk.main()
+
+
+def test_resumed_run_writes_what_an_uninterrupted_run_writes(monkeypatch, fixture_dir, rows_file, tmp_path):
+    run_bulk(monkeypatch, fixture_dir, rows_file, tmp_path / "whole.jsonl")
+    expected = (tmp_path / "whole.jsonl").read_bytes()
+    assert len(expected.splitlines()) == 11
+
+    # Die after the second chunk is written but before its checkpoint is saved
+    save_checkpoint = bulk.save_checkpoint
+    calls = []
+
+    def crash_on_second(path, state):
+        calls.append(state)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        save_checkpoint(path, state)
+
+    monkeypatch.setattr(bulk, "save_checkpoint", crash_on_second)
+    with pytest.raises(KeyboardInterrupt):
+        run_bulk(monkeypatch, fixture_dir, rows_file, tmp_path / "resumed.jsonl")
+    assert len((tmp_path / "resumed.jsonl").read_bytes().splitlines()) == 8
+
+    monkeypatch.setattr(bulk, "save_checkpoint", save_checkpoint)
+    run_bulk(monkeypatch, fixture_dir, rows_file, tmp_path / "resumed.jsonl")
+    assert (tmp_path / "resumed.jsonl").read_bytes() == expected
+
+
+def test_checkpoint_without_its_output_refuses_to_resume(monkeypatch, fixture_dir, rows_file, tmp_path):
+    output = tmp_path / "lost.jsonl"
+    run_bulk(monkeypatch, fixture_dir, rows_file, output)
+    output.unlink()
+    with pytest.raises(SystemExit, match="missing rows"):
+        run_bulk(monkeypatch, fixture_dir, rows_file, output)
+    assert not output.exists()
@@ -0,0 +1,71 @@
+import threading
+
+import numpy as np
+
+from scanner.cache import EmbeddingCache
+
+VALUE_BYTES = 512 * 4
+
+
+def vector(i):
+    return np.full(512, i, dtype=np.float32)
+
+
+def test_disk_stays_under_max_bytes(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), memory_entries=4, max_bytes=20 * VALUE_BYTES)
+    for i in range(200):
+        cache.put("text", str(i), vector(i))
+        assert cache.stats()["disk_bytes"] <= cache.max_bytes
+    stored = cache._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    assert stored == cache.stats()["disk_bytes"]
+    assert cache.stats()["evictions"] > 0
+    cache.close()
+
+
+def test_eviction_keeps_entries_read_from_disk(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), memory_entries=1, max_bytes=10 * VALUE_BYTES)
+    for i in range(10):
+        cache.put("image", str(i), vector(i))
+    # Entry 0 is the oldest written; reading it from disk makes it the newest used
+    np.testing.assert_array_equal(cache.get("image", "0"), vector(0))
+    assert cache.stats()["image_disk_hits"] == 1
+    cache.put("image", "10", vector(10))
+    assert cache.get("image", "0") is not None
+    assert cache.get("image", "1") is None
+    cache.close()
+
+
+def test_entries_and_access_times_survive_a_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = EmbeddingCache(path, namespace="model-a")
+    cache.put("text", "headline", vector(3))
+    cache.close()
+    cache = EmbeddingCache(path, namespace="model-a")
+    np.testing.assert_array_equal(cache.get("text", "headline"), vector(3))
+    other = EmbeddingCache(path, namespace="model-b")
+    assert other.get("text", "headline") is None
+    other.close()
+    cache.close()
+
+
+def test_concurrent_disk_reads(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), memory_entries=1)
+    for i in range(50):
+        cache.put("text", str(i), vector(i))
+    errors = []
+
+    def read(offset):
+        try:
+            for i in range(200):
+                key = (i * 7 + offset) % 50
+                np.testing.assert_array_equal(cache.get("text", str(key)), vector(key))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    cache.close()
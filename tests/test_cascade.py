@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from scanner.cascade import NEVER, TextCascade, featurize, train_logistic, tune_band
+
+
+def brute_force_band(probs, labels, clip_preds, tolerance):
+    """The most texts any pair of cut points settles within tolerance, tried one by one."""
+    values = np.unique(probs)
+    midpoints = (values[:-1] + values[1:]) / 2
+    lows = [NEVER[0]] + [cut for cut in midpoints if probs[probs < cut].max() < 0.5]
+    highs = [NEVER[1]] + [cut for cut in midpoints if probs[probs > cut].min() > 0.5]
+    target = (clip_preds == labels).sum() - tolerance * len(probs)
+    best = -1
+    for low in lows:
+        for high in highs:
+            preds = np.where(probs < low, 0, np.where(probs > high, 1, clip_preds))
+            if (preds == labels).sum() >= target:
+                best = max(best, int(((probs < low) | (probs > high)).sum()))
+    return best
+
+
+def settled_and_correct(band, probs, labels, clip_preds):
+    low, high = band
+    preds = np.where(probs < low, 0, np.where(probs > high, 1, clip_preds))
+    return int(((probs < low) | (probs > high)).sum()), int((preds == labels).sum())
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("tolerance", [0.0, 0.05])
+def test_tune_band_settles_as_many_texts_as_an_exhaustive_search(seed, tolerance):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 2, 60)
+    # Scores that lean toward the label, with ties, and a CLIP that is right 85% of the time
+    probs = np.clip(np.round(0.5 + (labels - 0.5) * 0.3 + rng.normal(0, 0.2, 60), 2), 0.01, 0.99)
+    clip_preds = np.where(rng.uniform(size=60) < 0.85, labels, 1 - labels)
+
+    band = tune_band(probs, labels, clip_preds, tolerance)
+    settled, correct = settled_and_correct(band, probs, labels, clip_preds)
+    # Settled as Fake only below 0.5, as Real only above
+    assert probs[probs < band[0]].max(initial=0) < 0.5 < probs[probs > band[1]].min(initial=1)
+    assert correct >= (clip_preds == labels).sum() - tolerance * len(probs)
+    assert settled == brute_force_band(probs, labels, clip_preds, tolerance)
+
+
+def test_tune_band_settles_everything_when_scores_separate_the_labels():
+    labels = np.array([0] * 10 + [1] * 10)
+    probs = np.concatenate([np.linspace(0.05, 0.4, 10), np.linspace(0.6, 0.95, 10)])
+    band = tune_band(probs, labels, 1 - labels)
+    assert settled_and_correct(band, probs, labels, 1 - labels) == (20, 20)
+
+
+def test_tune_band_settles_nothing_it_would_get_wrong_against_a_perfect_clip():
+    labels = np.array([0, 1, 0, 1, 0, 1])
+    probs = np.array([0.1, 0.2, 0.3, 0.7, 0.8, 0.9])
+    band = tune_band(probs, labels, labels)
+    assert settled_and_correct(band, probs, labels, labels) == (2, 6)
+    assert tune_band(np.empty(0), np.empty(0), np.empty(0)) == NEVER
+
+
+def test_saved_bands_route_texts(tmp_path):
+    texts = ["flood in dhaka", "ঢাকায় বন্যা", "celebrity secretly an alien", "ভাইরাল ভুয়া খবর"] * 5
+    labels = np.array([1, 1, 0, 0] * 5)
+    weights, bias = train_logistic(featurize(texts, 1024), labels, 1024, iterations=200, learning_rate=0.5)
+    cascade = TextCascade(weights, bias, {"en": (0.3, 0.7), "bn": NEVER})
+    cascade.save(str(tmp_path / "cascade.npz"))
+    loaded = TextCascade.load(str(tmp_path / "cascade.npz"))
+    assert loaded.bands == cascade.bands
+    logits, settled = loaded.route(texts)
+    probs = loaded.probabilities(texts)
+    english = np.array([i % 4 in (0, 2) for i in range(len(texts))])
+    np.testing.assert_array_equal(settled, english & ((probs < 0.3) | (probs > 0.7)))
+    np.testing.assert_allclose(np.exp(logits[:, 1]), probs, rtol=1e-5)
+    assert loaded.stats()["by_language"]["bn"]["short_circuited"] == 0
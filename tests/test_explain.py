@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from scanner.explain import cell_variants, explain
+from scanner.model import FULL_MODEL_FILE, LABELS, FullGraphClassifier, create_session, load_classifier, softmax
+from scanner.preprocess import preprocess_images
+from scanner.tokenizer import ClipTokenizer
+
+LAYOUTS = ["full", "towers"]
+TEXT = "Breaking news from Dhaka: বাংলাদেশের রাস্তায় কোন যানজট নেই"
+
+
+def classifier(base_dir, layout):
+    model_dir = os.path.join(base_dir, "clip_model")
+    if layout == "full":
+        return FullGraphClassifier(create_session(os.path.join(model_dir, FULL_MODEL_FILE)))
+    return load_classifier(model_dir)
+
+
+@pytest.fixture(scope="module")
+def image():
+    return Image.fromarray(np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8))
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_batched_occlusions_equal_one_by_one_runs(fixture_dir, layout, image):
+    model = classifier(fixture_dir, layout)
+    processor = ClipTokenizer.from_dir(os.path.join(fixture_dir, "clip_processor"))
+    batched = explain(TEXT, image, model, processor, grid=3, batch_size=64)
+    single = explain(TEXT, image, model, processor, grid=3, batch_size=1)
+
+    assert batched["verdicts"].keys() == single["verdicts"].keys() == {"text", "image", "joint"}
+    for view, verdict in batched["verdicts"].items():
+        assert verdict["label"] == single["verdicts"][view]["label"]
+        assert verdict["conf"] == pytest.approx(single["verdicts"][view]["conf"], abs=1e-5)
+    assert len(batched["tokens"]) == len(single["tokens"]) > 1
+    for ours, theirs in zip(batched["tokens"], single["tokens"]):
+        assert (ours["token"], ours["start"], ours["end"]) == (theirs["token"], theirs["start"], theirs["end"])
+        for view, importance in ours["importance"].items():
+            assert importance == pytest.approx(theirs["importance"][view], abs=1e-5)
+    assert batched["heatmaps"].keys() == single["heatmaps"].keys() == {"image", "joint"}
+    for view, heatmap in batched["heatmaps"].items():
+        np.testing.assert_allclose(heatmap, single["heatmaps"][view], atol=1e-5)
+
+    # The first cell's importance is the drop a scan of that occluded image alone shows
+    pixel_values = preprocess_images([image])
+    label = LABELS.index(batched["verdicts"]["image"]["label"])
+    occluded = softmax(model.image_logits(cell_variants(pixel_values, 3)[:1], int(processor([TEXT])[1].sum())))[0, label]
+    assert batched["heatmaps"]["image"][0][0] == pytest.approx(batched["verdicts"]["image"]["conf"] - occluded, abs=1e-5)
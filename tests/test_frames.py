@@ -0,0 +1,60 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from scanner.frames import SAMPLED_PER_KEPT, is_animated, keyframes
+
+
+def noise(seed, size=64):
+    return np.random.default_rng(seed).integers(0, 256, (size, size, 3), dtype=np.uint8)
+
+
+def nudged(pixels, i):
+    # Almost the same picture, but not a duplicate the GIF writer would merge
+    pixels = pixels.copy()
+    pixels[i % pixels.shape[0], 0] = 255 - pixels[i % pixels.shape[0], 0]
+    return pixels
+
+
+def gif(frames, durations):
+    images = [Image.fromarray(pixels) for pixels in frames]
+    buffer = io.BytesIO()
+    images[0].save(buffer, "GIF", save_all=True, append_images=images[1:], duration=durations, loop=0)
+    return buffer.getvalue()
+
+
+def test_gif_times_come_from_frame_durations():
+    data = gif([noise(i) for i in range(4)], [200, 500, 0, 300])
+    assert is_animated(data)
+    times, crops = keyframes(data, rate=100, max_frames=10, max_diff=-1)
+    # A frame without a duration is shown for 100 ms
+    assert times == [0.0, 0.2, 0.7, 0.8]
+    assert all(crop.shape == (224, 224, 3) and crop.dtype == np.uint8 for crop in crops)
+
+
+def test_near_duplicate_frames_are_dropped():
+    first = noise(0)
+    data = gif([first, nudged(first, 1), noise(1)], [200, 200, 200])
+    times, crops = keyframes(data, rate=100, max_frames=10, max_diff=6)
+    assert times == [0.0, 0.4]
+    assert len(crops) == 2
+
+
+def test_reading_stops_at_max_frames():
+    data = gif([noise(i) for i in range(10)], [100] * 10)
+    times, crops = keyframes(data, rate=100, max_frames=3, max_diff=-1)
+    assert times == [0.0, 0.1, 0.2]
+    assert len(crops) == 3
+
+
+def test_long_static_clip_is_not_read_to_the_end():
+    still = noise(0)
+    max_frames = 2
+    frames = [nudged(still, i) for i in range(max_frames * SAMPLED_PER_KEPT * 3)] + [noise(1)]
+    data = gif(frames, [1000] * len(frames))
+    times, _ = keyframes(data, rate=1, max_frames=max_frames, max_diff=6)
+    # The changed last frame lies past the sampled frames read
+    assert times == [0.0]
+    times, _ = keyframes(data, rate=1, max_frames=len(frames), max_diff=6)
+    assert times == [0.0, float(len(frames) - 1)]
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.inference import WORDS
+from scanner.longtext import AGGREGATIONS, aggregate_windows, long_text_logits
+from scanner.model import load_classifier, softmax
+from scanner.tokenizer import DEFAULT_WINDOW_STRIDE, ClipTokenizer
+
+
+@pytest.fixture(scope="module")
+def model(fixture_dir):
+    return (load_classifier(os.path.join(fixture_dir, "clip_model")),
+            ClipTokenizer.from_dir(os.path.join(fixture_dir, "clip_processor")))
+
+
+def article(words=200, seed=0):
+    return " ".join(np.random.default_rng(seed).choice(WORDS, words))
+
+
+@pytest.mark.parametrize("method", AGGREGATIONS)
+def test_long_text_combines_overlapping_windows_run_one_by_one(model, method):
+    classifier, processor = model
+    text, short = article(), "Breaking news from Dhaka"
+    input_ids, attention_mask = processor.windows(text)
+    assert len(input_ids) > 2
+    # Consecutive windows overlap by all but DEFAULT_WINDOW_STRIDE content tokens
+    size = input_ids.shape[1] - 2
+    np.testing.assert_array_equal(input_ids[1, 1:1 + size - DEFAULT_WINDOW_STRIDE],
+                                  input_ids[0, 1 + DEFAULT_WINDOW_STRIDE:1 + size])
+
+    logits = long_text_logits([text, short], classifier, processor, method)
+    windows = np.concatenate([classifier.text_logits(input_ids[i:i + 1], attention_mask[i:i + 1])
+                              for i in range(len(input_ids))])
+    np.testing.assert_allclose(softmax(logits[:1]), softmax(aggregate_windows(windows, method)), atol=1e-5)
+    if method == "mean":
+        np.testing.assert_allclose(softmax(logits[:1])[0], softmax(windows).mean(axis=0), atol=1e-5)
+    # A text that fits in one window keeps its plain text verdict
+    np.testing.assert_allclose(softmax(logits[1:]), softmax(classifier.text_logits(*processor([short]))), atol=1e-5)
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+
+from scanner.model import (FULL_MODEL_FILE, TEXT_BUCKETS, VIEWS, FullGraphClassifier, create_session, load_classifier,
+                           multi_view_from_embeds, softmax)
+from scanner.tokenizer import ClipTokenizer
+
+# The repeated text comes with another image, and shares a run with the first
+TEXTS = ["Breaking news from Dhaka", "বাংলাদেশের রাস্তায় কোন যানজট নেই", "", "ভাইরাল ছবি 😱", "Breaking news from Dhaka"]
+
+
+def inputs(base_dir):
+    input_ids, attention_mask = ClipTokenizer.from_dir(os.path.join(base_dir, "clip_processor"))(TEXTS)
+    pixel_values = np.random.default_rng(0).standard_normal((len(TEXTS), 3, 224, 224)).astype(np.float32)
+    return input_ids, attention_mask, pixel_values
+
+
+def separate(model, input_ids, attention_mask, pixel_values):
+    return {"text": model.text_logits(input_ids, attention_mask),
+            "image": model.image_logits(pixel_values, attention_mask.sum(axis=1)),
+            "joint": model.joint_logits(input_ids, attention_mask, pixel_values)}
+
+
+def assert_same_views(combined, expected):
+    assert set(combined) == set(VIEWS)
+    for view in VIEWS:
+        np.testing.assert_allclose(softmax(combined[view]), softmax(expected[view]), atol=1e-5)
+
+
+@pytest.mark.parametrize("text_buckets", [None, TEXT_BUCKETS], ids=["full-length", "bucketed"])
+def test_full_graph_three_views_equal_separate_calls(fixture_dir, text_buckets):
+    session = create_session(os.path.join(fixture_dir, "clip_model", FULL_MODEL_FILE))
+    model = FullGraphClassifier(session) if text_buckets is None else FullGraphClassifier(session, text_buckets)
+    input_ids, attention_mask, pixel_values = inputs(fixture_dir)
+    # Several posts share a token length, so runs hold more than one post
+    assert len(np.unique(attention_mask.sum(axis=1))) < len(TEXTS)
+    assert_same_views(model.multi_view_logits(input_ids, attention_mask, pixel_values),
+                      separate(model, input_ids, attention_mask, pixel_values))
+
+
+def test_tower_three_views_equal_separate_calls(fixture_dir):
+    model = load_classifier(os.path.join(fixture_dir, "clip_model"))
+    assert model.has_embeddings
+    input_ids, attention_mask, pixel_values = inputs(fixture_dir)
+    combined = multi_view_from_embeds(model, model.image_embeds(pixel_values), model.text_embeds(input_ids, attention_mask),
+                                      input_ids, attention_mask)
+    assert_same_views(combined, separate(model, input_ids, attention_mask, pixel_values))
+    assert_same_views(model.multi_view_logits(input_ids, attention_mask, pixel_values), combined)
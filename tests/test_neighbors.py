@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pytest
+
+from scanner import neighbors
+from scanner.neighbors import ITEMS_FILE, NeighborIndex
+
+DIM = 32
+
+
+def labelled(count, seed):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, DIM)).astype(np.float32)
+    items = [{"id": f"{seed}-{i}", "text": f"post {i}"} for i in range(count)]
+    return items, rng.integers(0, 2, count), vectors
+
+
+def append(index, items, labels, vectors):
+    # Every item has a text vector; every other one an image vector too
+    positions = np.arange(0, len(items), 2)
+    index.append(items, labels, {"text": (np.arange(len(items)), vectors), "image": (positions, -vectors[positions])})
+
+
+@pytest.fixture
+def small_tables(monkeypatch):
+    monkeypatch.setattr(neighbors, "MIN_TRAIN_ROWS", 64)
+
+
+def test_appends_in_parts_equal_one_append(tmp_path):
+    items, labels, vectors = labelled(120, 0)
+    whole = NeighborIndex.create(str(tmp_path / "whole"), dim=DIM)
+    append(whole, items, labels, vectors)
+    parts = NeighborIndex.create(str(tmp_path / "parts"), dim=DIM)
+    for start in range(0, 120, 50):
+        # Even starts keep the image positions of the parts aligned with the whole
+        append(parts, items[start:start + 50], labels[start:start + 50], vectors[start:start + 50])
+
+    queries = labelled(10, 1)[2]
+    for kind in ("text", "image"):
+        assert whole.tables[kind].count == parts.tables[kind].count
+        expected, got = whole.neighbors(kind, queries), parts.neighbors(kind, queries)
+        assert [[match["id"] for match in matches] for matches in got] == \
+               [[match["id"] for match in matches] for matches in expected]
+
+
+def test_interrupted_append_is_dropped_by_the_next_one(tmp_path):
+    index = NeighborIndex.create(str(tmp_path / "index"), dim=DIM)
+    items, labels, vectors = labelled(20, 0)
+    append(index, items[:10], labels[:10], vectors[:10])
+    # An append that died before publishing index.json leaves bytes past the published ends
+    for name in (ITEMS_FILE, "text.vectors", "text.rows", "image.vectors", "image.rows"):
+        with open(os.path.join(index.directory, name), "ab") as f:
+            f.write(b"\x07" * 999)
+    assert NeighborIndex(index.directory).tables["text"].count == 10
+
+    append(index, items[10:], labels[10:], vectors[10:])
+    reopened = NeighborIndex(index.directory)
+    assert reopened.tables["text"].count == 20
+    assert os.path.getsize(os.path.join(index.directory, "text.vectors")) == 20 * DIM
+    for i, matches in enumerate(reopened.neighbors("text", vectors, k=1)):
+        assert matches[0]["id"] == items[i]["id"]
+        assert matches[0]["label"] == neighbors.LABELS[labels[i]]
+        assert matches[0]["similarity"] > 0.99
+
+
+def test_rows_appended_after_training_join_its_cells(tmp_path, small_tables):
+    index = NeighborIndex.create(str(tmp_path / "index"), dim=DIM)
+    items, labels, vectors = labelled(200, 0)
+    append(index, items[:100], labels[:100], vectors[:100])
+    cells = index.header["tables"]["text"]["cells"]
+    assert cells > 0
+    centroids = index.tables["text"].centroids.copy()
+
+    append(index, items[100:], labels[100:], vectors[100:])
+    table = index.tables["text"]
+    assert index.header["tables"]["text"]["cells"] == cells
+    np.testing.assert_array_equal(table.centroids, centroids)
+    # Cells are assigned from the stored (int8-rounded) vectors
+    np.testing.assert_array_equal(table.cells[100:], np.argmax(table.dequantized(slice(100, 200)) @ centroids.T, axis=1))
+    # A re-post of an appended row is found through the cells
+    rows, similarities = index.search("text", vectors[150:160], k=1, probes=1)
+    np.testing.assert_array_equal(rows[:, 0], np.arange(150, 160))
+    assert (similarities[:, 0] > 0.99).all()
+
+
+def test_another_reader_sees_appends(tmp_path):
+    writer = NeighborIndex.create(str(tmp_path / "index"), dim=DIM)
+    reader = NeighborIndex(writer.directory)
+    items, labels, vectors = labelled(10, 0)
+    append(writer, items, labels, vectors)
+    os.utime(os.path.join(writer.directory, neighbors.HEADER_FILE), ns=(1, 1))
+    assert reader.neighbors("text", vectors[:1], k=1)[0][0]["id"] == items[0]["id"]
+    assert len(reader) == 15
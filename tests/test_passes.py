@@ -0,0 +1,49 @@
+import io
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from scanner.pipeline import load_model_and_processor, run_passes, scan_post
+
+
+def png(seed):
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.default_rng(seed).integers(0, 256, (40, 60, 3), dtype=np.uint8)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_concurrent_passes_overlap_and_report_on_the_calling_thread(monkeypatch):
+    monkeypatch.setenv("SCANNER_CONCURRENT_PASSES", "1")
+    started = {name: threading.Event() for name in ("text", "image")}
+
+    def waits_for(name, other):
+        def fn():
+            started[name].set()
+            # Only returns if the other pass runs at the same time
+            assert started[other].wait(timeout=5)
+            return name
+        return fn
+
+    caller, done = threading.get_ident(), []
+    results = run_passes({"text": waits_for("text", "image"), "image": waits_for("image", "text")},
+                         lambda name, result: done.append((name, result, threading.get_ident())))
+    assert results == {"text": "text", "image": "image"}
+    assert sorted(done) == [("image", "image", caller), ("text", "text", caller)]
+
+
+@pytest.mark.parametrize("images", [[0], [0, 1]], ids=["one-image", "two-images"])
+def test_concurrent_scans_equal_sequential_scans(monkeypatch, fixture_dir, images):
+    uploads = [png(seed) for seed in images]
+    results = {}
+    for value in ("0", "1"):
+        monkeypatch.setenv("SCANNER_CONCURRENT_PASSES", value)
+        classifier, processor = load_model_and_processor(fixture_dir, max_batch_size=1)
+        results[value] = scan_post("Breaking news from Dhaka", uploads if len(uploads) > 1 else uploads[0],
+                                   classifier, processor)
+    sequential, concurrent = results["0"], results["1"]
+    assert sequential.keys() == concurrent.keys()
+    for view in ("text", "image", "joint"):
+        assert concurrent[view]["label"] == sequential[view]["label"]
+        assert concurrent[view]["conf"] == pytest.approx(sequential[view]["conf"], abs=1e-5)
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("transformers")
+from transformers import CLIPImageProcessor
+
+from benchmarks.preprocess import TOLERANCE, load_images, max_difference
+
+
+@pytest.fixture(scope="module")
+def image_processor():
+    return CLIPImageProcessor(size={"shortest_edge": 224}, crop_size={"height": 224, "width": 224})
+
+
+def test_random_photos_match_clip_image_processor(image_processor):
+    assert max_difference(image_processor, load_images(None, 6, 0)) <= TOLERANCE
+
+
+def test_smooth_and_odd_sized_images_match_clip_image_processor(image_processor):
+    gradient = np.linspace(0, 255, 1000 * 700).reshape(700, 1000).astype(np.uint8)
+    images = [Image.fromarray(np.stack([gradient, gradient[::-1], 255 - gradient], -1)),
+              Image.fromarray(np.full((223, 225, 3), 128, dtype=np.uint8)),
+              Image.fromarray(np.full((2000, 90, 3), 30, dtype=np.uint8))]
+    assert max_difference(image_processor, images) <= TOLERANCE
@@ -0,0 +1,65 @@
+import types
+
+from scanner.registry import ModelRegistry, ModelVariant
+
+
+def make_registry(default_budget_ms=None):
+    # Only max_batch_size is read from the classifier when routing
+    classifier = types.SimpleNamespace(max_batch_size=2)
+    variants = {
+        "default": ModelVariant("default", None, classifier, latency_ms=40.0, accuracy={"text": 0.9, "image": 0.9}),
+        "int8": ModelVariant("int8", None, classifier, latency_ms=10.0, accuracy={"text": 0.8, "image": 0.8}),
+        "tiny": ModelVariant("tiny", None, classifier, latency_ms=5.0, accuracy={"text": 0.6, "image": 0.6}),
+    }
+    return ModelRegistry(variants, default_budget_ms=default_budget_ms)
+
+
+def test_picks_most_accurate_variant_within_budget():
+    registry = make_registry()
+    assert registry.route(100).name == "default"
+    assert registry.route(20).name == "int8"
+    assert registry.route().name == "default"
+
+
+def test_in_flight_requests_push_routing_to_a_cheaper_variant():
+    registry = make_registry()
+    held = [registry.route(50) for _ in range(2)]
+    assert [variant.name for variant in held] == ["default", "default"]
+    # Two in flight at max_batch_size 2: default is expected at 80 ms, int8 at 20 ms
+    assert registry._expected_ms(registry.variants["default"]) == 80.0
+    assert registry.route(50).name == "int8"
+    for variant in held:
+        registry.release(variant)
+    registry.release(registry.variants["int8"])
+    assert registry.stats()["in_flight"] == 0
+    assert registry.route(50).name == "default"
+
+
+def test_saturated_host_picks_variant_expected_first():
+    registry = make_registry()
+    for _ in range(8):
+        registry.route()
+    # 8 in flight: default 200 ms, int8 50 ms, tiny 25 ms, none within 20 ms
+    assert registry.route(20).name == "tiny"
+
+
+def test_default_serves_when_nothing_fits():
+    registry = make_registry()
+    assert registry.route(1).name == "default"
+    unmeasured = {name: ModelVariant(name, None, object()) for name in ("default", "int8")}
+    assert ModelRegistry(unmeasured)._pick(50).name == "default"
+
+
+def test_serving_releases_and_stats_count_reroutes():
+    registry = make_registry(default_budget_ms=20)
+    with registry.serving() as variant:
+        assert variant.name == "int8"
+        assert registry.stats()["in_flight"] == 1
+    with registry.serving(100) as variant:
+        assert variant.name == "default"
+    stats = registry.stats()
+    assert stats["in_flight"] == 0
+    assert stats["rerouted"] == 1
+    assert stats["variants"]["int8"]["served"] == 1
+    assert stats["variants"]["default"]["served"] == 1
+    assert stats["variants"]["tiny"]["served"] == 0
@@ -0,0 +1,73 @@
+import asyncio
+import base64
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("aiohttp")
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+from scanner.pipeline import load_model_and_processor
+from scanner.service import MAX_IMAGE_BYTES, MAX_POST_IMAGES, create_app
+
+
+@pytest.fixture(scope="module")
+def model(fixture_dir):
+    return load_model_and_processor(fixture_dir, max_batch_size=1, concurrent=False)
+
+
+def png():
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (40, 60, 3), dtype=np.uint8)).save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+async def bulk(app, lines):
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/scan/bulk", data="\n".join(json.dumps(line) for line in lines).encode("utf-8"))
+        assert response.status == 200
+        body = await response.text()
+    return sorted((json.loads(line) for line in body.splitlines()), key=lambda result: result["index"])
+
+
+def test_bulk_counts_images_before_decoding_them(model):
+    classifier, processor = model
+    lines = [{"id": "ok", "text": "Breaking news from Dhaka", "images": [png(), png()]},
+             {"id": "too-many", "images": ["not base64!"] * (MAX_POST_IMAGES + 1)},
+             {"id": "too-many-paths", "image_paths": ["missing.png"] * (MAX_POST_IMAGES + 1)}]
+    results = asyncio.run(bulk(create_app(classifier, processor), lines))
+    assert "error" not in results[0] and len(results[0]["images"]) == 2
+    for result in results[1:]:
+        assert result["error"] == f"At most {MAX_POST_IMAGES} images per post"
+
+
+def test_caller_supplied_executor_outlives_the_app(model):
+    classifier, processor = model
+    executor = ThreadPoolExecutor(max_workers=2)
+    asyncio.run(bulk(create_app(classifier, processor, executor=executor), [{"text": "Breaking news"}]))
+    assert executor.submit(lambda: 42).result(timeout=5) == 42
+    executor.shutdown()
+
+
+async def scan_form(app, uploads):
+    form = FormData()
+    for i, data in enumerate(uploads):
+        form.add_field("image", data, filename=f"{i}.png", content_type="image/png")
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/scan", data=form)
+        return response.status, await response.json()
+
+
+def test_scan_accepts_several_full_size_images_and_rejects_one_too_large(model):
+    classifier, processor = model
+    app = create_app(classifier, processor)
+    # Together above one image's limit; each is read and only then found undecodable
+    status, body = asyncio.run(scan_form(app, [b"\0" * (MAX_IMAGE_BYTES - 1)] * 2))
+    assert status == 400 and body["error"].startswith("Cannot open image")
+    status, body = asyncio.run(scan_form(create_app(classifier, processor), [b"\0" * (MAX_IMAGE_BYTES + 1)]))
+    assert status == 400 and body["error"] == f"Image larger than {MAX_IMAGE_BYTES} bytes: 0.png"
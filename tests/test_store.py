@@ -0,0 +1,45 @@
+import threading
+
+from scanner.store import PredictionStore
+
+RESULT = {"text": {"label": "Fake", "conf": 0.9}, "image": None, "joint": None}
+
+
+def test_rows_recorded_before_close_are_written(tmp_path):
+    store = PredictionStore(str(tmp_path / "predictions.sqlite"), flush_ms=5)
+    for i in range(20):
+        store.record(RESULT, text=f"headline {i}", image_bytes=b"\x89PNG", source="test")
+    store.close()
+    reopened = PredictionStore(str(tmp_path / "predictions.sqlite"))
+    rows = reopened.query(limit=100)
+    reopened.close()
+    assert len(rows) == 20
+    assert all(row["text_label"] == "Fake" and len(row["image_hashes"]) == 1 for row in rows)
+
+
+def test_record_racing_close_is_written_or_dropped_never_lost(tmp_path):
+    store = PredictionStore(str(tmp_path / "predictions.sqlite"), flush_ms=1, batch_size=4)
+    start = threading.Barrier(2)
+
+    def record():
+        start.wait()
+        for i in range(200):
+            store.record(RESULT, text=f"headline {i}")
+
+    thread = threading.Thread(target=record)
+    thread.start()
+    start.wait()
+    store.close()
+    thread.join()
+    stats = store.stats()
+    assert stats["written"] + stats["dropped"] == 200
+    assert stats["failed"] == 0
+
+
+def test_record_and_flush_after_close_are_no_ops(tmp_path):
+    store = PredictionStore(str(tmp_path / "predictions.sqlite"))
+    store.close()
+    store.record(RESULT, text="late")
+    store.flush()
+    store.close()
+    assert store.stats()["dropped"] == 1
@@ -0,0 +1,76 @@
+import os
+import unicodedata
+
+import numpy as np
+import pytest
+
+pytest.importorskip("transformers")
+
+from benchmarks.tokenizer import HARD_CASES, mismatches, reference_processor, sample_texts
+from scanner.model import MAX_TEXT_LENGTH
+from scanner.tokenizer import ClipTokenizer
+
+BENGALI = [
+    "বাংলাদেশের রাস্তায় কোন যানজট নেই",
+    unicodedata.normalize("NFD", "ড়াকাত ধরা পড়েছে"),
+    "র‍্যাবের অভিযানে আটক ৫",
+]
+MIXED_SCRIPT = [
+    "ঢাকায় BREAKING news: ভাইরাল ছবি",
+    "প্রধানমন্ত্রী said the বন্যা was under control",
+    "১২৩ ৪৫৬ 2024-05-01 ৳500",
+]
+EMOJI = [
+    "ভাইরাল ছবি 😱🔥",
+    "👨‍👩‍👧 family 🇧🇩 flag ❤️ and skin tones 👍🏽",
+    "😂" * 100,
+]
+LONG = [
+    " ".join(["বাংলাদেশের রাস্তায় কোন যানজট নেই"] * 30),
+    " ".join(["Breaking news from Dhaka"] * 40),
+    " ".join(["ঢাকায় BREAKING 😱"] * 40),
+]
+
+
+@pytest.fixture(scope="module")
+def processor_dir(fixture_dir):
+    return os.path.join(fixture_dir, "clip_processor")
+
+
+@pytest.fixture(scope="module")
+def fast_processor(processor_dir):
+    return reference_processor(processor_dir, use_fast=True)
+
+
+@pytest.mark.parametrize("texts", [BENGALI, MIXED_SCRIPT, EMOJI, LONG, HARD_CASES],
+                         ids=["bengali", "mixed-script", "emoji", "over-77-tokens", "hard-cases"])
+def test_matches_fast_clip_processor(processor_dir, fast_processor, texts):
+    tokenizer = ClipTokenizer.from_dir(processor_dir, memo_entries=0)
+    assert mismatches(tokenizer, fast_processor, texts) == []
+
+
+def test_long_texts_are_truncated_to_max_length(processor_dir):
+    ids, mask = ClipTokenizer.from_dir(processor_dir)(LONG)
+    assert ids.shape == (len(LONG), MAX_TEXT_LENGTH)
+    assert (mask == 1).all()
+
+
+def test_memo_gives_the_uncached_encodings(processor_dir, fast_processor):
+    texts = sample_texts(200, 0)
+    tokenizer = ClipTokenizer.from_dir(processor_dir, memo_entries=64)
+    first = tokenizer(texts)
+    second = tokenizer(texts[::-1])
+    expected = tokenizer.encode_uncached(texts)
+    for got, want in zip(first, expected):
+        np.testing.assert_array_equal(got, want)
+    for got, want in zip(second, expected):
+        np.testing.assert_array_equal(got[::-1], want)
+    assert mismatches(tokenizer, fast_processor, texts) == []
+
+
+def test_decomposed_and_composed_spellings_share_a_memo_entry(processor_dir):
+    composed = "ড়াকাত ধরা পড়েছে"
+    tokenizer = ClipTokenizer.from_dir(processor_dir)
+    ids, _ = tokenizer([composed, unicodedata.normalize("NFD", composed)])
+    np.testing.assert_array_equal(ids[0], ids[1])
+    assert tokenizer.stats()["memo_entries"] == 1